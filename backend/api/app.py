@@ -1,16 +1,25 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional
 from modelclass import CounselGPTModel
+from llm.model_factory import ModelNotReady, registry
 from cache import ResponseCache
+from singleflight import SingleFlight
+from inference_executor import InferenceExecutor, InferenceQueueFull
 from metrics import (
     INFERENCE_TIME,
-    TOKENS_GENERATED,
     CACHE_HITS,
     CACHE_MISSES,
+    COALESCED_REQUESTS,
+    CONTEXT_TRUNCATED_MESSAGES,
+    TIME_TO_FIRST_TOKEN,
     add_metrics_middleware
 )
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import json
 import logging
 import time
 import os
@@ -42,6 +51,52 @@ add_metrics_middleware(app)
 redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
 cache = ResponseCache(redis_url=redis_url)
 
+# -----------------------------
+# Request Coalescing
+# -----------------------------
+# Identical in-flight prompts share one generation; followers wait for the leader.
+inflight = SingleFlight()
+# Optionally extend this across replicas with a Redis lock
+SINGLEFLIGHT_REDIS_LOCK = os.getenv("SINGLEFLIGHT_REDIS_LOCK", "false").lower() == "true"
+SINGLEFLIGHT_LOCK_TTL = float(os.getenv("SINGLEFLIGHT_LOCK_TTL", "120"))
+
+# -----------------------------
+# Inference Executor
+# -----------------------------
+# Generation runs on dedicated threads behind a bounded queue, so the event
+# loop (cache hits, health checks) never waits behind llama.cpp.
+inference = InferenceExecutor(
+    # With parallel decoding each slot needs a thread blocked on its request
+    max_workers=int(os.getenv("INFERENCE_WORKERS", str(max(2, int(os.getenv("LLM_N_PARALLEL", "1")))))),
+    max_queue=int(os.getenv("INFERENCE_MAX_QUEUE", "32")),
+)
+INFERENCE_RETRY_AFTER = os.getenv("INFERENCE_RETRY_AFTER", "5")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    inference.shutdown()
+    await cache.aclose()
+    cache.close()
+
+
+def _queue_full(e: InferenceQueueFull) -> HTTPException:
+    logger.warning(str(e))
+    return HTTPException(
+        status_code=503,
+        detail="Inference queue full, retry later",
+        headers={"Retry-After": INFERENCE_RETRY_AFTER},
+    )
+
+
+def _not_ready(e: ModelNotReady) -> HTTPException:
+    logger.warning(str(e))
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
 
 # -----------------------------
 # Request/Response Models
@@ -61,6 +116,8 @@ class InferRequest(BaseModel):
     use_gpu: bool = Field(True, description="Use GPU acceleration (recommended)")
     use_cache: bool = Field(True, description="Use Redis cache for faster repeated queries")
     semantic_threshold: Optional[float] = Field(None, ge=0.0, le=1.0, description="Optional: Override semantic similarity threshold (0.0-1.0)")
+    stream: bool = Field(False, description="Stream tokens as server-sent events instead of returning one JSON body")
+    session_id: Optional[str] = Field(None, max_length=128, description="Conversation id: reuses the model state of earlier turns (the router keeps it on one pod)")
 
 
 class InferResponse(BaseModel):
@@ -69,10 +126,13 @@ class InferResponse(BaseModel):
     response_length: int = Field(..., description="Length of generated response in characters")
     cached: bool = Field(default=False, description="Whether response was served from cache")
     model_used: str = Field(default="qwen", description="Model that generated the response")
-    # New: context tracking
-    estimated_tokens: int = Field(default=0, description="Approximate tokens in prompt (chars / 4)")
+    # New: context tracking (None on cache hits whose entry has no stored usage)
+    estimated_tokens: Optional[int] = Field(default=None, description="Prompt tokens (model tokenizer, including the template)")
     context_window: int = Field(default=2048, description="Maximum context window size")
-    messages_in_context: int = Field(default=1, description="Number of messages in context")
+    messages_in_context: Optional[int] = Field(default=None, description="Number of messages in context")
+    messages_truncated: Optional[int] = Field(default=None, description="Oldest messages dropped to fit the context window")
+    coalesced: bool = Field(default=False, description="Whether response was shared from an identical in-flight request")
+    session_id: Optional[str] = Field(default=None, description="Conversation id echoed back for follow-up turns")
 
 
 # -----------------------------
@@ -93,12 +153,14 @@ def metrics_endpoint():
 # HEALTH CHECK
 # -----------------------------
 @app.get("/health")
-def health_check():
+async def health_check():
     return {
         "status": "healthy",
-        "cache": cache.stats(),
+        "cache": await cache.stats(),
+        "inference": inference.stats(),
+        "models": registry.stats(),
         "available_models": ["qwen", "llama"],
-        "context_window": 2048,  # Token limit for models
+        "context_window": CounselGPTModel().context_window,  # Token limit of the default model
         "max_tokens_per_request": 2048,
     }
 
@@ -107,7 +169,7 @@ def health_check():
 # INFERENCE ENDPOINT
 # -----------------------------
 @app.post("/infer", response_model=InferResponse)
-def infer(req: InferRequest):
+async def infer(req: InferRequest):
     """
     Perform model inference (Qwen or Llama) with conversation context
     """
@@ -117,82 +179,144 @@ def infer(req: InferRequest):
     # -----------------------------
     if req.messages:
         # New: conversation history
-        conversation_text = ""
+        lines = []
         for msg in req.messages:
             role_label = "User" if msg.role == "user" else "Assistant"
-            conversation_text += f"{role_label}: {msg.content}\n\n"
+            lines.append(f"{role_label}: {msg.content}\n\n")
         
         # Add final prompt for assistant
-        conversation_text += "Assistant:"
-        full_prompt = conversation_text
-        messages_count = len(req.messages)
+        suffix = "Assistant:"
     elif req.prompt:
         # Legacy: single prompt
-        full_prompt = req.prompt
-        messages_count = 1
+        lines = [req.prompt]
+        suffix = ""
     else:
         raise HTTPException(
             status_code=400,
             detail="Either 'messages' or 'prompt' must be provided"
         )
-    
-    # Estimate token count (rough: 1 token ≈ 4 chars)
-    estimated_tokens = len(full_prompt) // 4
-    
-    logger.info(
-        f"Received infer request model={req.model_name}, "
-        f"use_gpu={req.use_gpu}, "
-        f"max_tokens={req.max_tokens}, "
-        f"use_cache={req.use_cache}, "
-        f"threshold={req.semantic_threshold}, "
-        f"messages={messages_count}, "
-        f"est_tokens={estimated_tokens}"
-    )
+    # Cache and coalescing keys use the whole conversation, not the fitted one
+    full_prompt = "".join(lines) + suffix
 
     # -----------------------------
-    # Cache Check
+    # Validate Model Name
+    # -----------------------------
+    if req.model_name.lower() not in ["qwen", "llama"]:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Invalid model_name: {req.model_name}. Must be 'qwen' or 'llama'"
+        )
+
+    model = CounselGPTModel(model_name=req.model_name, use_gpu=req.use_gpu)
+
+    # -----------------------------
+    # Cache Check (before fitting: hits never touch the tokenizer)
     # -----------------------------
     if req.use_cache:
-        cached_response = cache.get(full_prompt, req.max_tokens, threshold=req.semantic_threshold)
+        cached_response = await cache.get(full_prompt, req.max_tokens, threshold=req.semantic_threshold)
         if cached_response:
             CACHE_HITS.inc()
             logger.info(f"Cache hit for prompt (length={len(full_prompt)})")
+            if req.stream:
+                return _sse_response(_cached_events(cached_response, req))
+            # Usage stored with the entry; unknown for semantic hits or older entries
+            usage = await cache.get_usage(full_prompt, req.max_tokens)
+            if usage.get("model") != req.model_name.lower():
+                usage = {}
             return InferResponse(
                 response=cached_response,
                 prompt_length=len(full_prompt),
                 response_length=len(cached_response),
                 cached=True,
                 model_used=req.model_name,
-                estimated_tokens=estimated_tokens,
-                context_window=2048,
-                messages_in_context=messages_count,
+                estimated_tokens=usage.get("estimated_tokens"),
+                context_window=usage.get("context_window", model.context_window),
+                messages_in_context=usage.get("messages_in_context"),
+                messages_truncated=usage.get("messages_truncated"),
+                session_id=req.session_id,
             )
         else:
             CACHE_MISSES.inc()
 
     # -----------------------------
-    # Validate Model Name
+    # Fit the context window (n_ctx - max_tokens), counted by the model tokenizer
     # -----------------------------
-    if req.model_name.lower() not in ["qwen", "llama"]:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid model_name: {req.model_name}. Must be 'qwen' or 'llama'"
+    try:
+        model_prompt, messages_count, estimated_tokens = await asyncio.to_thread(
+            _fit_context, model, lines, suffix, req.max_tokens
         )
+    except ValueError as e:
+        logger.error(f"Validation Error: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    messages_truncated = len(lines) - messages_count
+    context_window = model.context_window
+    # Stored with cache entries, so cache hits report the same usage
+    usage = {
+        "model": req.model_name.lower(),
+        "estimated_tokens": estimated_tokens,
+        "context_window": context_window,
+        "messages_in_context": messages_count,
+        "messages_truncated": messages_truncated,
+    }
+    
+    logger.info(
+        f"Received infer request model={req.model_name}, "
+        f"use_gpu={req.use_gpu}, "
+        f"max_tokens={req.max_tokens}, "
+        f"use_cache={req.use_cache}, "
+        f"threshold={req.semantic_threshold}, "
+        f"stream={req.stream}, "
+        f"messages={messages_count}, "
+        f"truncated={messages_truncated}, "
+        f"prompt_tokens={estimated_tokens}"
+    )
 
+    # Fail fast (and start loading in the background) if the model isn't resident
+    try:
+        model.ensure_ready()
+    except ModelNotReady as e:
+        raise _not_ready(e)
+
+    # -----------------------------
+    # Streaming Inference (not coalesced: each client gets its own token stream)
     # -----------------------------
-    # Run Inference Using ModelFactory
+    if req.stream:
+        try:
+            pieces = await inference.stream(lambda: model.infer_stream(model_prompt, req.max_tokens, req.session_id))
+        except InferenceQueueFull as e:
+            raise _queue_full(e)
+        except ModelNotReady as e:
+            raise _not_ready(e)
+        except ValueError as e:
+            logger.error(f"Validation Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.error(f"Unexpected Error: {e}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+        # Closing on completion also covers a response dropped before it streamed
+        return _sse_response(_stream_events(pieces, full_prompt, req, usage), on_close=pieces.aclose)
+
+    # -----------------------------
+    # Run Inference (coalesced per prompt/max_tokens/model)
     # -----------------------------
     try:
-        model = CounselGPTModel(model_name=req.model_name, use_gpu=req.use_gpu)
+        if req.use_cache:
+            flight_key = f"{req.model_name.lower()}:{req.max_tokens}:{full_prompt}"
+            result, coalesced = await inflight.do(
+                flight_key,
+                lambda: _generate_and_cache(flight_key, full_prompt, model_prompt, req, usage),
+            )
+            if coalesced:
+                COALESCED_REQUESTS.inc()
+                logger.info(f"Coalesced with in-flight request (length={len(full_prompt)})")
+        else:
+            result, coalesced = await _generate(model_prompt, req), False
 
-        start_time = time.time()
-        result = model.infer(full_prompt, req.max_tokens)
-        inference_time = time.time() - start_time
-        
-        INFERENCE_TIME.observe(inference_time)
-        TOKENS_GENERATED.inc(len(result.split()))
-        
-        logger.info(f"Inference completed in {inference_time:.2f}s, generated {len(result)} chars")
+    except InferenceQueueFull as e:
+        raise _queue_full(e)
+
+    except ModelNotReady as e:
+        raise _not_ready(e)
 
     except ValueError as e:
         logger.error(f"Validation Error: {e}")
@@ -206,12 +330,6 @@ def infer(req: InferRequest):
         logger.error(f"Unexpected Error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-    # -----------------------------
-    # Cache Result
-    # -----------------------------
-    if req.use_cache:
-        cache.set(full_prompt, req.max_tokens, result, ttl=3600)
-
     return InferResponse(
         response=result,
         prompt_length=len(full_prompt),
@@ -219,23 +337,155 @@ def infer(req: InferRequest):
         cached=False,
         model_used=req.model_name,
         estimated_tokens=estimated_tokens,
-        context_window=2048,
+        context_window=context_window,
         messages_in_context=messages_count,
+        messages_truncated=messages_truncated,
+        coalesced=coalesced,
+        session_id=req.session_id,
     )
 
 
+def _fit_context(model: CounselGPTModel, lines: list[str], suffix: str, max_tokens: int) -> tuple[str, int, int]:
+    """
+    Drop the oldest transcript lines until the templated prompt plus
+    max_tokens fits the model's context window. Returns
+    (prompt, lines kept, prompt tokens); raises ValueError if even the
+    latest line alone does not fit.
+    """
+    window = model.context_window
+    budget = window - max_tokens
+    keep = len(lines)
+    tokens = model.prompt_tokens("".join(lines) + suffix, max_tokens)
+    if tokens > budget and keep > 1:
+        # Per-line counts are close enough to pick the cut; the exact count is rechecked below
+        sizes = [model.count_tokens(line) for line in lines]
+        while keep > 1 and tokens > budget:
+            tokens -= sizes[len(lines) - keep]
+            keep -= 1
+        tokens = model.prompt_tokens("".join(lines[-keep:]) + suffix, max_tokens)
+        while keep > 1 and tokens > budget:
+            keep -= 1
+            tokens = model.prompt_tokens("".join(lines[-keep:]) + suffix, max_tokens)
+        dropped = len(lines) - keep
+        CONTEXT_TRUNCATED_MESSAGES.inc(dropped)
+        logger.info(f"Dropped {dropped} oldest messages to fit {tokens} + {max_tokens} tokens into {window}")
+
+    if tokens > budget:
+        raise ValueError(
+            f"Prompt is {tokens} tokens; with max_tokens={max_tokens} the "
+            f"{window}-token context window allows at most {budget}"
+        )
+    return "".join(lines[-keep:]) + suffix, keep, tokens
+
+
+async def _generate(model_prompt: str, req: InferRequest) -> str:
+    """Run the model on the inference executor and record inference metrics."""
+    model = CounselGPTModel(model_name=req.model_name, use_gpu=req.use_gpu)
+
+    start_time = time.time()
+    result = await inference.run(lambda: model.infer(model_prompt, req.max_tokens, req.session_id))
+    inference_time = time.time() - start_time
+    
+    # Token counts are recorded by the model from llama.cpp's usage
+    INFERENCE_TIME.observe(inference_time)
+    
+    logger.info(f"Inference completed in {inference_time:.2f}s, generated {len(result)} chars")
+    return result
+
+
+async def _generate_and_cache(
+    flight_key: str, full_prompt: str, model_prompt: str, req: InferRequest, usage: dict
+) -> str:
+    """
+    Leader path of a coalesced request: generate once and write the cache
+    before followers are released. With SINGLEFLIGHT_REDIS_LOCK, a replica
+    that finds the prompt already in flight elsewhere waits for that result.
+    """
+    token = ""
+    if SINGLEFLIGHT_REDIS_LOCK:
+        token = await cache.acquire_lock(flight_key, SINGLEFLIGHT_LOCK_TTL)
+        if token is None:
+            remote = await cache.wait_for(flight_key, full_prompt, req.max_tokens, timeout=SINGLEFLIGHT_LOCK_TTL)
+            if remote:
+                return remote
+            # Owner failed or timed out - generate locally
+            token = await cache.acquire_lock(flight_key, SINGLEFLIGHT_LOCK_TTL)
+
+    try:
+        result = await _generate(model_prompt, req)
+        await cache.set(full_prompt, req.max_tokens, result, ttl=3600, usage=usage)
+        return result
+    finally:
+        await cache.release_lock(flight_key, token)
+
+
+# -----------------------------
+# Streaming (Server-Sent Events)
+# -----------------------------
+def _sse(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def _sse_response(events, on_close: Optional[Callable[[], Awaitable]] = None) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(on_close) if on_close else None,
+    )
+
+
+def _cached_events(response: str, req: InferRequest) -> Iterator[str]:
+    yield _sse({"token": response})
+    yield _sse({"done": True, "cached": True, "model_used": req.model_name, "response_length": len(response)})
+
+
+async def _stream_events(
+    pieces: AsyncIterator[str], full_prompt: str, req: InferRequest, usage: dict
+) -> AsyncIterator[str]:
+    """
+    Relay generated pieces as SSE events. The assembled text is cached only
+    when generation completes (not when the client disconnects mid-stream).
+    """
+    start_time = time.time()
+    parts = []
+    try:
+        async for piece in pieces:
+            if not parts:
+                TIME_TO_FIRST_TOKEN.observe(time.time() - start_time)
+            parts.append(piece)
+            yield _sse({"token": piece})
+    except Exception as e:
+        logger.error(f"Inference Error: {e}")
+        yield _sse({"error": "Model inference failed"})
+        return
+    finally:
+        # Stop the worker (and release the model lock) promptly if the client went away
+        await pieces.aclose()
+
+    result = "".join(parts).strip()
+    inference_time = time.time() - start_time
+    INFERENCE_TIME.observe(inference_time)
+    logger.info(f"Streamed inference completed in {inference_time:.2f}s, generated {len(result)} chars")
+
+    if req.use_cache and result:
+        await cache.set(full_prompt, req.max_tokens, result, ttl=3600, usage=usage)
+
+    yield _sse({"done": True, "cached": False, "model_used": req.model_name, "response_length": len(result)})
+
+
 # -----------------------------
 # Cache Admin
 # -----------------------------
 @app.post("/cache/clear")
-def clear_cache():
-    deleted = cache.clear()
+async def clear_cache():
+    deleted = await cache.clear()
     return {"message": f"Cleared {deleted} cached responses"}
 
 
 @app.get("/cache/stats")
-def cache_stats():
-    return cache.stats()
+async def cache_stats():
+    return await cache.stats()
 
 
 @app.get("/")
@@ -253,6 +503,8 @@ def root():
                     "model_name": "qwen (default) or llama",
                     "use_gpu": "true/false",
                     "use_cache": "true/false",
+                    "stream": "true/false (server-sent events)",
+                    "session_id": "optional conversation id for multi-turn KV reuse",
                 },
             },
             "/cache/stats": "GET",
@@ -1,4 +1,6 @@
 import redis
+import redis.asyncio as aioredis
+import asyncio
 import json
 import hashlib
 import logging
@@ -6,10 +8,75 @@ import os
 import httpx
 import time
 import threading
-from typing import Optional, List
+import uuid
+from typing import Optional
+
+import numpy as np
+
+from local_cache import LRUCache
+from metrics import LOCAL_CACHE_HITS, LOCAL_CACHE_MISSES
+from vector_index import VectorIndex
 
 logger = logging.getLogger("counselgpt-api.cache")
 
+# -----------------------------
+# Entry layout
+# -----------------------------
+# v2 entries are Redis hashes:
+#   v          -> b"2"
+#   response   -> UTF-8 response text
+#   prompt     -> UTF-8 prompt text
+#   max_tokens -> integer
+#   emb        -> raw little-endian embedding buffer (optional)
+#   emb_dtype  -> "f32" | "f16" | "i8"
+#   emb_scale  -> dequantization scale for "i8"
+#   model, estimated_tokens, context_window, messages_in_context,
+#   messages_truncated -> usage of the answering model (optional)
+# v1 entries (plain string, or JSON with an "embedding" float list) are still read.
+CACHE_FORMAT_VERSION = b"2"
+INVALIDATION_CHANNEL = "llama:cache:invalidate"
+LOCK_PREFIX = "llama:inflight:"
+USAGE_FIELDS = ("model", "estimated_tokens", "context_window", "messages_in_context", "messages_truncated")
+
+# Delete the lock only if we still own it
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+EMBEDDING_DTYPES = {"f32": "<f4", "f16": "<f2", "i8": "i1"}
+
+
+def encode_embedding(embedding, dtype: str = "f16") -> tuple:
+    """Pack an embedding into (buffer, scale) for the given storage dtype."""
+    vec = np.asarray(embedding, dtype=np.float32).ravel()
+    if dtype == "i8":
+        peak = float(np.max(np.abs(vec))) if vec.size else 0.0
+        scale = peak / 127.0 if peak > 0 else 1.0
+        return np.round(vec / scale).astype(np.int8).tobytes(), scale
+    return vec.astype(EMBEDDING_DTYPES[dtype]).tobytes(), 1.0
+
+
+def decode_embedding(buffer: bytes, dtype: str = "f16", scale: float = 1.0) -> np.ndarray:
+    """Zero-copy view of a stored embedding (i8 is rescaled into a new float32 array)."""
+    vec = np.frombuffer(buffer, dtype=EMBEDDING_DTYPES[dtype])
+    if dtype == "i8":
+        return vec.astype(np.float32) * np.float32(scale)
+    return vec
+
+
+EMBED_BINARY_TYPE = "application/octet-stream"
+EMBED_ACCEPT = f"{EMBED_BINARY_TYPE}, application/json;q=0.5"
+
+
+def parse_embed_response(response: httpx.Response) -> np.ndarray:
+    """Decode an /embed response (binary float32 matrix or JSON) into a (rows, dim) array."""
+    if response.headers.get("content-type", "").startswith(EMBED_BINARY_TYPE):
+        rows, dim = (int(n) for n in response.headers["x-embedding-shape"].split(","))
+        return np.frombuffer(response.content, dtype="<f4").reshape(rows, dim)
+    return np.asarray(response.json()["embeddings"], dtype=np.float32)
+
 class ResponseCache:
     def __init__(
         self, 
@@ -17,7 +84,8 @@ class ResponseCache:
         embedding_url: str = "http://counselgpt-embeddings:8000",
         use_semantic: bool = True,
         similarity_threshold: float = 0.95,
-        retry_delay: float = 5.0
+        retry_delay: float = 5.0,
+        index_resync_interval: float = 60.0
     ):
         """Initialize Redis Cache in a non-blocking background thread."""
 
@@ -43,14 +111,50 @@ class ResponseCache:
         self.is_connected = False
         self.embedding_available = False
         
-        # Clients (Initially None)
+        # Clients (Initially None). The sync ones serve the background thread
+        # (health, index resync, pubsub); request handlers use the asyncio ones.
         self.redis_client = None
         self.embedding_client = None
+        self._async_redis = None
+        self._async_embedding = None
+        self.redis_max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+
+        # Binary embedding storage dtype for v2 entries
+        self.embedding_dtype = os.getenv("CACHE_EMBEDDING_DTYPE", "f16")
+        if self.embedding_dtype not in EMBEDDING_DTYPES:
+            logger.warning(f"Invalid CACHE_EMBEDDING_DTYPE '{self.embedding_dtype}', using f16")
+            self.embedding_dtype = "f16"
+
+        # In-process vector index for semantic lookups (Redis stays source of truth)
+        self.vector_index = VectorIndex()
+        self.index_resync_interval = float(os.getenv("SEMANTIC_INDEX_RESYNC_INTERVAL", index_resync_interval))
+        self._last_index_sync = 0.0
+
+        # Per-worker in-memory tier consulted before Redis for exact-key hits
+        self.local_cache = LRUCache(
+            max_items=int(os.getenv("LOCAL_CACHE_MAX_ITEMS", "1024")),
+            max_bytes=int(os.getenv("LOCAL_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+            ttl=float(os.getenv("LOCAL_CACHE_TTL", "300")),
+        )
+        self.use_invalidation = os.getenv("CACHE_INVALIDATION_PUBSUB", "true").lower() == "true"
+
+        # Prompt -> embedding memo, so get() and the set() after a miss (and
+        # repeated prompts) call the embedding service once
+        self.embedding_memo = LRUCache(
+            max_items=int(os.getenv("EMBEDDING_MEMO_MAX_ITEMS", "4096")),
+            max_bytes=int(os.getenv("EMBEDDING_MEMO_MAX_BYTES", str(16 * 1024 * 1024))),
+            ttl=float(os.getenv("EMBEDDING_MEMO_TTL", "600")),
+        )
 
         # Start connection logic in a background thread so app startup isn't blocked
         self._stop_event = threading.Event()
         self._bg_thread = threading.Thread(target=self._background_monitor, daemon=True)
         self._bg_thread.start()
+
+        # Listen for /cache/clear on other replicas so the local tier does not serve stale entries
+        if self.use_invalidation:
+            self._sub_thread = threading.Thread(target=self._invalidation_listener, daemon=True)
+            self._sub_thread.start()
         
         logger.info("ResponseCache initialized (Connection strictly in background)")
 
@@ -70,6 +174,7 @@ class ResponseCache:
                     client.ping()
                     self.redis_client = client
                     self.is_connected = True
+                    self._last_index_sync = 0.0  # Force a full index rebuild
                     logger.info("✓ Redis connected successfully (Background)")
                 except Exception as e:
                     logger.debug(f"Background Redis connection failed: {e}")
@@ -96,31 +201,190 @@ class ResponseCache:
                 except Exception:
                     self.embedding_available = False
 
+            # 3. Keep the vector index in sync with Redis (writes from other replicas, evictions)
+            if self.use_semantic and self.is_connected:
+                if time.time() - self._last_index_sync >= self.index_resync_interval:
+                    self._resync_index()
+                else:
+                    self.vector_index.purge_expired()
+
             # Wait before next check
             time.sleep(self.retry_delay)
 
+    def _invalidation_listener(self):
+        """Drop in-process state when another replica publishes a cache invalidation."""
+        pubsub = None
+        while not self._stop_event.is_set():
+            if not self.redis_client:
+                pubsub = None
+                time.sleep(self.retry_delay)
+                continue
+            try:
+                if pubsub is None:
+                    pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(INVALIDATION_CHANNEL)
+                message = pubsub.get_message(timeout=1.0)
+                if message and message.get("data") == b"clear":
+                    self.local_cache.clear()
+                    self.vector_index.clear()
+                    logger.info("Local cache tier invalidated (remote clear)")
+            except Exception as e:
+                logger.debug(f"Invalidation listener error: {e}")
+                pubsub = None
+                time.sleep(self.retry_delay)
+
+    def _aredis(self) -> aioredis.Redis:
+        """Pooled asyncio Redis client, created on first use inside the serving event loop."""
+        if self._async_redis is None:
+            pool = aioredis.ConnectionPool.from_url(
+                self.redis_url,
+                max_connections=self.redis_max_connections,
+                socket_timeout=1.0,
+            )
+            self._async_redis = aioredis.Redis(connection_pool=pool)
+        return self._async_redis
+
+    def _async_embedding_client(self) -> httpx.AsyncClient:
+        if self._async_embedding is None:
+            self._async_embedding = httpx.AsyncClient(timeout=2.0)
+        return self._async_embedding
+
     def _generate_key(self, prompt: str, max_tokens: int) -> str:
         content = f"{prompt}:{max_tokens}"
         return f"llama:cache:{hashlib.sha256(content.encode()).hexdigest()}"
     
-    def _get_embedding(self, text: str) -> Optional[List[float]]:
+    async def _get_embedding(self, text: str) -> Optional[np.ndarray]:
         # Fail fast if service not marked available
         if not self.embedding_available:
             return None
+
+        memo_key = hashlib.sha256(text.encode()).hexdigest()
+        embedding = self.embedding_memo.get(memo_key)
+        if embedding is not None:
+            return embedding
         
         try:
-            response = self.embedding_client.post(
+            # Prefer the raw float32 wire format; older services still answer JSON
+            response = await self._async_embedding_client().post(
                 f"{self.embedding_url}/embed",
                 json={"texts": [text]},
+                headers={"Accept": EMBED_ACCEPT},
                 timeout=2.0
             )
             if response.status_code == 200:
-                return response.json()["embeddings"][0]
+                embedding = parse_embed_response(response)[0]
+                self.embedding_memo.set(memo_key, embedding)
+                return embedding
         except Exception as e:
             logger.error(f"Embedding fetch failed: {e}")
         return None
 
-    def _search_similar(self, embedding: List[float], max_tokens: int, threshold: Optional[float] = None) -> Optional[tuple]:
+    def _resync_index(self):
+        """Rebuild the vector index from a full Redis scan (runs in the background thread)."""
+        client = self.redis_client
+        if not client:
+            return
+        started_at = time.time()
+        try:
+            removed = self.vector_index.sync(self._scan_entries(client), started_at)
+            self._last_index_sync = started_at
+            logger.info(
+                f"Vector index synced: {len(self.vector_index)} entries "
+                f"({removed} stale removed) in {time.time() - started_at:.2f}s"
+            )
+        except Exception as e:
+            logger.warning(f"Vector index sync failed: {e}")
+
+    def _scan_entries(self, client, batch_size: int = 500):
+        """Yield (key, embedding, max_tokens, ttl) for every cache entry that has an embedding."""
+        batch = []
+        for key in client.scan_iter(match="llama:cache:*", count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield from self._load_batch(client, batch)
+                batch = []
+        if batch:
+            yield from self._load_batch(client, batch)
+
+    def _load_batch(self, client, keys: list):
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, "emb", "emb_dtype", "emb_scale", "max_tokens")
+            pipe.ttl(key)
+        results = pipe.execute(raise_on_error=False)
+
+        legacy = []
+        for key, fields, ttl in zip(keys, results[0::2], results[1::2]):
+            ttl = ttl if isinstance(ttl, int) and ttl > 0 else None
+            if isinstance(fields, redis.ResponseError):
+                legacy.append((key, ttl))  # WRONGTYPE: v1 string entry
+                continue
+            if isinstance(fields, Exception) or not fields[0]:
+                continue
+            emb, dtype, scale, max_tokens = fields
+            try:
+                embedding = decode_embedding(emb, dtype.decode(), float(scale or 1.0))
+                yield self._key_str(key), embedding, int(max_tokens), ttl
+            except (KeyError, ValueError, AttributeError):
+                continue
+
+        if legacy:
+            raws = client.mget([key for key, _ in legacy])
+            for (key, ttl), raw in zip(legacy, raws):
+                data = self._decode_legacy(raw)
+                if data and data.get("embedding"):
+                    yield self._key_str(key), data["embedding"], data.get("max_tokens"), ttl
+
+    @staticmethod
+    def _key_str(key) -> str:
+        return key.decode() if isinstance(key, bytes) else key
+
+    @staticmethod
+    def _decode_legacy(raw) -> Optional[dict]:
+        """Parse a v1 JSON entry; returns None for plain-text or missing entries."""
+        if not raw:
+            return None
+        try:
+            data = json.loads(raw)
+        except (json.JSONDecodeError, UnicodeDecodeError, TypeError):
+            return None
+        return data if isinstance(data, dict) else None
+
+    async def _read_response(self, key) -> Optional[str]:
+        """Read the response text for a key in either entry format."""
+        try:
+            cached = await self._aredis().hget(key, "response")
+        except redis.ResponseError:
+            # v1 entry stored as a plain string
+            cached = await self._aredis().get(key)
+            if not cached:
+                return None
+            data = self._decode_legacy(cached)
+            if data is not None:
+                return data.get("response")
+            return cached.decode() if isinstance(cached, bytes) else cached
+        if cached is None:
+            return None
+        return cached.decode()
+
+    async def get_usage(self, prompt: str, max_tokens: int) -> dict:
+        """
+        Usage stored with the exact entry for ``prompt`` (see ``set``), or {}
+        for v1 entries, entries written without it, or when Redis is down.
+        """
+        if not self.is_connected or not self.redis_client:
+            return {}
+        try:
+            values = await self._aredis().hmget(self._generate_key(prompt, max_tokens), *USAGE_FIELDS)
+        except Exception:
+            return {}
+        usage = {name: value.decode() for name, value in zip(USAGE_FIELDS, values) if value is not None}
+        try:
+            return {name: value if name == "model" else int(value) for name, value in usage.items()}
+        except ValueError:
+            return {}
+
+    async def _search_similar(self, embedding: np.ndarray, max_tokens: int, threshold: Optional[float] = None) -> Optional[tuple]:
         if not self.is_connected or not self.redis_client:
             return None
         
@@ -128,78 +392,52 @@ class ResponseCache:
         min_score = threshold if threshold is not None else self.similarity_threshold
         
         try:
-            # Note: SCAN is slow for large DBs. 
-            best_score = 0.0
-            best_key = None
-            best_response = None
-            
-            # Using scan_iter is safer than keys()
-            for key in self.redis_client.scan_iter(match="llama:cache:*"):
-                try:
-                    raw = self.redis_client.get(key)
-                    if not raw: continue
-                    
-                    cached_data = json.loads(raw)
-                    if cached_data.get("max_tokens") != max_tokens: continue
-                    
-                    cached_emb = cached_data.get("embedding")
-                    if not cached_emb: continue
-                    
-                    score = self._cosine_similarity(embedding, cached_emb)
-                    if score > best_score:
-                        best_score = score
-                        best_key = key
-                        best_response = cached_data.get("response")
-                except (json.JSONDecodeError, TypeError):
-                    continue
-
-            if best_score >= min_score:
-                return (best_key, best_response, best_score)
+            match = self.vector_index.search(embedding, max_tokens)
+            if not match or match[1] < min_score:
+                return None
+
+            best_key, best_score = match
+            response = await self._read_response(best_key)
+            if response is None:
+                # Evicted or expired in Redis before the index noticed
+                self.vector_index.remove(best_key)
+                return None
+
+            return (best_key, response, best_score)
         except Exception as e:
             logger.error(f"Semantic search error: {e}")
         return None
 
-    def _cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
-        import math
-        try:
-            dot_product = sum(a * b for a, b in zip(vec1, vec2))
-            magnitude1 = math.sqrt(sum(a * a for a in vec1))
-            magnitude2 = math.sqrt(sum(b * b for b in vec2))
-            if magnitude1 == 0 or magnitude2 == 0: return 0.0
-            return dot_product / (magnitude1 * magnitude2)
-        except Exception:
-            return 0.0
-
-    def get(self, prompt: str, max_tokens: int, threshold: Optional[float] = None) -> Optional[str]:
+    async def get(self, prompt: str, max_tokens: int, threshold: Optional[float] = None) -> Optional[str]:
         """
         Non-blocking Get. Returns None immediately if Redis is down.
         """
-        # 1. Fail Fast Check
+        # 1. In-process tier (no network hop)
+        key = self._generate_key(prompt, max_tokens)
+        cached = self.local_cache.get(key)
+        if cached is not None:
+            LOCAL_CACHE_HITS.inc()
+            return cached
+        LOCAL_CACHE_MISSES.inc()
+
+        # 2. Fail Fast Check
         if not self.is_connected or not self.redis_client:
             # Do not log here to avoid spamming logs on every request when down
             return None
         
         try:
-            # 2. Exact Match
-            key = self._generate_key(prompt, max_tokens)
-            cached = self.redis_client.get(key)
+            # 3. Exact Match
+            cached = await self._read_response(key)
             
             if cached:
-                if isinstance(cached, bytes): cached = cached.decode()
-                # Handle JSON wrapper if present
-                if cached.startswith("{"):
-                    try:
-                        data = json.loads(cached)
-                        return data.get("response", cached)
-                    except:
-                        return cached
+                self.local_cache.set(key, cached)
                 return cached
             
-            # 3. Semantic Search (only if enabled and available)
+            # 4. Semantic Search (only if enabled and available)
             if self.use_semantic and self.embedding_available:
-                embedding = self._get_embedding(prompt)
-                if embedding:
-                    result = self._search_similar(embedding, max_tokens, threshold)
+                embedding = await self._get_embedding(prompt)
+                if embedding is not None:
+                    result = await self._search_similar(embedding, max_tokens, threshold)
                     if result:
                         logger.info(f"Cache HIT (semantic) score={result[2]:.2f}")
                         return result[1]
@@ -209,36 +447,53 @@ class ResponseCache:
             logger.error(f"Cache get error: {e}")
             return None
 
-    def set(self, prompt: str, max_tokens: int, response: str, ttl: int = 1800):
+    async def set(
+        self, prompt: str, max_tokens: int, response: str, ttl: int = 1800, usage: Optional[dict] = None
+    ):
         """
-        Non-blocking Set. Does nothing if Redis is down.
+        Non-blocking Set. Only the local tier is written if Redis is down.
+        ``usage`` (prompt token count, context window, ... of the model that
+        answered) is stored with the entry so the router can return it on hits.
         """
+        key = self._generate_key(prompt, max_tokens)
+        self.local_cache.set(key, response, ttl)
+
         if not self.is_connected or not self.redis_client:
             return
         
         try:
-            key = self._generate_key(prompt, max_tokens)
             
             # Try to get embedding, but don't fail operation if embedding service is down
             embedding = None
             if self.use_semantic and self.embedding_available:
-                embedding = self._get_embedding(prompt)
+                embedding = await self._get_embedding(prompt)
             
-            if embedding:
-                data = {
-                    "prompt": prompt, 
-                    "max_tokens": max_tokens, 
-                    "response": response, 
-                    "embedding": embedding
-                }
-                self.redis_client.setex(key, ttl, json.dumps(data))
-            else:
-                self.redis_client.setex(key, ttl, response)
+            entry = {
+                "v": CACHE_FORMAT_VERSION,
+                "prompt": prompt,
+                "max_tokens": max_tokens,
+                "response": response,
+            }
+            if usage:
+                entry.update(usage)
+            if embedding is not None:
+                buffer, scale = encode_embedding(embedding, self.embedding_dtype)
+                entry.update(emb=buffer, emb_dtype=self.embedding_dtype, emb_scale=scale)
+
+            # Replace atomically (an older v1 string entry may still hold the key)
+            async with self._aredis().pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.hset(key, mapping=entry)
+                pipe.expire(key, ttl)
+                await pipe.execute()
+
+            if embedding is not None:
+                self.vector_index.add(key, embedding, max_tokens, ttl)
                 
         except Exception as e:
             logger.error(f"Cache set error: {e}")
 
-    def stats(self) -> dict:
+    async def stats(self) -> dict:
         """
         Safe stats for Health Checks. 
         Returns 'degraded' instead of crashing if Redis is down.
@@ -247,34 +502,99 @@ class ResponseCache:
             return {
                 "status": "degraded", 
                 "detail": "Redis unavailable - Caching disabled",
+                "local": self.local_cache.stats(),
+                "embedding_memo": self.embedding_memo.stats(),
                 "threshold": self.similarity_threshold
             }
         
         try:
-            info = self.redis_client.info()
+            client = self._aredis()
+            info = await client.info()
             return {
                 "status": "healthy",
-                "keys": self.redis_client.dbsize(),
+                "keys": await client.dbsize(),
                 "memory": info.get("used_memory_human"),
                 "semantic_active": self.embedding_available,
+                "semantic_index": self.vector_index.stats(),
+                "local": self.local_cache.stats(),
+                "embedding_memo": self.embedding_memo.stats(),
                 "threshold": self.similarity_threshold
             }
         except Exception:
             return {"status": "degraded", "detail": "Connection Error", "threshold": self.similarity_threshold}
 
-    def clear(self) -> int:
+    async def clear(self) -> int:
         """Clear all cache keys."""
+        self.local_cache.clear()
         if not self.is_connected or not self.redis_client:
             return 0
         try:
-            keys = self.redis_client.keys("llama:cache:*")
+            self.vector_index.clear()
+            if self.use_invalidation:
+                await self._aredis().publish(INVALIDATION_CHANNEL, "clear")
+            keys = [key async for key in self._aredis().scan_iter(match="llama:cache:*", count=500)]
             if keys:
-                return self.redis_client.delete(*keys)
+                return await self._aredis().delete(*keys)
             return 0
         except Exception as e:
             logger.error(f"Cache clear error: {e}")
             return 0
 
+    async def acquire_lock(self, name: str, ttl: float) -> Optional[str]:
+        """
+        Try to take a cross-replica in-flight lock.
+
+        Returns an owner token when acquired, None when another replica holds
+        it. If Redis is down there is nothing to coordinate with, so an empty
+        token is returned and the caller proceeds as owner.
+        """
+        if not self.is_connected or not self.redis_client:
+            return ""
+        token = uuid.uuid4().hex
+        try:
+            lock_key = f"{LOCK_PREFIX}{hashlib.sha256(name.encode()).hexdigest()}"
+            if await self._aredis().set(lock_key, token, nx=True, px=int(ttl * 1000)):
+                return token
+            return None
+        except Exception as e:
+            logger.warning(f"Lock acquire error: {e}")
+            return ""
+
+    async def release_lock(self, name: str, token: Optional[str]):
+        """Release a lock taken with acquire_lock (no-op for empty tokens)."""
+        if not token or not self.redis_client:
+            return
+        try:
+            lock_key = f"{LOCK_PREFIX}{hashlib.sha256(name.encode()).hexdigest()}"
+            await self._aredis().eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except Exception as e:
+            logger.warning(f"Lock release error: {e}")
+
+    async def wait_for(self, name: str, prompt: str, max_tokens: int, timeout: float, poll_interval: float = 0.5) -> Optional[str]:
+        """
+        Poll for the exact-match entry another replica is generating under lock ``name``.
+        Returns None once the lock is gone without a result, or on timeout.
+        """
+        key = self._generate_key(prompt, max_tokens)
+        lock_key = f"{LOCK_PREFIX}{hashlib.sha256(name.encode()).hexdigest()}"
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.is_connected or not self.redis_client:
+                return None
+            try:
+                cached = await self._read_response(key)
+                if cached:
+                    self.local_cache.set(key, cached)
+                    return cached
+                if not await self._aredis().exists(lock_key):
+                    # Owner finished; re-read in case it wrote just before releasing
+                    return await self._read_response(key)
+            except Exception as e:
+                logger.warning(f"Lock wait error: {e}")
+                return None
+            await asyncio.sleep(poll_interval)
+        return None
+
     def update_threshold(self, new_threshold: float):
         """Update similarity threshold dynamically."""
         if 0.0 <= new_threshold <= 1.0:
@@ -284,8 +604,19 @@ class ResponseCache:
             return True
         return False
 
+    async def aclose(self):
+        """Close the asyncio clients (call from the app's shutdown hook)."""
+        if self._async_redis is not None:
+            await self._async_redis.aclose()
+            self._async_redis = None
+        if self._async_embedding is not None:
+            await self._async_embedding.aclose()
+            self._async_embedding = None
+
     def close(self):
         """Cleanup thread on shutdown"""
         self._stop_event.set()
         if self._bg_thread.is_alive():
-            self._bg_thread.join(timeout=1.0)
\ No newline at end of file
+            self._bg_thread.join(timeout=1.0)
+        if self.use_invalidation and self._sub_thread.is_alive():
+            self._sub_thread.join(timeout=1.0)
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""
+Bounded executor for blocking llama.cpp generation.
+
+Generation runs on a small dedicated thread pool instead of the event loop
+or Starlette's shared threadpool, behind an explicit admission limit: when
+``max_workers + max_queue`` generations are already pending, new work is
+rejected with ``InferenceQueueFull`` rather than piling up. Cache lookups
+and health checks stay on the event loop and never wait behind generation.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+from metrics import INFERENCE_ACTIVE, INFERENCE_QUEUE_DEPTH, INFERENCE_QUEUE_WAIT, INFERENCE_REJECTED
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class InferenceQueueFull(Exception):
+    """Raised when the executor already holds its maximum of pending generations."""
+
+
+class _Relay:
+    """
+    Async iterator over the items a worker puts on ``items``. Unlike an async
+    generator, ``aclose()`` takes effect before the first ``__anext__``, so a
+    response dropped before it starts streaming still stops the worker.
+    """
+
+    def __init__(self, items: asyncio.Queue, cancelled: threading.Event):
+        self._items = items
+        self._cancelled = cancelled
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._cancelled.is_set():
+            raise StopAsyncIteration
+        try:
+            item = await self._items.get()
+        except BaseException:
+            self._cancelled.set()
+            raise
+        if item is _DONE:
+            self._cancelled.set()
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            self._cancelled.set()
+            raise item
+        return item
+
+    async def aclose(self):
+        self._cancelled.set()
+
+    def __del__(self):
+        # Last resort if the consumer never iterated or closed the relay
+        self._cancelled.set()
+
+
+class InferenceExecutor:
+    def __init__(self, max_workers: int = 2, max_queue: int = 32):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        # Touched only from the event loop thread
+        self._pending = 0
+        self._active = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def queued(self) -> int:
+        return self._pending - self._active
+
+    def _admit(self):
+        if self._pending >= self.max_workers + self.max_queue:
+            INFERENCE_REJECTED.inc()
+            raise InferenceQueueFull(
+                f"Inference queue full ({self._pending} pending, max {self.max_workers + self.max_queue})"
+            )
+        self._pending += 1
+        INFERENCE_QUEUE_DEPTH.set(self.queued)
+
+    def _started(self, enqueued_at: float):
+        # Called on the loop thread when a worker picks the job up
+        self._active += 1
+        INFERENCE_ACTIVE.set(self._active)
+        INFERENCE_QUEUE_DEPTH.set(self.queued)
+        INFERENCE_QUEUE_WAIT.observe(time.monotonic() - enqueued_at)
+
+    def _finished(self, started: bool):
+        self._pending -= 1
+        if started:
+            self._active -= 1
+        INFERENCE_ACTIVE.set(self._active)
+        INFERENCE_QUEUE_DEPTH.set(self.queued)
+
+    async def run(self, fn: Callable[[], T]) -> T:
+        """Run blocking ``fn`` on an inference thread and return its result."""
+        self._admit()
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.monotonic()
+        started = threading.Event()
+
+        def job():
+            started.set()
+            loop.call_soon_threadsafe(self._started, enqueued_at)
+            return fn()
+
+        future = self._pool.submit(job)
+        # Account on completion of the thread, not of the awaiting request
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._finished, started.is_set()))
+        return await asyncio.wrap_future(future)
+
+    async def stream(self, make_iterator: Callable[[], Iterator[T]]) -> AsyncIterator[T]:
+        """
+        Run a blocking iterator on one inference thread and relay its items.
+
+        ``make_iterator`` is called on the worker; exceptions it raises (e.g.
+        validation errors) propagate from this call, before any item is
+        relayed. Closing the returned async iterator (client disconnect),
+        even before its first item, stops the worker and closes the
+        underlying iterator.
+        """
+        self._admit()
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.monotonic()
+        items: asyncio.Queue = asyncio.Queue()
+        opened: asyncio.Future = loop.create_future()
+        cancelled = threading.Event()
+        started = threading.Event()
+
+        def put(item):
+            loop.call_soon_threadsafe(items.put_nowait, item)
+
+        def resolve(error=None):
+            def _set():
+                if opened.done():
+                    return
+                if error is None:
+                    opened.set_result(None)
+                else:
+                    opened.set_exception(error)
+            loop.call_soon_threadsafe(_set)
+
+        def job():
+            started.set()
+            loop.call_soon_threadsafe(self._started, enqueued_at)
+            try:
+                iterator = make_iterator()
+            except BaseException as e:
+                resolve(e)
+                return
+            resolve()
+            try:
+                for item in iterator:
+                    if cancelled.is_set():
+                        break
+                    put(item)
+                put(_DONE)
+            except BaseException as e:
+                put(e)
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+
+        future = self._pool.submit(job)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._finished, started.is_set()))
+        try:
+            await opened
+        except BaseException:
+            cancelled.set()
+            raise
+
+        return _Relay(items, cancelled)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queued": self.queued,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
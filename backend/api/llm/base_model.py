@@ -1,10 +1,23 @@
 import logging
 import os
 import threading
-from typing import List, Optional
+import time
+from typing import Iterator, List, Optional
 
+import numpy as np
 from llama_cpp import Llama
 
+from .parallel import ParallelDecoder
+from .session_cache import SessionStore
+from metrics import (
+    COMPLETION_TOKENS,
+    PREFIX_CACHE_RESTORES,
+    PROMPT_TOKENS,
+    PROMPT_TOKENS_EVALUATED,
+    PROMPT_TOKENS_REUSED,
+    TOKENS_GENERATED,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -13,7 +26,11 @@ class BaseLlamaModel:
     Thin wrapper around llama_cpp.Llama with:
       - common init params
       - basic validation
-      - single-inference lock
+      - single-inference lock, or continuous batching over n_parallel
+        sequence slots (LLM_N_PARALLEL > 1, see llm/parallel.py)
+      - optional token streaming
+      - KV-state reuse of a constant prompt prefix (system prompt)
+      - per-session KV state for multi-turn conversations
     """
 
     def __init__(
@@ -28,6 +45,7 @@ class BaseLlamaModel:
         use_mmap: bool = True,
         n_batch: Optional[int] = None,  # Batch size for prompt processing
         use_mlock: bool = False,  # Don't lock memory (let OS manage)
+        n_parallel: Optional[int] = None,  # Concurrent sequences (1 = serialized)
     ):
         self.name = name
         self.model_path = model_path
@@ -40,19 +58,39 @@ class BaseLlamaModel:
         # Allow n_batch to be configured via env var for CPU optimization
         self.n_batch = n_batch or int(os.getenv("LLM_N_BATCH", "512"))
         self.use_mlock = use_mlock
+        self.n_parallel = n_parallel or int(os.getenv("LLM_N_PARALLEL", "1"))
+        self.decoder: Optional[ParallelDecoder] = None
+        if self.n_parallel > 1 and self.lora_paths and not ParallelDecoder.supports_lora():
+            # Slots would silently decode with the base weights only
+            logger.warning(
+                f"[{self.name}] llama_cpp can't apply LoRA adapters to a parallel context; "
+                f"falling back to LLM_N_PARALLEL=1"
+            )
+            self.n_parallel = 1
 
         self._inference_lock = threading.Lock()
 
+        # Saved KV state of the constant prompt prefix (see set_prefix)
+        self.prefix_cache = os.getenv("PREFIX_CACHE", "true").lower() == "true"
+        self._prefix_text: Optional[str] = None
+        self._prefix_tokens: Optional[np.ndarray] = None
+        self._prefix_state = None
+
+        # session id -> KV state after that conversation's last turn (serialized mode only)
+        self.sessions = SessionStore.from_env() if self.n_parallel <= 1 else None
+
         logger.info(
             f"[{self.name}] Loading model from {self.model_path} "
             f"(ctx={self.n_ctx}, gpu_layers={self.n_gpu_layers}, "
-            f"threads={self.n_threads}, batch={self.n_batch}, lora={self.lora_paths})"
+            f"threads={self.n_threads}, batch={self.n_batch}, parallel={self.n_parallel}, "
+            f"lora={self.lora_paths})"
         )
 
         try:
             self.model = Llama(
                 model_path=self.model_path,
-                n_ctx=self.n_ctx,
+                # In parallel mode this context only serves tokenization; slots get their own
+                n_ctx=self.n_ctx if self.n_parallel <= 1 else 256,
                 n_gpu_layers=self.n_gpu_layers,
                 n_threads=self.n_threads,
                 n_batch=self.n_batch,
@@ -70,29 +108,202 @@ class BaseLlamaModel:
             logger.error(f"[{self.name}] Failed to load model: {e}")
             raise
 
-    def infer(self, prompt: str, max_tokens: int = 300) -> str:
+        if self.n_parallel > 1:
+            self.decoder = ParallelDecoder(
+                self.name,
+                self.model,
+                n_parallel=self.n_parallel,
+                n_ctx_per_slot=self.n_ctx,
+                n_batch=self.n_batch,
+                n_threads=self.n_threads,
+                sampling=self.SAMPLING_PARAMS,
+                lora_paths=self.lora_paths,
+                lora_scaling=self.lora_scaling,
+            )
+
+    # Sampling settings shared by blocking and streaming generation
+    SAMPLING_PARAMS = dict(
+        temperature=0.7,  # Balanced creativity
+        top_p=0.9,  # Nucleus sampling
+        top_k=40,  # Top-K sampling
+        repeat_penalty=1.1,  # Reduce repetition
+        stop=["<|im_end|>", "<|im_start|>", "User:", "\n\n\n"],  # Qwen chat template stop tokens
+        echo=False,  # Don't echo prompt
+    )
+
+    def close(self):
+        """Free the llama.cpp context and weights (the registry calls this on eviction)."""
+        if self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
+        self._prefix_state = None
+        self.sessions = None
+        close = getattr(self.model, "close", None)
+        if close is not None:
+            close()
+        logger.info(f"[{self.name}] Model unloaded")
+
+    def _validate(self, prompt: str, max_tokens: int):
         if not prompt or not prompt.strip():
             raise ValueError("Prompt cannot be empty")
 
         if max_tokens < 1 or max_tokens > 2048:
             raise ValueError("max_tokens must be between 1 and 2048")
 
+    def set_prefix(self, text: str):
+        """
+        Evaluate ``text`` once and keep its KV state so prompts starting with
+        it only need their suffix evaluated. No-op if already primed with it.
+        """
+        if not self.prefix_cache or text == self._prefix_text:
+            return
+        if self.decoder is not None:
+            self.decoder.set_prefix(self.model.tokenize(text.encode("utf-8"), add_bos=True, special=True))
+            self._prefix_text = text
+            return
+        with self._inference_lock:
+            if text == self._prefix_text:
+                return
+            started = time.time()
+            tokens = self.model.tokenize(text.encode("utf-8"), add_bos=True, special=True)
+            self.model.reset()
+            self.model.eval(tokens)
+            self._prefix_state = self.model.save_state()
+            self._prefix_tokens = np.asarray(tokens, dtype=np.intc)
+            self._prefix_text = text
+            logger.info(
+                f"[{self.name}] Cached KV state for {len(tokens)}-token prompt prefix "
+                f"in {time.time() - started:.2f}s"
+            )
+
+    @staticmethod
+    def _common_prefix(cached, tokens) -> int:
+        """Tokens llama.cpp can keep from ``cached`` (same rule as Llama.generate)."""
+        reused = 0
+        for a, b in zip(cached, tokens[:-1]):
+            if a != b:
+                break
+            reused += 1
+        return reused
+
+    def _prepare_context(self, prompt: str, session_id: Optional[str] = None) -> int:
+        """
+        Load the KV state that shares the longest prefix with ``prompt`` before
+        generating (call with the inference lock held): the session's last
+        turn, the primed system prefix, or whatever the context already holds.
+        llama.cpp then only evaluates the tokens after the shared prefix.
+        Returns the prompt length in tokens.
+        """
+        tokens = self.model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        if self._prefix_state is None and not (session_id and self.sessions):
+            return len(tokens)
+        current = self.model.input_ids[: self.model.n_tokens]
+        best = self._common_prefix(current, tokens)
+
+        session = self.sessions.get(session_id) if session_id and self.sessions else None
+        if session is not None and self._common_prefix(session[0], tokens) > best:
+            self.model.load_state(session[1])
+            best = self._common_prefix(session[0], tokens)
+        elif self._prefix_state is not None and self._common_prefix(self._prefix_tokens, tokens) > best:
+            # KV cache holds another prompt's prefix (e.g. a different template) - restore
+            self.model.load_state(self._prefix_state)
+            best = self._common_prefix(self._prefix_tokens, tokens)
+            PREFIX_CACHE_RESTORES.inc()
+
+        PROMPT_TOKENS_REUSED.inc(best)
+        PROMPT_TOKENS_EVALUATED.inc(len(tokens) - best)
+        return len(tokens)
+
+    def _record_usage(self, prompt_tokens: int, completion_tokens: int):
+        PROMPT_TOKENS.labels(model=self.name).inc(prompt_tokens)
+        COMPLETION_TOKENS.labels(model=self.name).inc(completion_tokens)
+        TOKENS_GENERATED.inc(completion_tokens)
+
+    def _save_session(self, session_id: Optional[str]):
+        """Keep the context after a completed turn for the session's next turn."""
+        if not session_id or not self.sessions:
+            return
+        try:
+            tokens = np.array(self.model.input_ids[: self.model.n_tokens], dtype=np.intc)
+            self.sessions.put(session_id, tokens, self.model.save_state())
+        except Exception as e:
+            logger.warning(f"[{self.name}] Session state save failed: {e}")
+
+    def infer(self, prompt: str, max_tokens: int = 300, session_id: Optional[str] = None) -> str:
+        self._validate(prompt, max_tokens)
+
+        if self.decoder is not None:
+            logger.info(f"[{self.name}] Generating response (max_tokens={max_tokens}, parallel)")
+            text = "".join(self.decoder.generate(prompt, max_tokens)).strip()
+            logger.info(f"[{self.name}] Generated {len(text)} chars")
+            return text
+
         with self._inference_lock:
             try:
+                prompt_tokens = self._prepare_context(prompt, session_id)
                 logger.info(f"[{self.name}] Generating response (max_tokens={max_tokens})")
-                res = self.model(
-                    prompt,
-                    max_tokens=max_tokens,
-                    temperature=0.7,  # Balanced creativity
-                    top_p=0.9,  # Nucleus sampling
-                    top_k=40,  # Top-K sampling
-                    repeat_penalty=1.1,  # Reduce repetition
-                    stop=["<|im_end|>", "<|im_start|>", "User:", "\n\n\n"],  # Qwen chat template stop tokens
-                    echo=False,  # Don't echo prompt
-                )
+                res = self.model(prompt, max_tokens=max_tokens, **self.SAMPLING_PARAMS)
                 text = res["choices"][0]["text"].strip()
-                logger.info(f"[{self.name}] Generated {len(text)} chars")
+                self._save_session(session_id)
+                usage = res.get("usage") or {}
+                completion_tokens = usage.get("completion_tokens", 0)
+                self._record_usage(usage.get("prompt_tokens", prompt_tokens), completion_tokens)
+                logger.info(f"[{self.name}] Generated {len(text)} chars ({completion_tokens} tokens)")
                 return text
             except Exception as e:
                 logger.error(f"[{self.name}] Inference failed: {e}")
                 raise RuntimeError(f"Model inference failed: {e}")
+
+    def infer_stream(self, prompt: str, max_tokens: int = 300, session_id: Optional[str] = None) -> Iterator[str]:
+        """
+        Stream generated text pieces as llama.cpp produces them.
+        Validation happens eagerly; the inference lock is held until the
+        returned iterator is exhausted or closed.
+        """
+        self._validate(prompt, max_tokens)
+        if self.decoder is not None:
+            # Queued now, so a stream dropped before iteration still frees its slot
+            logger.info(f"[{self.name}] Streaming response (max_tokens={max_tokens}, parallel)")
+            return self._stream_parallel(self.decoder.generate(prompt, max_tokens))
+        return self._stream(prompt, max_tokens, session_id)
+
+    def _stream_parallel(self, pieces) -> Iterator[str]:
+        emitted = 0
+        try:
+            for piece in pieces:
+                if not emitted:
+                    piece = piece.lstrip()
+                if piece:
+                    emitted += len(piece)
+                    yield piece
+        finally:
+            pieces.close()
+        logger.info(f"[{self.name}] Streamed {emitted} chars")
+
+    def _stream(self, prompt: str, max_tokens: int, session_id: Optional[str] = None) -> Iterator[str]:
+        with self._inference_lock:
+            logger.info(f"[{self.name}] Streaming response (max_tokens={max_tokens})")
+            emitted = 0
+            # Streamed chunks carry no usage; llama.cpp emits one per sampled token
+            prompt_tokens = completion_tokens = 0
+            try:
+                prompt_tokens = self._prepare_context(prompt, session_id)
+                for chunk in self.model(prompt, max_tokens=max_tokens, stream=True, **self.SAMPLING_PARAMS):
+                    completion_tokens += 1
+                    piece = chunk["choices"][0]["text"]
+                    if not emitted:
+                        # Match infer(): no leading whitespace
+                        piece = piece.lstrip()
+                    if piece:
+                        emitted += len(piece)
+                        yield piece
+            except GeneratorExit:
+                logger.info(f"[{self.name}] Stream closed by client after {emitted} chars")
+                raise
+            except Exception as e:
+                logger.error(f"[{self.name}] Streaming inference failed: {e}")
+                raise RuntimeError(f"Model inference failed: {e}")
+            finally:
+                self._record_usage(prompt_tokens, completion_tokens)
+            self._save_session(session_id)
+            logger.info(f"[{self.name}] Streamed {emitted} chars")
@@ -1,6 +1,6 @@
 import logging
 import os
-from typing import Optional
+from typing import List, Optional
 
 from .base_model import BaseLlamaModel
 
@@ -12,6 +12,18 @@ class LlamaModel(BaseLlamaModel):
     LLaMA 2 7B Chat (no LoRA for now).
     """
 
+    @staticmethod
+    def default_model_path() -> str:
+        return os.getenv("LLAMA_MODEL_PATH", "/models/llama/llama-2-7b-chat.Q4_K_M.gguf")
+
+    @staticmethod
+    def default_n_ctx() -> int:
+        return int(os.getenv("LLAMA_N_CTX", "2048"))
+
+    @classmethod
+    def weight_files(cls) -> List[str]:
+        return [cls.default_model_path()]
+
     def __init__(
         self,
         gpu: bool,
@@ -19,11 +31,9 @@ class LlamaModel(BaseLlamaModel):
         n_gpu_layers: Optional[int] = None,
         n_threads: Optional[int] = None,
     ):
-        model_path = os.getenv(
-            "LLAMA_MODEL_PATH", "/models/llama/llama-2-7b-chat.Q4_K_M.gguf"
-        )
+        model_path = self.default_model_path()
 
-        ctx = n_ctx or int(os.getenv("LLAMA_N_CTX", "2048"))
+        ctx = n_ctx or self.default_n_ctx()
         threads = n_threads or int(os.getenv("LLM_N_THREADS", "8"))
 
         if gpu:
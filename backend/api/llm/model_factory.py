@@ -1,49 +1,314 @@
+"""
+Model registry: which llama.cpp instances are resident in this pod.
+
+Instances load on a background thread (one load per model at a time), so a
+request for a model that is not resident fails fast with ``ModelNotReady``
+instead of blocking a worker for minutes. Resident models are counted
+against MODEL_MEMORY_BUDGET_GB by the size of their weight files; before a
+load, idle models (no leased request) are unloaded in LRU order until the
+new one fits.
+"""
 import logging
-from typing import Dict, Optional
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from llama_cpp import Llama
 
 from .qwen_model import QwenModel
 from .llama_model import LlamaModel
+from metrics import MODEL_EVICTIONS, MODEL_LOAD_DURATION, MODEL_LOADED, MODEL_NOT_READY, MODEL_RESIDENT_BYTES
 
 logger = logging.getLogger(__name__)
 
-# model_name -> {"gpu": instance or None, "cpu": instance or None}
-_models: Dict[str, Dict[str, Optional[object]]] = {
-    "qwen": {"gpu": None, "cpu": None},
-    "llama": {"gpu": None, "cpu": None},
-}
+_model_classes = {"qwen": QwenModel, "llama": LlamaModel}
+
+Key = Tuple[str, str]  # (model_name, "gpu" | "cpu")
+
+
+class ModelNotReady(Exception):
+    """The model is not resident yet; retry after ``retry_after`` seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Entry:
+    def __init__(self, key: Key, size: int):
+        self.key = key
+        self.label = f"{key[0]}-{key[1]}"
+        self.size = size
+        self.instance = None
+        self.leases = 0
+        self.loading = False
+        self.error: Optional[Exception] = None
+        self.failed_at = 0.0
+        self.ready = threading.Event()
+
+    @property
+    def state(self) -> str:
+        if self.instance is not None:
+            return "loaded"
+        if self.loading:
+            return "loading"
+        return "failed" if self.error is not None else "unloaded"
+
+
+class ModelRegistry:
+    def __init__(self, budget_bytes: int = 0, retry_after: int = 30, load_wait: float = 0.0, overhead: float = 0.15):
+        self.budget_bytes = budget_bytes  # 0 = unlimited
+        self.retry_after = retry_after
+        self.load_wait = load_wait
+        self.overhead = overhead
+        self._lock = threading.Lock()
+        # Signalled when a lease is returned (a model may have become evictable)
+        self._released = threading.Condition(self._lock)
+        self._entries: Dict[Key, _Entry] = {}
+        # Resident entries, least recently used first
+        self._lru: "OrderedDict[Key, _Entry]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "ModelRegistry":
+        return cls(
+            budget_bytes=int(float(os.getenv("MODEL_MEMORY_BUDGET_GB", "0")) * 1024 ** 3),
+            retry_after=int(os.getenv("MODEL_LOAD_RETRY_AFTER", "30")),
+            load_wait=float(os.getenv("MODEL_LOAD_WAIT", "0")),
+            overhead=float(os.getenv("MODEL_MEMORY_OVERHEAD", "0.15")),
+        )
+
+    # ----------------- lookup -----------------
+
+    @staticmethod
+    def _key(model_name: str, use_gpu: bool) -> Key:
+        name = model_name.lower()
+        if name not in _model_classes:
+            raise ValueError(f"Unknown model_name: {model_name}")
+        return name, "gpu" if use_gpu else "cpu"
+
+    def _estimate(self, name: str) -> int:
+        """Weights on disk plus a margin for the KV cache and scratch buffers."""
+        size = 0
+        for path in _model_classes[name].weight_files():
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return int(size * (1 + self.overhead))
+
+    def _entry(self, key: Key) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(key, self._estimate(key[0]))
+        return entry
+
+    def resident(self, model_name: str) -> Optional[object]:
+        """Any loaded instance of model_name (gpu or cpu), without a lease."""
+        name = model_name.lower()
+        with self._lock:
+            for entry in self._lru.values():
+                if entry.key[0] == name:
+                    return entry.instance
+        return None
+
+    # ----------------- leases -----------------
+
+    def acquire(self, model_name: str, use_gpu: bool, wait: Optional[float] = None):
+        """
+        Lease a resident instance (release it with ``release``); a leased model
+        is never evicted. Starts a background load if needed and waits up to
+        ``wait`` seconds (default MODEL_LOAD_WAIT) before raising ModelNotReady.
+        """
+        key = self._key(model_name, use_gpu)
+        deadline = time.monotonic() + (self.load_wait if wait is None else wait)
+        while True:
+            with self._lock:
+                entry = self._entry(key)
+                if entry.instance is not None:
+                    entry.leases += 1
+                    self._lru.move_to_end(key)
+                    return entry.instance
+                self._start_load(entry)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not entry.ready.wait(remaining) or entry.error is not None:
+                MODEL_NOT_READY.labels(model=entry.label).inc()
+                reason = f"failed to load ({entry.error})" if entry.error is not None else "loading"
+                raise ModelNotReady(f"Model {entry.label} is {reason}", self.retry_after)
+
+    def release(self, instance):
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.instance is instance:
+                    entry.leases -= 1
+                    break
+            self._released.notify_all()
 
+    @contextmanager
+    def lease(self, model_name: str, use_gpu: bool) -> Iterator[object]:
+        instance = self.acquire(model_name, use_gpu)
+        try:
+            yield instance
+        finally:
+            self.release(instance)
 
-def _preload_qwen_gpu():
-    try:
-        logger.info("Preloading Qwen GPU model at startup...")
-        _models["qwen"]["gpu"] = QwenModel(gpu=True)
-        logger.info("Qwen GPU model loaded")
-    except Exception as e:
-        logger.error(f"Failed to preload Qwen GPU model: {e}")
+    def ensure(self, model_name: str, use_gpu: bool):
+        """Non-blocking readiness check: start loading if needed, raise ModelNotReady unless resident."""
+        self.release(self.acquire(model_name, use_gpu, wait=0))
 
+    def preload(self, model_name: str, use_gpu: bool):
+        with self._lock:
+            self._start_load(self._entry(self._key(model_name, use_gpu)))
 
-# Preload only Qwen GPU at import time
-_preload_qwen_gpu()
+    # ----------------- loading / eviction -----------------
 
+    def _start_load(self, entry: _Entry):
+        """Called with the lock held; at most one loader thread per model."""
+        if entry.loading or entry.instance is not None:
+            return
+        if entry.error is not None and time.monotonic() - entry.failed_at < self.retry_after:
+            return  # Back off after a failed load instead of retrying on every request
+        entry.loading = True
+        entry.error = None
+        entry.ready.clear()
+        threading.Thread(target=self._load, args=(entry,), name=f"load-{entry.label}", daemon=True).start()
 
-def get_model(model_name: str = "qwen", use_gpu: bool = True):
+    def _load(self, entry: _Entry):
+        name, mode = entry.key
+        started = time.monotonic()
+        try:
+            self._make_room(entry)
+            logger.info(f"Loading {name.upper()} ({mode}) model...")
+            instance = _model_classes[name](gpu=mode == "gpu")
+        except Exception as e:
+            logger.error(f"Failed to load {name.upper()} ({mode}) model: {e}")
+            with self._lock:
+                entry.error = e
+                entry.failed_at = time.monotonic()
+        else:
+            MODEL_LOAD_DURATION.labels(model=entry.label).observe(time.monotonic() - started)
+            MODEL_LOADED.labels(model=entry.label).set(1)
+            logger.info(f"{name.upper()} ({mode}) model loaded in {time.monotonic() - started:.1f}s")
+            with self._lock:
+                entry.instance = instance
+                self._lru[entry.key] = entry
+        finally:
+            with self._lock:
+                entry.loading = False
+                self._update_resident_bytes()
+            entry.ready.set()
+
+    def _committed_bytes(self, exclude: _Entry) -> int:
+        return sum(e.size for e in self._entries.values() if e is not exclude and (e.instance is not None or e.loading))
+
+    def _update_resident_bytes(self):
+        MODEL_RESIDENT_BYTES.set(sum(e.size for e in self._entries.values() if e.instance is not None or e.loading))
+
+    def _make_room(self, entry: _Entry):
+        """Unload idle models (LRU first) until ``entry`` fits the budget; waits for leases if needed."""
+        if not self.budget_bytes:
+            return
+        while True:
+            with self._lock:
+                if self._committed_bytes(entry) + entry.size <= self.budget_bytes:
+                    return
+                victim = next((e for e in self._lru.values() if e.leases == 0), None)
+                if victim is None:
+                    if not any(e.instance is not None for e in self._lru.values()):
+                        # Nothing left to evict: a model bigger than the budget still has to be servable
+                        logger.warning(
+                            f"{entry.label} ({entry.size / 1024 ** 3:.1f} GiB) exceeds "
+                            f"MODEL_MEMORY_BUDGET_GB ({self.budget_bytes / 1024 ** 3:.1f} GiB); loading anyway"
+                        )
+                        return
+                    # Every resident model is serving requests - wait for one to go idle
+                    self._released.wait(timeout=5)
+                    continue
+                del self._lru[victim.key]
+                instance, victim.instance = victim.instance, None
+                self._update_resident_bytes()
+            logger.info(f"Evicting idle model {victim.label} to load {entry.label}")
+            MODEL_EVICTIONS.labels(model=victim.label).inc()
+            MODEL_LOADED.labels(model=victim.label).set(0)
+            instance.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_gb": round(self.budget_bytes / 1024 ** 3, 2),
+                "models": {
+                    entry.label: {
+                        "state": entry.state,
+                        "size_gb": round(entry.size / 1024 ** 3, 2),
+                        "leases": entry.leases,
+                    }
+                    for entry in self._entries.values()
+                },
+            }
+
+
+registry = ModelRegistry.from_env()
+
+# model_name -> vocab-only Llama, for tokenizing without leasing a full instance
+_tokenizers: Dict[str, Llama] = {}
+_tokenizer_lock = threading.Lock()
+
+
+def _preload():
+    # Default keeps the old behaviour: Qwen GPU starts loading at startup (now in the background)
+    for spec in os.getenv("MODEL_PRELOAD", "qwen:gpu").split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        name, _, mode = spec.partition(":")
+        try:
+            logger.info(f"Preloading {name.upper()} ({mode or 'gpu'}) model in the background...")
+            registry.preload(name, mode != "cpu")
+        except ValueError as e:
+            logger.error(f"Ignoring MODEL_PRELOAD entry {spec!r}: {e}")
+
+
+_preload()
+
+
+def get_model(model_name: str = "qwen", use_gpu: bool = True, wait: float = 600.0):
+    """
+    Returns a loaded model instance, waiting up to ``wait`` seconds for it
+    to load. The instance is not leased and may be evicted later; request
+    paths should use ``registry.lease`` instead.
+    """
+    instance = registry.acquire(model_name, use_gpu, wait=wait)
+    registry.release(instance)
+    return instance
+
+
+def get_tokenizer(model_name: str = "qwen") -> Llama:
     """
-    Returns a cached model instance (lazy-load when needed).
-    model_name: "qwen" or "llama"
-    use_gpu: True -> GPU instance, False -> CPU instance
+    Returns a Llama usable for tokenize()/detokenize() of model_name. Only
+    the vocabulary is loaded (cheap, cached), so it never depends on which
+    full instances are resident.
     """
     name = model_name.lower()
-    if name not in _models:
+    if name not in _model_classes:
         raise ValueError(f"Unknown model_name: {model_name}")
 
-    mode = "gpu" if use_gpu else "cpu"
+    with _tokenizer_lock:
+        if name not in _tokenizers:
+            path = _model_classes[name].default_model_path()
+            logger.info(f"Loading {name.upper()} vocabulary from {path}")
+            _tokenizers[name] = Llama(model_path=path, vocab_only=True, verbose=False)
+        return _tokenizers[name]
+
 
-    if _models[name][mode] is None:
-        logger.info(f"Lazy-loading {name.upper()} ({mode}) model...")
-        if name == "qwen":
-            _models[name][mode] = QwenModel(gpu=use_gpu)
-        elif name == "llama":
-            _models[name][mode] = LlamaModel(gpu=use_gpu)
-        logger.info(f"{name.upper()} ({mode}) model loaded")
+def get_context_window(model_name: str = "qwen") -> int:
+    """n_ctx of model_name (of a loaded instance if any, else the configured default)"""
+    name = model_name.lower()
+    if name not in _model_classes:
+        raise ValueError(f"Unknown model_name: {model_name}")
 
-    return _models[name][mode]
+    instance = registry.resident(name)
+    if instance is not None:
+        return instance.n_ctx
+    return _model_classes[name].default_n_ctx()
@@ -0,0 +1,468 @@
+"""
+Continuous-batching decoder on top of llama.cpp's sequence API.
+
+One llama.cpp context with ``n_parallel`` sequence slots shares the model
+weights of an already-loaded ``Llama``. A scheduler thread owns the context:
+every step it packs the next prompt chunk of newly admitted requests and
+the last sampled token of every generating request into a single batch,
+runs one ``llama_decode`` and samples each slot independently. Requests
+join and leave between steps, so a long answer no longer blocks the pod.
+"""
+import codecs
+import logging
+import queue
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import llama_cpp
+
+from metrics import (
+    COMPLETION_TOKENS,
+    LLM_DECODE_BATCH_TOKENS,
+    LLM_SLOT_OCCUPIED,
+    LLM_SLOTS_BUSY,
+    LLM_WAITING_REQUESTS,
+    PROMPT_TOKENS,
+    PROMPT_TOKENS_EVALUATED,
+    PROMPT_TOKENS_REUSED,
+    TOKENS_GENERATED,
+)
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _llama_fn(*names):
+    """First llama_cpp binding that exists (names moved between releases)."""
+    for name in names:
+        fn = getattr(llama_cpp, name, None)
+        if fn is not None:
+            return fn
+    raise AttributeError(f"llama_cpp has none of {names}")
+
+
+class _Request:
+    def __init__(self, tokens: List[int], max_tokens: int, sampling: dict):
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.temperature = sampling.get("temperature", 0.7)
+        self.top_p = sampling.get("top_p", 0.9)
+        self.top_k = sampling.get("top_k", 40)
+        self.repeat_penalty = sampling.get("repeat_penalty", 1.1)
+        self.stop = [s for s in sampling.get("stop", []) if s]
+        self.out: "queue.Queue" = queue.Queue()
+        self.cancelled = threading.Event()
+
+
+class _Stream:
+    """
+    Iterator over one request's text pieces. ``close()`` (or dropping the
+    stream) cancels the request whether or not iteration ever started.
+    """
+
+    def __init__(self, request: _Request, wakeup: threading.Event):
+        self.request = request
+        self._wakeup = wakeup
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self.request.cancelled.is_set():
+            raise StopIteration
+        item = self.request.out.get()
+        if item is _DONE:
+            self.close()
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        return item
+
+    def close(self):
+        if not self.request.cancelled.is_set():
+            self.request.cancelled.set()
+            self._wakeup.set()
+
+    def __del__(self):
+        self.close()
+
+
+class _Slot:
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        self.request: Optional[_Request] = None
+        self.reset()
+
+    def reset(self):
+        self.request = None
+        self.pending: List[int] = []   # prompt tokens not yet decoded
+        self.pos = 0                   # next KV position in this sequence
+        self.generated: List[int] = []
+        self.history: List[int] = []   # recent tokens for the repeat penalty
+        self.text = ""                 # decoded, not yet emitted
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.batch_index = -1          # logits row of this slot in the last batch
+
+    @property
+    def busy(self) -> bool:
+        return self.request is not None
+
+
+class ParallelDecoder:
+    """Run up to ``n_parallel`` generations concurrently on one llama.cpp context."""
+
+    PENALTY_LAST_N = 64
+
+    def __init__(
+        self,
+        name: str,
+        llama: "llama_cpp.Llama",
+        n_parallel: int,
+        n_ctx_per_slot: int,
+        n_batch: int,
+        n_threads: Optional[int],
+        sampling: dict,
+        lora_paths: Optional[List[str]] = None,
+        lora_scaling: Optional[List[float]] = None,
+    ):
+        self.name = name
+        self.llama = llama
+        self.n_parallel = n_parallel
+        self.n_ctx_per_slot = n_ctx_per_slot
+        self.n_batch = n_batch
+        self.sampling = sampling
+        self.n_vocab = llama.n_vocab()
+        self._rng = np.random.default_rng()
+
+        # One extra sequence holds the shared prompt prefix (see set_prefix). It
+        # gets its own n_ctx_per_slot cells so slots can always fill theirs.
+        self.prefix_seq = n_parallel
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx_per_slot * (n_parallel + 1)
+        params.n_batch = n_batch
+        if hasattr(params, "n_ubatch"):
+            params.n_ubatch = n_batch
+        params.n_seq_max = n_parallel + 1
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads
+        new_context = _llama_fn("llama_init_from_model", "llama_new_context_with_model")
+        self.ctx = new_context(llama.model, params)
+        if not self.ctx:
+            raise RuntimeError(f"[{name}] Failed to create parallel context")
+        self._adapters = []
+        try:
+            self._apply_lora(lora_paths or [], lora_scaling or [])
+        except Exception:
+            self._free_context()
+            raise
+
+        self._seq_rm = _llama_fn("llama_kv_self_seq_rm", "llama_kv_cache_seq_rm")
+        self._seq_cp = _llama_fn("llama_kv_self_seq_cp", "llama_kv_cache_seq_cp")
+        self._is_eog = getattr(llama_cpp, "llama_token_is_eog", None)
+        self._eos = llama.token_eos()
+
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, n_parallel + 1)
+        self.slots = [_Slot(i) for i in range(n_parallel)]
+        self.waiting: "queue.Queue[_Request]" = queue.Queue()
+
+        self._prefix_tokens: List[int] = []
+        self._prefix_ready = False
+        self._next_prefix: Optional[List[int]] = None
+
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name=f"decoder-{name}", daemon=True)
+        self._thread.start()
+
+        for slot in self.slots:
+            LLM_SLOT_OCCUPIED.labels(model=name, slot=str(slot.seq_id)).set(0)
+        logger.info(
+            f"[{name}] Parallel decoding: {n_parallel} slots x {n_ctx_per_slot} ctx, batch={n_batch}"
+        )
+
+    @staticmethod
+    def supports_lora() -> bool:
+        """Whether this llama_cpp build can attach LoRA adapters to our own context."""
+        try:
+            _llama_fn("llama_adapter_lora_init", "llama_lora_adapter_init")
+            _llama_fn("llama_set_adapter_lora", "llama_lora_adapter_set")
+        except AttributeError:
+            return False
+        return True
+
+    def _apply_lora(self, paths: List[str], scales: List[float]):
+        """Attach the model's LoRA adapters to the slot context (Llama only applies them to its own)."""
+        if not paths:
+            return
+        init = _llama_fn("llama_adapter_lora_init", "llama_lora_adapter_init")
+        attach = _llama_fn("llama_set_adapter_lora", "llama_lora_adapter_set")
+        for i, path in enumerate(paths):
+            scale = scales[i] if i < len(scales) else 1.0
+            adapter = init(self.llama.model, path.encode("utf-8"))
+            if not adapter:
+                raise RuntimeError(f"[{self.name}] Failed to load LoRA adapter {path}")
+            self._adapters.append(adapter)
+            if attach(self.ctx, adapter, scale) != 0:
+                raise RuntimeError(f"[{self.name}] Failed to apply LoRA adapter {path}")
+            logger.info(f"[{self.name}] LoRA adapter {path} applied to parallel context (scale={scale})")
+
+    def _free_context(self):
+        free_adapter = getattr(llama_cpp, "llama_adapter_lora_free", None) or getattr(
+            llama_cpp, "llama_lora_adapter_free", None
+        )
+        _llama_fn("llama_free")(self.ctx)
+        self.ctx = None
+        if free_adapter is not None:
+            for adapter in self._adapters:
+                free_adapter(adapter)
+        self._adapters = []
+
+    # ----------------- public API (any thread) -----------------
+
+    def set_prefix(self, tokens: List[int]):
+        """Evaluate ``tokens`` once into a shared sequence that slots copy from."""
+        if tokens != self._prefix_tokens:
+            self._next_prefix = list(tokens)
+            self._wakeup.set()
+
+    def generate(self, prompt: str, max_tokens: int) -> _Stream:
+        """
+        Queue ``prompt`` and return an iterator of text pieces. Raises
+        ValueError immediately if it can't fit a slot; closing the iterator,
+        even before its first piece, frees the slot.
+        """
+        tokens = self.llama.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        if len(tokens) + max_tokens > self.n_ctx_per_slot:
+            raise ValueError(
+                f"Prompt ({len(tokens)} tokens) + max_tokens ({max_tokens}) exceeds "
+                f"the per-slot context of {self.n_ctx_per_slot}"
+            )
+        request = _Request(tokens, max_tokens, self.sampling)
+        self.waiting.put(request)
+        LLM_WAITING_REQUESTS.labels(model=self.name).set(self.waiting.qsize())
+        self._wakeup.set()
+        return _Stream(request, self._wakeup)
+
+    # ----------------- scheduler thread -----------------
+
+    def _run(self):
+        while not self._closing:
+            if not any(slot.busy for slot in self.slots) and self.waiting.empty() and self._next_prefix is None:
+                self._wakeup.wait()
+                if self._closing:
+                    break
+            self._wakeup.clear()
+            try:
+                self._refresh_prefix()
+                self._admit()
+                self._step()
+            except Exception as e:
+                logger.error(f"[{self.name}] Decode step failed: {e}")
+                for slot in self.slots:
+                    if slot.busy:
+                        self._finish(slot, RuntimeError(f"Model inference failed: {e}"))
+        _llama_fn("llama_batch_free")(self.batch)
+        self._free_context()
+
+    def _refresh_prefix(self):
+        tokens = self._next_prefix
+        if tokens is None or any(slot.busy for slot in self.slots):
+            return  # Swap the shared prefix only while no slot may be copying it
+        self._next_prefix = None
+        self._seq_rm(self.ctx, self.prefix_seq, -1, -1)
+        self._prefix_tokens, self._prefix_ready = tokens, False
+        if len(tokens) > self.n_ctx_per_slot:
+            logger.warning(f"[{self.name}] Prefix of {len(tokens)} tokens exceeds its reserved cells; not cached")
+            return
+        for start in range(0, len(tokens), self.n_batch):
+            chunk = tokens[start:start + self.n_batch]
+            self._clear_batch()
+            for i, token in enumerate(chunk):
+                self._add(token, start + i, self.prefix_seq, False)
+            if llama_cpp.llama_decode(self.ctx, self.batch) != 0:
+                logger.warning(f"[{self.name}] Prefix evaluation failed; slots will evaluate it themselves")
+                self._seq_rm(self.ctx, self.prefix_seq, -1, -1)
+                return
+        self._prefix_ready = True
+        logger.info(f"[{self.name}] Shared prefix of {len(tokens)} tokens cached for all slots")
+
+    def _admit(self):
+        if self._next_prefix is not None:
+            return  # Let busy slots drain so the pending prefix swap can land
+        for slot in self.slots:
+            if slot.busy:
+                continue
+            try:
+                request = self.waiting.get_nowait()
+            except queue.Empty:
+                break
+            if request.cancelled.is_set():
+                continue
+            slot.reset()
+            slot.request = request
+            tokens = request.tokens
+            n = len(self._prefix_tokens)
+            reused = 0
+            if self._prefix_ready and len(tokens) > n and tokens[:n] == self._prefix_tokens:
+                # Share the prefix cells instead of re-evaluating them
+                self._seq_cp(self.ctx, self.prefix_seq, slot.seq_id, 0, n)
+                reused = n
+            slot.pending = tokens[reused:]
+            slot.pos = reused
+            slot.history = tokens[-self.PENALTY_LAST_N:]
+            PROMPT_TOKENS_REUSED.inc(reused)
+            PROMPT_TOKENS_EVALUATED.inc(len(tokens) - reused)
+            LLM_SLOT_OCCUPIED.labels(model=self.name, slot=str(slot.seq_id)).set(1)
+        LLM_WAITING_REQUESTS.labels(model=self.name).set(self.waiting.qsize())
+        LLM_SLOTS_BUSY.labels(model=self.name).set(sum(slot.busy for slot in self.slots))
+
+    def _step(self):
+        # Drop requests whose caller went away
+        for slot in self.slots:
+            if slot.busy and slot.request.cancelled.is_set():
+                self._finish(slot)
+
+        self._clear_batch()
+        capacity = self.n_batch
+        # Generating slots first (one token each), then prompt chunks fill the rest
+        for slot in sorted((s for s in self.slots if s.busy), key=lambda s: bool(s.pending)):
+            slot.batch_index = -1
+            if capacity == 0:
+                break
+            if slot.pending:
+                chunk = slot.pending[:capacity]
+                slot.pending = slot.pending[len(chunk):]
+                for i, token in enumerate(chunk):
+                    last = not slot.pending and i == len(chunk) - 1
+                    self._add(token, slot.pos, slot.seq_id, last)
+                    if last:
+                        slot.batch_index = self.batch.n_tokens - 1
+                    slot.pos += 1
+                capacity -= len(chunk)
+            elif slot.generated:
+                self._add(slot.generated[-1], slot.pos, slot.seq_id, True)
+                slot.batch_index = self.batch.n_tokens - 1
+                slot.pos += 1
+                capacity -= 1
+
+        if self.batch.n_tokens == 0:
+            return
+        LLM_DECODE_BATCH_TOKENS.labels(model=self.name).observe(self.batch.n_tokens)
+        if llama_cpp.llama_decode(self.ctx, self.batch) != 0:
+            raise RuntimeError("llama_decode failed (KV cache full?)")
+
+        for slot in self.slots:
+            if slot.busy and slot.batch_index >= 0:
+                self._sample(slot)
+
+    def _sample(self, slot: _Slot):
+        request = slot.request
+        logits = np.ctypeslib.as_array(
+            llama_cpp.llama_get_logits_ith(self.ctx, slot.batch_index), shape=(self.n_vocab,)
+        ).astype(np.float32)
+        token = self._pick(logits, slot.history, request)
+        slot.generated.append(token)
+        slot.history = (slot.history + [token])[-self.PENALTY_LAST_N:]
+
+        if self._is_end(token):
+            self._finish(slot)
+            return
+
+        slot.text += slot.decoder.decode(self.llama.detokenize([token]))
+        for stop in request.stop:
+            cut = slot.text.find(stop)
+            if cut >= 0:
+                slot.text = slot.text[:cut]
+                self._finish(slot)
+                return
+        if len(slot.generated) >= request.max_tokens:
+            self._finish(slot)
+            return
+        self._emit(slot, final=False)
+
+    def _pick(self, logits: np.ndarray, history: List[int], request: _Request) -> int:
+        if request.repeat_penalty != 1.0 and history:
+            seen = np.unique(history)
+            values = logits[seen]
+            logits[seen] = np.where(values > 0, values / request.repeat_penalty, values * request.repeat_penalty)
+        if request.temperature <= 0:
+            return int(np.argmax(logits))
+
+        k = min(request.top_k, len(logits)) if request.top_k > 0 else len(logits)
+        top = np.argpartition(-logits, k - 1)[:k]
+        top = top[np.argsort(-logits[top])]
+        scaled = logits[top] / request.temperature
+        probs = np.exp(scaled - scaled.max())
+        probs /= probs.sum()
+        if request.top_p < 1.0:
+            keep = int(np.searchsorted(np.cumsum(probs), request.top_p)) + 1
+            top, probs = top[:keep], probs[:keep] / probs[:keep].sum()
+        return int(self._rng.choice(top, p=probs))
+
+    def _is_end(self, token: int) -> bool:
+        if self._is_eog is not None:
+            try:
+                return bool(self._is_eog(self.llama.model, token))
+            except Exception:
+                pass
+        return token == self._eos
+
+    def _emit(self, slot: _Slot, final: bool):
+        """Send decoded text, holding back any tail that could start a stop string."""
+        text = slot.text
+        hold = 0
+        if not final:
+            for stop in slot.request.stop:
+                for n in range(min(len(stop) - 1, len(text)), 0, -1):
+                    if text.endswith(stop[:n]):
+                        hold = max(hold, n)
+                        break
+        ready, slot.text = text[: len(text) - hold], text[len(text) - hold:]
+        if ready:
+            slot.request.out.put(ready)
+
+    def _finish(self, slot: _Slot, error: Optional[Exception] = None):
+        request = slot.request
+        if error is None:
+            self._emit(slot, final=True)
+            request.out.put(_DONE)
+        else:
+            request.out.put(error)
+        PROMPT_TOKENS.labels(model=self.name).inc(len(request.tokens))
+        COMPLETION_TOKENS.labels(model=self.name).inc(len(slot.generated))
+        TOKENS_GENERATED.inc(len(slot.generated))
+        self._seq_rm(self.ctx, slot.seq_id, -1, -1)
+        slot.reset()
+        LLM_SLOT_OCCUPIED.labels(model=self.name, slot=str(slot.seq_id)).set(0)
+        LLM_SLOTS_BUSY.labels(model=self.name).set(sum(s.busy for s in self.slots))
+
+    # ----------------- batch helpers -----------------
+
+    def _clear_batch(self):
+        self.batch.n_tokens = 0
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool):
+        i = self.batch.n_tokens
+        self.batch.token[i] = token
+        self.batch.pos[i] = pos
+        self.batch.n_seq_id[i] = 1
+        self.batch.seq_id[i][0] = seq_id
+        self.batch.logits[i] = logits
+        self.batch.n_tokens += 1
+
+    def close(self):
+        """Stop the scheduler and free the context. Only call once no request uses it."""
+        self._closing = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "slots": self.n_parallel,
+            "busy": sum(slot.busy for slot in self.slots),
+            "waiting": self.waiting.qsize(),
+        }
@@ -1,6 +1,6 @@
 import logging
 import os
-from typing import Optional
+from typing import List, Optional
 
 from .base_model import BaseLlamaModel
 
@@ -12,6 +12,22 @@ class QwenModel(BaseLlamaModel):
     Qwen2.5-7B-Instruct + LoRA adapter (always applied).
     """
 
+    @staticmethod
+    def default_model_path() -> str:
+        return os.getenv("QWEN_MODEL_PATH", "/models/qwen/Qwen2.5-7B-Instruct-Q8_0.gguf")
+
+    @staticmethod
+    def default_lora_path() -> str:
+        return os.getenv("QWEN_LORA_PATH", "/models/qwen/legal_lora_adapter_only_25k.gguf")
+
+    @staticmethod
+    def default_n_ctx() -> int:
+        return int(os.getenv("QWEN_N_CTX", "2048"))
+
+    @classmethod
+    def weight_files(cls) -> List[str]:
+        return [cls.default_model_path(), cls.default_lora_path()]
+
     def __init__(
         self,
         gpu: bool,
@@ -19,15 +35,11 @@ class QwenModel(BaseLlamaModel):
         n_gpu_layers: Optional[int] = None,
         n_threads: Optional[int] = None,
     ):
-        model_path = os.getenv(
-            "QWEN_MODEL_PATH", "/models/qwen/Qwen2.5-7B-Instruct-Q8_0.gguf"
-        )
-        lora_path = os.getenv(
-            "QWEN_LORA_PATH", "/models/qwen/legal_lora_adapter_only_25k.gguf"
-        )
+        model_path = self.default_model_path()
+        lora_path = self.default_lora_path()
 
         # Optimized for L4 GPU - reduce context for faster inference
-        ctx = n_ctx or int(os.getenv("QWEN_N_CTX", "2048"))
+        ctx = n_ctx or self.default_n_ctx()
         
         # L4 has 24 cores, use all for CPU parts
         threads = n_threads or int(os.getenv("LLM_N_THREADS", "24"))
@@ -0,0 +1,155 @@
+"""
+Per-conversation KV state cache.
+
+Maps a session id to the llama.cpp state left behind by that session's
+last turn, so the next turn (whose transcript starts with the same tokens)
+only evaluates what is new. States live in an in-process LRU bounded by
+count and bytes; with a spill directory, states evicted from memory are
+pickled to local disk and promoted back on the next hit.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from local_cache import LRUCache
+from metrics import SESSION_CACHE_HITS, SESSION_CACHE_MISSES
+
+logger = logging.getLogger(__name__)
+
+
+def _state_size(entry) -> int:
+    tokens, state = entry
+    size = tokens.nbytes + len(getattr(state, "llama_state", b""))
+    for name in ("input_ids", "scores"):
+        size += getattr(getattr(state, name, None), "nbytes", 0)
+    return size
+
+
+class SessionStore:
+    def __init__(
+        self,
+        max_items: int = 32,
+        max_bytes: int = 2 * 1024 ** 3,
+        ttl: float = 1800.0,
+        spill_dir: Optional[str] = None,
+        spill_max_bytes: int = 8 * 1024 ** 3,
+    ):
+        self.ttl = ttl
+        self.spill_dir = spill_dir or None
+        self.spill_max_bytes = spill_max_bytes
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self.memory = LRUCache(
+            max_items=max_items,
+            max_bytes=max_bytes,
+            ttl=ttl,
+            sizeof=_state_size,
+            on_evict=self._spill if self.spill_dir else None,
+        )
+
+    @classmethod
+    def from_env(cls, prefix: str = "SESSION_CACHE") -> Optional["SessionStore"]:
+        """Build from SESSION_CACHE_* env vars; None when disabled (MAX_ITEMS=0)."""
+        max_items = int(os.getenv(f"{prefix}_MAX_ITEMS", "32"))
+        if max_items <= 0:
+            return None
+        return cls(
+            max_items=max_items,
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(2 * 1024 ** 3))),
+            ttl=float(os.getenv(f"{prefix}_TTL", "1800")),
+            spill_dir=os.getenv(f"{prefix}_SPILL_DIR", ""),
+            spill_max_bytes=int(os.getenv(f"{prefix}_SPILL_MAX_BYTES", str(8 * 1024 ** 3))),
+        )
+
+    def get(self, session_id: str) -> Optional[Tuple[np.ndarray, object]]:
+        """Return ``(tokens, state)`` for the session's last turn, or None."""
+        entry = self.memory.get(session_id)
+        if entry is not None:
+            SESSION_CACHE_HITS.labels(tier="memory").inc()
+            return entry
+        entry = self._load(session_id)
+        if entry is not None:
+            SESSION_CACHE_HITS.labels(tier="disk").inc()
+            self.memory.set(session_id, entry)
+            return entry
+        SESSION_CACHE_MISSES.inc()
+        return None
+
+    def put(self, session_id: str, tokens: np.ndarray, state):
+        self.memory.set(session_id, (np.asarray(tokens, dtype=np.intc), state))
+        if self.spill_dir:
+            # A spilled copy of an older turn is now stale
+            self._remove(self._path(session_id))
+
+    # ----------------- disk tier -----------------
+
+    def _path(self, session_id: str) -> str:
+        name = hashlib.sha256(session_id.encode()).hexdigest()
+        return os.path.join(self.spill_dir, f"{name}.state")
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _spill(self, session_id: str, entry):
+        path = self._path(session_id)
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            self._prune()
+        except Exception as e:
+            logger.warning(f"Session spill failed for {session_id}: {e}")
+            self._remove(tmp)
+
+    def _load(self, session_id: str):
+        if not self.spill_dir:
+            return None
+        path = self._path(session_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self._remove(path)
+                return None
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Session load failed for {session_id}: {e}")
+            self._remove(path)
+            return None
+        self._remove(path)
+        return entry
+
+    def _prune(self):
+        """Delete the oldest spilled states beyond spill_max_bytes (and expired ones)."""
+        files = []
+        now = time.time()
+        for entry in os.scandir(self.spill_dir):
+            if not entry.name.endswith(".state"):
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.spill_max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats["spill_dir"] = self.spill_dir
+        return stats
@@ -0,0 +1,123 @@
+"""
+Bounded in-process LRU cache used as the first tier in front of Redis.
+
+Entries are bounded by count and by an approximate byte budget, and expire
+after a TTL. Each gunicorn worker holds its own instance.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+def _default_sizeof(value: Any) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    nbytes = getattr(value, "nbytes", None)
+    return nbytes if nbytes is not None else sys.getsizeof(value)
+
+
+class LRUCache:
+    """Thread-safe LRU with size, byte and TTL limits plus hit/miss counters."""
+
+    def __init__(
+        self,
+        max_items: int = 1024,
+        max_bytes: int = 32 * 1024 * 1024,
+        ttl: float = 300.0,
+        sizeof: Callable[[Any], int] = _default_sizeof,
+        on_evict: Optional[Callable[[str, Any], None]] = None,
+    ):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        # Called (outside the lock) for entries pushed out by capacity, not TTL/delete
+        self.on_evict = on_evict
+
+        # key -> (value, size, expires_at)
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_items > 0 and self.max_bytes > 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = item
+            if expires_at <= time.monotonic():
+                self._drop_locked(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        if not self.enabled:
+            return
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        expires_at = time.monotonic() + ttl
+        evicted = []
+        with self._lock:
+            if key in self._data:
+                self._drop_locked(key)
+            self._data[key] = (value, size, expires_at)
+            self._bytes += size
+            while len(self._data) > self.max_items or self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                item = self._drop_locked(oldest)
+                self.evictions += 1
+                if item[2] > time.monotonic():
+                    evicted.append((oldest, item[0]))
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._drop_locked(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _drop_locked(self, key: str) -> Optional[tuple]:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= item[1]
+        return item
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_items": self.max_items,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
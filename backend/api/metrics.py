@@ -33,11 +33,34 @@ INFERENCE_TIME = Histogram(
     buckets=(1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300, 360, 420, 480, 540, 600)  # Up to 10 min
 )
 
+TIME_TO_FIRST_TOKEN = Histogram(
+    "time_to_first_token_seconds",
+    "Time from start of a streamed generation to its first token",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+)
+
 TOKENS_GENERATED = Counter(
     "tokens_generated_total",
     "Total number of tokens generated"
 )
 
+PROMPT_TOKENS = Counter(
+    "llm_prompt_tokens_total",
+    "Prompt tokens per generation, counted by the model tokenizer",
+    ["model"]
+)
+
+COMPLETION_TOKENS = Counter(
+    "llm_completion_tokens_total",
+    "Completion tokens per generation, counted by the model tokenizer",
+    ["model"]
+)
+
+CONTEXT_TRUNCATED_MESSAGES = Counter(
+    "context_truncated_messages_total",
+    "Oldest conversation messages dropped to fit the context window"
+)
+
 CACHE_HITS = Counter(
     "cache_hits_total",
     "Total number of cache hits"
@@ -48,6 +71,123 @@ CACHE_MISSES = Counter(
     "Total number of cache misses"
 )
 
+COALESCED_REQUESTS = Counter(
+    "coalesced_requests_total",
+    "Requests that reused the result of an identical in-flight generation"
+)
+
+LOCAL_CACHE_HITS = Counter(
+    "cache_local_hits_total",
+    "Exact-key hits served from the in-process cache tier"
+)
+
+LOCAL_CACHE_MISSES = Counter(
+    "cache_local_misses_total",
+    "Lookups that fell through the in-process cache tier to Redis"
+)
+
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "inference_queue_depth",
+    "Generations waiting for an inference worker"
+)
+
+INFERENCE_ACTIVE = Gauge(
+    "inference_active",
+    "Generations currently running on inference workers"
+)
+
+INFERENCE_QUEUE_WAIT = Histogram(
+    "inference_queue_wait_seconds",
+    "Time a generation waited for an inference worker",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+)
+
+INFERENCE_REJECTED = Counter(
+    "inference_rejected_total",
+    "Generations rejected because the inference queue was full"
+)
+
+PROMPT_TOKENS_REUSED = Counter(
+    "prompt_tokens_reused_total",
+    "Prompt tokens served from the KV cache (cached prefix) instead of evaluated"
+)
+
+PROMPT_TOKENS_EVALUATED = Counter(
+    "prompt_tokens_evaluated_total",
+    "Prompt tokens evaluated by the model"
+)
+
+PREFIX_CACHE_RESTORES = Counter(
+    "prefix_cache_restores_total",
+    "Times the saved system-prompt KV state was loaded back into the model"
+)
+
+LLM_SLOT_OCCUPIED = Gauge(
+    "llm_slot_occupied",
+    "1 while a parallel decoding slot holds a request",
+    ["model", "slot"]
+)
+
+LLM_SLOTS_BUSY = Gauge(
+    "llm_slots_busy",
+    "Parallel decoding slots currently generating",
+    ["model"]
+)
+
+LLM_WAITING_REQUESTS = Gauge(
+    "llm_waiting_requests",
+    "Requests waiting for a free parallel decoding slot",
+    ["model"]
+)
+
+LLM_DECODE_BATCH_TOKENS = Histogram(
+    "llm_decode_batch_tokens",
+    "Tokens packed into one llama_decode call",
+    ["model"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+
+SESSION_CACHE_HITS = Counter(
+    "session_cache_hits_total",
+    "Conversation turns that resumed from a cached session KV state",
+    ["tier"]
+)
+
+SESSION_CACHE_MISSES = Counter(
+    "session_cache_misses_total",
+    "Conversation turns with a session id but no cached KV state"
+)
+
+MODEL_LOADED = Gauge(
+    "model_loaded",
+    "Whether a model instance is resident (1) in this pod",
+    ["model"]
+)
+
+MODEL_RESIDENT_BYTES = Gauge(
+    "model_resident_bytes",
+    "Estimated memory of resident and loading models, counted against MODEL_MEMORY_BUDGET_GB"
+)
+
+MODEL_LOAD_DURATION = Histogram(
+    "model_load_duration_seconds",
+    "Time to load a model instance",
+    ["model"],
+    buckets=(1, 5, 10, 20, 30, 60, 120, 300, 600)
+)
+
+MODEL_EVICTIONS = Counter(
+    "model_evictions_total",
+    "Idle models unloaded to make room for another",
+    ["model"]
+)
+
+MODEL_NOT_READY = Counter(
+    "model_not_ready_total",
+    "Requests refused because their model was still loading",
+    ["model"]
+)
+
 # ----------------- MIDDLEWARE -----------------
 
 class PrometheusMiddleware(BaseHTTPMiddleware):
@@ -1,6 +1,6 @@
 import logging
-from typing import Literal
-from llm.model_factory import get_model
+from typing import Iterator, Literal, Optional
+from llm.model_factory import get_context_window, get_tokenizer, registry
 from prompt import SYSTEM_PROMPT  # your static system instructions
 
 logging.basicConfig(level=logging.INFO)
@@ -23,38 +23,88 @@ class CounselGPTModel:
         self.model_name = model_name
         self.use_gpu = use_gpu
 
-    def infer(self, prompt: str, max_tokens: int = 300) -> str:
-        if not prompt or not prompt.strip():
-            raise ValueError("Prompt cannot be empty")
-
-        if max_tokens < 1 or max_tokens > 2048:
-            raise ValueError("max_tokens must be between 1 and 2048")
+    @staticmethod
+    def _prefix() -> str:
+        """Constant head of every prompt (system instructions), KV-cached per model."""
+        return f"<|im_start|>system\n{SYSTEM_PROMPT.strip()}\n\n"
 
+    def _render(self, prompt: str, max_tokens: int) -> str:
         # Qwen2.5-Instruct uses a specific chat template with special tokens
         # Format: <|im_start|>role\ncontent<|im_end|>
         
-        # Build system message with length constraint
+        # Build system message with length constraint. The template head up
+        # to the word budget is identical for every request (see _prefix).
         word_budget = max_tokens
-        system_message = (
-            f"{SYSTEM_PROMPT.strip()}\n\n"
+        return (
+            f"{self._prefix()}"
             f"IMPORTANT: Keep your response under {word_budget} words. "
-            f"Be concise and direct."
-        )
-        
-        # Use proper Qwen chat template
-        final_prompt = (
-            f"<|im_start|>system\n{system_message}<|im_end|>\n"
+            f"Be concise and direct.<|im_end|>\n"
             f"<|im_start|>user\n{prompt}<|im_end|>\n"
             f"<|im_start|>assistant\n"
         )
 
+    def _build_prompt(self, prompt: str, max_tokens: int) -> str:
+        if not prompt or not prompt.strip():
+            raise ValueError("Prompt cannot be empty")
+
+        if max_tokens < 1 or max_tokens > 2048:
+            raise ValueError("max_tokens must be between 1 and 2048")
+
+        final_prompt = self._render(prompt, max_tokens)
+        word_budget = max_tokens
+
         logger.info(
             f"[{self.model_name}] Final prompt length={len(final_prompt)}, "
             f"word_budget={word_budget}"
         )
+        return final_prompt
+
+    def ensure_ready(self):
+        """Raise ModelNotReady (and start loading) unless the model is resident; never blocks."""
+        registry.ensure(self.model_name, self.use_gpu)
+
+    @property
+    def context_window(self) -> int:
+        return get_context_window(self.model_name)
+
+    def count_tokens(self, text: str) -> int:
+        """Tokens of ``text`` under the model's own vocabulary (no BOS)."""
+        return len(get_tokenizer(self.model_name).tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def prompt_tokens(self, prompt: str, max_tokens: int) -> int:
+        """Tokens of the full templated prompt that infer() would evaluate."""
+        return len(
+            get_tokenizer(self.model_name).tokenize(
+                self._render(prompt, max_tokens).encode("utf-8"), add_bos=True, special=True
+            )
+        )
+
+    def infer(self, prompt: str, max_tokens: int = 300, session_id: Optional[str] = None) -> str:
+        final_prompt = self._build_prompt(prompt, max_tokens)
+
+        # Lease the underlying llama.cpp model (qwen/llama, gpu/cpu) so it can't be evicted mid-request
+        with registry.lease(self.model_name, self.use_gpu) as model:
+            model.set_prefix(self._prefix())
+
+            # Delegate to BaseLlamaModel.infer (which calls llama_cpp with max_tokens)
+            return model.infer(final_prompt, max_tokens=max_tokens, session_id=session_id)
 
-        # Get the underlying llama.cpp model (qwen/llama, gpu/cpu)
-        model = get_model(self.model_name, self.use_gpu)
+    def infer_stream(self, prompt: str, max_tokens: int = 300, session_id: Optional[str] = None) -> Iterator[str]:
+        """Same prompt construction as infer(), yielding text pieces as they are generated."""
+        final_prompt = self._build_prompt(prompt, max_tokens)
+        model = registry.acquire(self.model_name, self.use_gpu)
+        try:
+            model.set_prefix(self._prefix())
+            pieces = model.infer_stream(final_prompt, max_tokens=max_tokens, session_id=session_id)
+        except BaseException:
+            registry.release(model)
+            raise
+        return self._leased(pieces, model)
 
-        # Delegate to BaseLlamaModel.infer (which calls llama_cpp with max_tokens)
-        return model.infer(final_prompt, max_tokens=max_tokens)
+    @staticmethod
+    def _leased(pieces: Iterator[str], model) -> Iterator[str]:
+        """Hold the model lease until the stream is exhausted or closed."""
+        try:
+            yield from pieces
+        finally:
+            registry.release(model)
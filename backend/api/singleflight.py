@@ -0,0 +1,43 @@
+"""
+Single-flight request coalescing.
+
+Concurrent callers with the same key share one execution: the first caller
+(leader) starts the coroutine as a task, every caller awaits the same result
+or exception. Cancelling a caller never cancels the shared task.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls per key (in-process, asyncio-based)."""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Await ``fn()`` once per in-flight ``key``.
+
+        Returns ``(result, shared)`` where ``shared`` is True for followers
+        that received the leader's result.
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if task is None:
+            # The work runs in its own task, so a caller (leader included)
+            # being cancelled never cancels it for the others
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task), shared
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Callers re-raise it; don't warn if they all went away
+            task.exception()
+
+    def inflight(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,221 @@
+"""
+In-process vector index for semantic cache lookups.
+
+Embeddings are L2-normalized and kept in one NumPy matrix per ``max_tokens``
+partition, so a lookup is a single matmul + argmax instead of a SCAN/GET over
+every Redis key. Rows carry the Redis expiry so entries vanish with their TTL.
+"""
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("counselgpt-api.vector_index")
+
+
+def normalize(vector) -> Optional[np.ndarray]:
+    """Return a float32 unit vector, or None for empty/zero vectors."""
+    vec = np.asarray(vector, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(vec))
+    if vec.size == 0 or norm == 0.0 or not np.isfinite(norm):
+        return None
+    return vec / norm
+
+
+class _Partition:
+    """Dense row storage for the embeddings of one max_tokens value."""
+
+    def __init__(self, dim: int, capacity: int):
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.expires = np.zeros(capacity, dtype=np.float64)
+        self.written = np.zeros(capacity, dtype=np.float64)
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _grow(self):
+        capacity = self.vectors.shape[0] * 2
+        for name in ("vectors", "expires", "written"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: len(self.keys)] = old[: len(self.keys)]
+            setattr(self, name, new)
+
+    def upsert(self, key: str, vec: np.ndarray, expires_at: float, now: float):
+        row = self.rows.get(key)
+        if row is None:
+            if len(self.keys) == self.vectors.shape[0]:
+                self._grow()
+            row = len(self.keys)
+            self.keys.append(key)
+            self.rows[key] = row
+        self.vectors[row] = vec
+        self.expires[row] = expires_at
+        self.written[row] = now
+
+    def remove(self, key: str) -> bool:
+        row = self.rows.pop(key, None)
+        if row is None:
+            return False
+        last = len(self.keys) - 1
+        if row != last:
+            # Swap the last row into the hole to keep storage dense
+            moved = self.keys[last]
+            self.vectors[row] = self.vectors[last]
+            self.expires[row] = self.expires[last]
+            self.written[row] = self.written[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+        self.keys.pop()
+        return True
+
+    def search(self, vec: np.ndarray, now: float) -> Optional[Tuple[str, float]]:
+        n = len(self.keys)
+        if n == 0:
+            return None
+        scores = self.vectors[:n] @ vec
+        scores[self.expires[:n] <= now] = -np.inf
+        best = int(np.argmax(scores))
+        if not np.isfinite(scores[best]):
+            return None
+        return self.keys[best], float(scores[best])
+
+    def expired_keys(self, now: float) -> List[str]:
+        n = len(self.keys)
+        return [self.keys[i] for i in np.flatnonzero(self.expires[:n] <= now)]
+
+    def stale_keys(self, seen: set, before: float) -> List[str]:
+        n = len(self.keys)
+        candidates = np.flatnonzero(self.written[:n] < before)
+        return [self.keys[i] for i in candidates if self.keys[i] not in seen]
+
+
+class VectorIndex:
+    """
+    Thread-safe top-1 cosine index partitioned by max_tokens.
+
+    Redis stays the source of truth: callers add rows on cache writes and
+    periodically ``sync`` from a scan so entries written by other replicas
+    (or evicted by Redis) converge.
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self.initial_capacity = initial_capacity
+        self.dim: Optional[int] = None
+        self._partitions: Dict[int, _Partition] = {}
+        self._key_partition: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._key_partition)
+
+    def _upsert_locked(self, key: str, vec: np.ndarray, max_tokens: int, expires_at: float, now: float):
+        if self.dim is None:
+            self.dim = vec.shape[0]
+        elif vec.shape[0] != self.dim:
+            logger.warning(f"Skipping embedding with dim={vec.shape[0]} (index dim={self.dim})")
+            return
+
+        previous = self._key_partition.get(key)
+        if previous is not None and previous != max_tokens:
+            self._partitions[previous].remove(key)
+
+        partition = self._partitions.get(max_tokens)
+        if partition is None:
+            partition = _Partition(self.dim, self.initial_capacity)
+            self._partitions[max_tokens] = partition
+        partition.upsert(key, vec, expires_at, now)
+        self._key_partition[key] = max_tokens
+
+    def _remove_locked(self, key: str) -> bool:
+        max_tokens = self._key_partition.pop(key, None)
+        if max_tokens is None:
+            return False
+        return self._partitions[max_tokens].remove(key)
+
+    def add(self, key: str, embedding, max_tokens: int, ttl: Optional[float] = None):
+        """Insert or refresh an entry. ``ttl`` <= 0 or None means no expiry."""
+        vec = normalize(embedding)
+        if vec is None:
+            return
+        now = time.time()
+        expires_at = now + ttl if ttl and ttl > 0 else np.inf
+        with self._lock:
+            self._upsert_locked(key, vec, max_tokens, expires_at, now)
+
+    def remove(self, key: str) -> bool:
+        with self._lock:
+            return self._remove_locked(key)
+
+    def search(self, embedding, max_tokens: int) -> Optional[Tuple[str, float]]:
+        """Return ``(key, cosine_score)`` of the nearest live entry, or None."""
+        vec = normalize(embedding)
+        if vec is None:
+            return None
+        with self._lock:
+            partition = self._partitions.get(max_tokens)
+            if partition is None or vec.shape[0] != partition.dim:
+                return None
+            return partition.search(vec, time.time())
+
+    def purge_expired(self) -> int:
+        """Drop rows whose TTL has passed. Returns the number removed."""
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for partition in self._partitions.values():
+                for key in partition.expired_keys(now):
+                    removed += self._remove_locked(key)
+        return removed
+
+    def sync(self, entries: Iterable[Tuple[str, object, int, Optional[float]]], started_at: float) -> int:
+        """
+        Reconcile with a full Redis scan that began at ``started_at``.
+
+        ``entries`` yields ``(key, embedding, max_tokens, ttl)``. Rows written
+        before the scan started and not seen in it are dropped; rows added
+        concurrently by ``add`` are kept. Entries without ``max_tokens`` (old
+        v1 records) are skipped: no lookup could ever reach their partition.
+        """
+        seen = set()
+        for key, embedding, max_tokens, ttl in entries:
+            if max_tokens is None:
+                continue
+            seen.add(key)
+            vec = normalize(embedding)
+            if vec is None:
+                continue
+            now = time.time()
+            expires_at = now + ttl if ttl and ttl > 0 else np.inf
+            with self._lock:
+                current = self._key_partition.get(key)
+                if current is not None:
+                    partition = self._partitions[current]
+                    if partition.written[partition.rows[key]] >= started_at:
+                        continue
+                self._upsert_locked(key, vec, max_tokens, expires_at, now)
+
+        removed = 0
+        with self._lock:
+            for partition in self._partitions.values():
+                for key in partition.stale_keys(seen, started_at):
+                    removed += self._remove_locked(key)
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._partitions.clear()
+            self._key_partition.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._key_partition),
+                "dimension": self.dim,
+                "partitions": {str(k): len(p) for k, p in self._partitions.items()},
+            }
@@ -3,11 +3,13 @@ Semantic Embedding Service
 Runs alongside Redis to generate embeddings for semantic caching
 """
 import os
+import time
+import asyncio
 import numpy as np
-from typing import List
-from fastapi import FastAPI, HTTPException
+from typing import List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -17,10 +19,206 @@ app = FastAPI(title="Semantic Embedding Service")
 
 # Load embedding model on startup
 MODEL_NAME = os.getenv("EMBEDDING_MODEL", "/models/semantic/all-MiniLM-L6-v2")
-logger.info(f"Loading embedding model: {MODEL_NAME}")
-model = SentenceTransformer(MODEL_NAME)
+
+# Inference backend: torch (SentenceTransformer), onnx, or onnx-int8 (dynamic quantization)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "") or None   # default: <model>/onnx
+# Where the graph is exported when EMBEDDING_ONNX_DIR (or <model>/onnx) is read-only
+EMBEDDING_ONNX_CACHE_DIR = os.getenv("EMBEDDING_ONNX_CACHE_DIR", os.path.expanduser("~/.cache/onnx"))
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))       # 0 = onnxruntime default
+# Compare ONNX output against torch at startup and refuse to serve if they disagree
+EMBEDDING_PARITY_CHECK = os.getenv("EMBEDDING_PARITY_CHECK", "false").lower() == "true"
+EMBEDDING_PARITY_MIN_COSINE = float(os.getenv("EMBEDDING_PARITY_MIN_COSINE", "0.99"))
+
+
+def load_model():
+    if EMBEDDING_BACKEND == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(MODEL_NAME)
+    
+    if EMBEDDING_BACKEND not in ("onnx", "onnx-int8"):
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+    
+    # Imported lazily so the torch backend doesn't need onnxruntime (and vice versa)
+    from onnx_backend import OnnxSentenceEncoder, parity_check
+    encoder = OnnxSentenceEncoder(
+        MODEL_NAME,
+        quantized=EMBEDDING_BACKEND == "onnx-int8",
+        onnx_dir=EMBEDDING_ONNX_DIR,
+        threads=EMBEDDING_THREADS,
+        cache_dir=EMBEDDING_ONNX_CACHE_DIR,
+    )
+    
+    if EMBEDDING_PARITY_CHECK:
+        from sentence_transformers import SentenceTransformer
+        cosine = parity_check(SentenceTransformer(MODEL_NAME), encoder)
+        if cosine < EMBEDDING_PARITY_MIN_COSINE:
+            raise RuntimeError(
+                f"{EMBEDDING_BACKEND} parity check failed: min cosine {cosine:.4f} "
+                f"< {EMBEDDING_PARITY_MIN_COSINE}"
+            )
+        logger.info(f"{EMBEDDING_BACKEND} parity check passed: min cosine {cosine:.4f}")
+    
+    return encoder
+
+
+logger.info(f"Loading embedding model: {MODEL_NAME} (backend: {EMBEDDING_BACKEND})")
+model = load_model()
 logger.info(f"Model loaded successfully. Embedding dimension: {model.get_sentence_embedding_dimension()}")
 
+# Micro-batching: concurrent /embed calls are merged into one encode() call
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))        # texts per forward pass
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))   # how long to hold a batch open
+
+
+# Metrics
+BATCH_SIZE = Histogram(
+    "embed_batch_size",
+    "Texts per batched encode() call",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+BATCH_REQUESTS = Histogram(
+    "embed_batch_requests",
+    "/embed requests merged into one encode() call",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+QUEUE_WAIT = Histogram(
+    "embed_queue_wait_seconds",
+    "Time a request waits before its batch starts encoding",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+ENCODE_DURATION = Histogram(
+    "embed_encode_duration_seconds",
+    "Duration of one batched encode() call",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+QUEUE_DEPTH = Gauge("embed_queue_depth", "Requests waiting to be batched")
+TEXTS_TOTAL = Counter("embed_texts_total", "Texts embedded")
+
+
+class MicroBatcher:
+    """
+    Collect concurrent embedding requests for up to ``max_wait`` seconds or
+    ``max_batch`` texts, run one ``encode`` on a worker thread and scatter
+    the rows back to each caller. While a batch is encoding, new requests
+    queue up and form the next batch.
+    """
+    
+    def __init__(self, encode, max_batch: int, max_wait: float):
+        self.encode = encode
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self.queue: "asyncio.Queue[Tuple[List[str], asyncio.Future, float]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._batch: List[Tuple[List[str], asyncio.Future, float]] = []
+        self._stopped = False
+    
+    def start(self):
+        self._stopped = False
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the worker and fail every request still queued or encoding."""
+        self._stopped = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        pending = self._batch
+        self._batch = []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        QUEUE_DEPTH.set(0)
+        for _, future, _ in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("Embedding batcher stopped"))
+    
+    async def submit(self, texts: List[str]) -> np.ndarray:
+        if self._stopped:
+            raise RuntimeError("Embedding batcher stopped")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future, time.perf_counter()))
+        QUEUE_DEPTH.set(self.queue.qsize())
+        return await future
+    
+    async def _collect(self) -> List[Tuple[List[str], asyncio.Future, float]]:
+        # Kept on the instance so stop() can fail a batch it interrupts
+        self._batch = batch = [await self.queue.get()]
+        count = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while count < self.max_batch:
+            # Take what is already queued without waiting, then wait out the window
+            if self.queue.empty():
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            batch.append(item)
+            count += len(item[0])
+        QUEUE_DEPTH.set(self.queue.qsize())
+        return batch
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Callers that gave up (client disconnect) don't need encoding
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            
+            started = time.perf_counter()
+            texts = [text for item in batch for text in item[0]]
+            for _, _, enqueued_at in batch:
+                QUEUE_WAIT.observe(started - enqueued_at)
+            BATCH_SIZE.observe(len(texts))
+            BATCH_REQUESTS.observe(len(batch))
+            
+            try:
+                embeddings = await loop.run_in_executor(None, self.encode, texts)
+            except Exception as e:
+                logger.error(f"Batch encode failed ({len(texts)} texts): {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            ENCODE_DURATION.observe(time.perf_counter() - started)
+            TEXTS_TOTAL.inc(len(texts))
+            
+            offset = 0
+            for item_texts, future, _ in batch:
+                rows = embeddings[offset:offset + len(item_texts)]
+                offset += len(item_texts)
+                if not future.done():
+                    future.set_result(rows)
+
+
+def encode_batch(texts: List[str]) -> np.ndarray:
+    return model.encode(texts, batch_size=EMBED_MAX_BATCH, convert_to_numpy=True)
+
+
+batcher = MicroBatcher(encode_batch, EMBED_MAX_BATCH, EMBED_MAX_WAIT_MS / 1000.0)
+
+
+# Binary /embed responses (Accept: application/octet-stream):
+#   body                -> little-endian float32 matrix, row-major
+#   X-Embedding-Shape   -> "rows,dim"
+#   X-Embedding-Dtype   -> "float32"
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+
+def wants_binary(request: Request) -> bool:
+    return BINARY_MEDIA_TYPE in request.headers.get("accept", "")
+
 
 class EmbedRequest(BaseModel):
     texts: List[str]
@@ -32,29 +230,58 @@ class EmbedResponse(BaseModel):
     dimension: int
 
 
+@app.on_event("startup")
+async def startup_event():
+    batcher.start()
+    logger.info(f"Micro-batching: max_batch={EMBED_MAX_BATCH}, max_wait={EMBED_MAX_WAIT_MS}ms")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await batcher.stop()
+
+
 @app.get("/health")
 def health():
     return {
         "status": "healthy",
         "model": MODEL_NAME,
+        "backend": EMBEDDING_BACKEND,
         "dimension": model.get_sentence_embedding_dimension()
     }
 
 
 @app.post("/embed", response_model=EmbedResponse)
-def embed_texts(request: EmbedRequest):
-    """Generate embeddings for input texts"""
+async def embed_texts(request: EmbedRequest, http_request: Request):
+    """
+    Generate embeddings for input texts (batched with concurrent requests).
+    
+    Returns JSON by default, or the raw float32 matrix when the client
+    sends ``Accept: application/octet-stream``.
+    """
+    if not request.texts:
+        raise HTTPException(status_code=400, detail="No texts provided")
+    
     try:
-        if not request.texts:
-            raise HTTPException(status_code=400, detail="No texts provided")
-        
         # Generate embeddings
-        embeddings = model.encode(request.texts, convert_to_numpy=True)
+        embeddings = await batcher.submit(request.texts)
+        
+        if wants_binary(http_request):
+            matrix = np.ascontiguousarray(embeddings, dtype="<f4")
+            return Response(
+                content=matrix.tobytes(),
+                media_type=BINARY_MEDIA_TYPE,
+                headers={
+                    "X-Embedding-Shape": f"{matrix.shape[0]},{matrix.shape[1]}",
+                    "X-Embedding-Dtype": "float32",
+                    "X-Embedding-Model": MODEL_NAME,
+                },
+            )
         
         # Convert to list of lists for JSON serialization
         embeddings_list = embeddings.tolist()
         
-        logger.info(f"Generated {len(embeddings_list)} embeddings")
+        logger.debug(f"Generated {len(embeddings_list)} embeddings")
         
         return EmbedResponse(
             embeddings=embeddings_list,
@@ -67,15 +294,27 @@ def embed_texts(request: EmbedRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/")
 def root():
     return {
         "service": "Semantic Embedding Service",
         "model": MODEL_NAME,
+        "backend": EMBEDDING_BACKEND,
         "dimension": model.get_sentence_embedding_dimension(),
         "endpoints": {
             "/health": "Health check",
-            "/embed": "POST - Generate embeddings"
+            "/embed": "POST - Generate embeddings (JSON, or float32 with Accept: application/octet-stream)",
+            "/metrics": "GET - Prometheus metrics"
+        },
+        "batching": {
+            "max_batch": EMBED_MAX_BATCH,
+            "max_wait_ms": EMBED_MAX_WAIT_MS
         }
     }
 
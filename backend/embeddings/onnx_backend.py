@@ -0,0 +1,233 @@
+"""
+ONNX Runtime backend for the embedding service.
+
+Runs the transformer of a SentenceTransformer model directory as an ONNX
+graph (optionally dynamic-int8 quantized) and reproduces the model's
+pooling and normalization in NumPy, so vectors match the PyTorch backend.
+"""
+import os
+import json
+import logging
+from typing import List, Optional
+
+import numpy as np
+import onnxruntime as ort
+from tokenizers import Tokenizer
+
+logger = logging.getLogger(__name__)
+
+PARITY_TEXTS = [
+    "What is the statute of limitations for breach of contract?",
+    "Can my landlord keep my security deposit?",
+    "How do I file for divorce in California?",
+    "hello",
+]
+
+
+def _read_json(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def export_onnx(model_dir: str, output_path: str):
+    """Export the model's transformer to ONNX (needs torch + transformers, build/first start only)"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    logger.info(f"Exporting {model_dir} to ONNX: {output_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModel.from_pretrained(model_dir)
+    model.eval()
+
+    inputs = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in inputs]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(inputs[name] for name in input_names),
+            output_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+
+def _writable(path: str) -> bool:
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(path, os.W_OK)
+
+
+def resolve_onnx_dir(model_dir: str, onnx_dir: Optional[str], filename: str, cache_dir: str) -> str:
+    """
+    Where to load ``filename`` from: ``onnx_dir`` (default ``<model_dir>/onnx``)
+    if it already holds it or can be written to, else a per-model
+    subdirectory of ``cache_dir`` (model volumes are often mounted read-only).
+    """
+    preferred = onnx_dir or os.path.join(model_dir, "onnx")
+    if os.path.exists(os.path.join(preferred, filename)) or _writable(preferred):
+        return preferred
+    fallback = os.path.join(cache_dir, os.path.basename(os.path.normpath(model_dir)))
+    logger.warning(f"{preferred} is not writable; exporting the ONNX graph to {fallback}")
+    os.makedirs(fallback, exist_ok=True)
+    return fallback
+
+
+def quantize_int8(input_path: str, output_path: str):
+    """Dynamic int8 quantization of the weights (activations stay float)"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    logger.info(f"Quantizing {input_path} to int8: {output_path}")
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QInt8)
+
+
+class OnnxSentenceEncoder:
+    """
+    Drop-in for the parts of SentenceTransformer the service uses:
+    ``encode`` and ``get_sentence_embedding_dimension``.
+
+    The graph is loaded from ``onnx_dir`` (default ``<model_dir>/onnx``) and
+    exported/quantized there on first use if missing; if that directory is
+    read-only, under ``cache_dir`` instead (see resolve_onnx_dir).
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        quantized: bool = False,
+        onnx_dir: Optional[str] = None,
+        threads: int = 0,
+        cache_dir: str = os.path.join(os.path.expanduser("~"), ".cache", "onnx"),
+    ):
+        self.model_dir = model_dir
+        self.quantized = quantized
+        filename = "model_int8.onnx" if quantized else "model.onnx"
+        onnx_dir = resolve_onnx_dir(model_dir, onnx_dir, filename, cache_dir)
+
+        fp32_path = os.path.join(onnx_dir, "model.onnx")
+        self.path = os.path.join(onnx_dir, filename)
+        if not os.path.exists(self.path):
+            if not os.path.exists(fp32_path):
+                export_onnx(model_dir, fp32_path)
+            if quantized:
+                quantize_int8(fp32_path, self.path)
+
+        self._load_pipeline_config()
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.max_seq_length)
+        self.tokenizer.no_padding()
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.dimension = self._detect_dimension()
+
+        logger.info(
+            f"ONNX encoder ready: {self.path} (int8={quantized}, pooling={self.pooling}, "
+            f"normalize={self.normalize}, max_seq_length={self.max_seq_length})"
+        )
+
+    def _load_pipeline_config(self):
+        """Mirror the SentenceTransformer module pipeline (pooling, normalize, max length)"""
+        self.pooling = "mean"
+        self.normalize = False
+        self.max_seq_length = 256
+
+        modules_path = os.path.join(self.model_dir, "modules.json")
+        modules = _read_json(modules_path) if os.path.exists(modules_path) else []
+        for module in modules:
+            kind = module.get("type", "")
+            path = os.path.join(self.model_dir, module.get("path", ""))
+            if kind.endswith("Pooling"):
+                config = _read_json(os.path.join(path, "config.json"))
+                if config.get("pooling_mode_cls_token"):
+                    self.pooling = "cls"
+                elif config.get("pooling_mode_max_tokens"):
+                    self.pooling = "max"
+                elif not config.get("pooling_mode_mean_tokens", True):
+                    raise ValueError(f"Unsupported pooling config for ONNX backend: {config}")
+            elif kind.endswith("Normalize"):
+                self.normalize = True
+
+        st_config = os.path.join(self.model_dir, "sentence_bert_config.json")
+        if os.path.exists(st_config):
+            self.max_seq_length = _read_json(st_config).get("max_seq_length", self.max_seq_length)
+
+    def _detect_dimension(self) -> int:
+        """Embedding width: static graph output, else config.json, else a probe run"""
+        dimension = self.session.get_outputs()[0].shape[-1]
+        if isinstance(dimension, int):
+            return dimension
+        config_path = os.path.join(self.model_dir, "config.json")
+        if os.path.exists(config_path):
+            hidden_size = _read_json(config_path).get("hidden_size")
+            if isinstance(hidden_size, int):
+                return hidden_size
+        # Symbolic output dim: run the graph once (not encode(), which needs the width)
+        return int(self._encode_batch(["dimension probe"]).shape[1])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        length = max(len(e.ids) for e in encodings)
+
+        input_ids = np.zeros((len(texts), length), dtype=np.int64)
+        attention_mask = np.zeros((len(texts), length), dtype=np.int64)
+        token_type_ids = np.zeros((len(texts), length), dtype=np.int64)
+        for row, encoding in enumerate(encodings):
+            n = len(encoding.ids)
+            input_ids[row, :n] = encoding.ids
+            attention_mask[row, :n] = encoding.attention_mask
+            token_type_ids[row, :n] = encoding.type_ids
+
+        feeds = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": token_type_ids,
+        }
+        hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self.input_names})[0]
+
+        mask = attention_mask[:, :, None].astype(np.float32)
+        if self.pooling == "cls":
+            pooled = hidden[:, 0]
+        elif self.pooling == "max":
+            pooled = np.where(mask > 0, hidden, -1e9).max(axis=1)
+        else:
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self.normalize:
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            pooled = pooled / np.clip(norms, 1e-12, None)
+        return pooled.astype(np.float32)
+
+    def encode(self, texts: List[str], batch_size: int = 32, convert_to_numpy: bool = True) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        # Sort by length so each sub-batch pads to similar lengths, then restore order
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        out = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+            out[idx] = self._encode_batch([texts[i] for i in idx])
+        return out
+
+
+def parity_check(reference, candidate, texts: List[str] = PARITY_TEXTS) -> float:
+    """Minimum cosine similarity between two encoders over ``texts``"""
+    a = np.asarray(reference.encode(texts, convert_to_numpy=True), dtype=np.float32)
+    b = np.asarray(candidate.encode(texts, convert_to_numpy=True), dtype=np.float32)
+    a /= np.linalg.norm(a, axis=1, keepdims=True)
+    b /= np.linalg.norm(b, axis=1, keepdims=True)
+    return float(np.min(np.sum(a * b, axis=1)))
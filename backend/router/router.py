@@ -4,18 +4,29 @@ Routes requests to GPU (priority) with CPU fallback based on load
 """
 
 import os
+import math
+import hashlib
 import time
+import random
+import bisect
+import socket
 import asyncio
+import json
 import logging
-from typing import Optional, Dict, Any
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, Callable, Deque, List, Tuple
+from urllib.parse import urlsplit
 from datetime import datetime, timedelta
 from enum import Enum
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask, BackgroundTasks
 import httpx
+import redis
+import redis.asyncio as aioredis
 
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
 from fastapi.responses import Response
@@ -26,12 +37,70 @@ from fastapi.responses import Response
 
 GPU_URL = os.getenv("GPU_URL", "http://counselgpt-api-gpu:8000")
 CPU_URL = os.getenv("CPU_URL", "http://counselgpt-api-cpu:8000")
+# Replica pools: static comma-separated lists (default: the single *_URL) ...
+GPU_URLS = [u.strip() for u in os.getenv("GPU_URLS", GPU_URL).split(",") if u.strip()]
+CPU_URLS = [u.strip() for u in os.getenv("CPU_URLS", CPU_URL).split(",") if u.strip()]
+# ... or DNS discovery of a headless service, e.g. "counselgpt-api-gpu-headless:8000"
+GPU_DISCOVERY_DNS = os.getenv("GPU_DISCOVERY_DNS", "")
+CPU_DISCOVERY_DNS = os.getenv("CPU_DISCOVERY_DNS", "")
+DISCOVERY_INTERVAL = int(os.getenv("DISCOVERY_INTERVAL", "30"))
+# Replica selection: "p2c" (power of two choices) or "least_outstanding"
+LB_POLICY = os.getenv("LB_POLICY", "p2c").lower()
+# chash policy: virtual nodes per replica and the bounded-load factor (max load = factor x average)
+CHASH_VNODES = int(os.getenv("CHASH_VNODES", "100"))
+CHASH_LOAD_FACTOR = float(os.getenv("CHASH_LOAD_FACTOR", "1.25"))
 GPU_MAX_INFLIGHT = int(os.getenv("GPU_MAX_INFLIGHT", "20"))
+GPU_MAX_QUEUE = int(os.getenv("GPU_MAX_QUEUE", "50"))
+# Priority classes "name:weight:shed_after" (X-Priority header / priority field). Weights share GPU
+# slots by weighted fair queuing; a class with shed_after > 0 is refused (429/503 + Retry-After)
+# instead of waiting longer than that or falling back to CPU.
+PRIORITY_CLASSES = os.getenv("PRIORITY_CLASSES", "interactive:8:0,batch:2:30,eval:1:10")
+DEFAULT_PRIORITY = os.getenv("DEFAULT_PRIORITY", "interactive")
+# Adaptive GPU concurrency: "gradient", "aimd" or "static" (fixed at GPU_MAX_INFLIGHT)
+GPU_LIMIT_ALGORITHM = os.getenv("GPU_LIMIT_ALGORITHM", "gradient").lower()
+GPU_MIN_INFLIGHT = int(os.getenv("GPU_MIN_INFLIGHT", "1"))
+GPU_INITIAL_INFLIGHT = int(os.getenv("GPU_INITIAL_INFLIGHT", "4"))
+GPU_LIMIT_AIMD_TIMEOUT = float(os.getenv("GPU_LIMIT_AIMD_TIMEOUT", "30.0"))
+DEFAULT_LATENCY_BUDGET = float(os.getenv("DEFAULT_LATENCY_BUDGET", "30.0"))
+GPU_SERVICE_TIME_INITIAL = float(os.getenv("GPU_SERVICE_TIME_INITIAL", "10.0"))
+CPU_SERVICE_TIME_INITIAL = float(os.getenv("CPU_SERVICE_TIME_INITIAL", "60.0"))
+SERVICE_TIME_EWMA_ALPHA = float(os.getenv("SERVICE_TIME_EWMA_ALPHA", "0.2"))
 BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", "60.0"))
 HEALTH_CHECK_INTERVAL = int(os.getenv("HEALTH_CHECK_INTERVAL", "10"))
 CIRCUIT_BREAKER_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "5"))
 CIRCUIT_BREAKER_TIMEOUT = int(os.getenv("CIRCUIT_BREAKER_TIMEOUT", "30"))
 
+# Request hedging: a second attempt once the first is slower than the tier's recent percentile
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2.0"))
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))  # Max share of requests that may hedge
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# Exact-match lookup in the API's shared Redis response cache (empty REDIS_URL disables it)
+REDIS_URL = os.getenv("REDIS_URL", "")
+ROUTER_CACHE = os.getenv("ROUTER_CACHE", "true").lower() == "true"
+ROUTER_CACHE_TIMEOUT = float(os.getenv("ROUTER_CACHE_TIMEOUT", "0.05"))
+ROUTER_CACHE_RETRY = float(os.getenv("ROUTER_CACHE_RETRY", "5.0"))
+
+# Per-client token buckets, charged by requested max_tokens (shared across replicas via REDIS_URL)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+RATE_LIMIT_TOKENS_PER_SEC = float(os.getenv("RATE_LIMIT_TOKENS_PER_SEC", "50"))  # Refill, in max_tokens units
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "4000"))
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))  # Trusted proxies appending X-Forwarded-For
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+RATE_LIMIT_TIMEOUT = float(os.getenv("RATE_LIMIT_TIMEOUT", "0.05"))
+RATE_LIMIT_RETRY = float(os.getenv("RATE_LIMIT_RETRY", "5.0"))
+# Comma-separated API keys that are never limited (benchmark / evaluation traffic)
+RATE_LIMIT_EXEMPT_KEYS = [k.strip() for k in os.getenv("RATE_LIMIT_EXEMPT_KEYS", "").split(",") if k.strip()]
+
+# Connection pooling (one long-lived client per backend)
+ROUTER_MAX_CONNECTIONS = int(os.getenv("ROUTER_MAX_CONNECTIONS", "100"))
+ROUTER_MAX_KEEPALIVE = int(os.getenv("ROUTER_MAX_KEEPALIVE", "20"))
+ROUTER_KEEPALIVE_EXPIRY = float(os.getenv("ROUTER_KEEPALIVE_EXPIRY", "30.0"))
+ROUTER_HTTP2 = os.getenv("ROUTER_HTTP2", "false").lower() == "true"
+
 # =====================================================
 # Logging
 # =====================================================
@@ -60,6 +129,13 @@ requests_duration = Histogram(
     buckets=(1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300, 360, 420, 480, 540, 600)  # Up to 10 min
 )
 
+time_to_first_byte = Histogram(
+    'router_time_to_first_byte_seconds',
+    'Time from forwarding a request to the first body byte from the backend',
+    ['backend'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 180)
+)
+
 gpu_queue_size = Gauge(
     'router_gpu_queue_size',
     'Current GPU queue size'
@@ -67,7 +143,30 @@ gpu_queue_size = Gauge(
 
 gpu_capacity = Gauge(
     'router_gpu_capacity',
-    'GPU available capacity'
+    'Current GPU concurrency limit (adaptive)'
+)
+
+gpu_available_slots = Gauge(
+    'router_gpu_available_slots',
+    'GPU slots currently free under the concurrency limit'
+)
+
+gpu_wait_queue_depth = Gauge(
+    'router_gpu_wait_queue_depth',
+    'Requests waiting for a GPU slot'
+)
+
+gpu_wait_seconds = Histogram(
+    'router_gpu_wait_seconds',
+    'Time spent waiting for a GPU slot',
+    ['outcome'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+)
+
+service_time_estimate = Gauge(
+    'router_service_time_estimate_seconds',
+    'Smoothed observed service time per backend (used for admission decisions)',
+    ['backend']
 )
 
 backend_health = Gauge(
@@ -82,12 +181,96 @@ circuit_breaker_state = Gauge(
     ['backend']
 )
 
+connection_pool_connections = Gauge(
+    'router_connection_pool_connections',
+    'Pooled backend connections by state',
+    ['backend', 'state']
+)
+
+connection_pool_pending = Gauge(
+    'router_connection_pool_pending_requests',
+    'Requests waiting for a pooled backend connection',
+    ['backend']
+)
+
+replica_outstanding = Gauge(
+    'router_replica_outstanding_requests',
+    'Requests currently outstanding per backend replica',
+    ['backend']
+)
+
+priority_queue_depth = Gauge(
+    'router_priority_queue_depth',
+    'Requests waiting for a GPU slot per priority class',
+    ['priority']
+)
+
+priority_wait_seconds = Histogram(
+    'router_priority_wait_seconds',
+    'Time spent waiting for a GPU slot per priority class',
+    ['priority'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+)
+
+shed_total = Counter(
+    'router_shed_total',
+    'Requests refused by load shedding',
+    ['priority', 'reason']
+)
+
+rate_limited_total = Counter(
+    'router_rate_limited_total',
+    'Requests refused by per-client rate limiting (local fast path or shared Redis bucket)',
+    ['source']
+)
+
+rate_limit_errors = Counter(
+    'router_rate_limit_errors_total',
+    'Shared rate-limit bucket updates that failed (local buckets enforce alone meanwhile)'
+)
+
 fallback_count = Counter(
     'router_fallback_total',
     'Total fallback from GPU to CPU',
     ['reason']
 )
 
+affinity_spills = Counter(
+    'router_affinity_spills_total',
+    'Hashed requests sent past their home replica on the ring',
+    ['backend', 'reason']
+)
+
+hedges_fired = Counter(
+    'router_hedges_fired_total',
+    'Second attempts sent because the first was slower than the hedge delay',
+    ['backend']
+)
+
+hedges_won = Counter(
+    'router_hedges_won_total',
+    'Hedged requests answered by the second attempt',
+    ['backend']
+)
+
+hedges_skipped = Counter(
+    'router_hedges_skipped_total',
+    'Hedges due but not sent',
+    ['reason']
+)
+
+hedge_delay_seconds = Gauge(
+    'router_hedge_delay_seconds',
+    'Current hedge delay (HEDGE_PERCENTILE of recent response-header latency)',
+    ['backend']
+)
+
+cache_lookups = Counter(
+    'router_cache_lookups_total',
+    'Router-side response cache lookups (hits are answered without a backend)',
+    ['result']
+)
+
 # =====================================================
 # Circuit Breaker
 # =====================================================
@@ -157,10 +340,11 @@ class CircuitBreaker:
 class BackendHealthMonitor:
     """Monitor backend health with periodic checks"""
     
-    def __init__(self, name: str, url: str, check_interval: int = 10):
+    def __init__(self, name: str, url: str, check_interval: int = 10, client: Optional[httpx.AsyncClient] = None):
         self.name = name
         self.url = url
         self.check_interval = check_interval
+        self.client = client  # Shared pooled client of the tier
         self.is_healthy = True
         self.last_check: Optional[datetime] = None
         self.consecutive_failures = 0
@@ -168,17 +352,16 @@ class BackendHealthMonitor:
     async def check_health(self) -> bool:
         """Perform health check"""
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.url}/health")
+            response = await self.client.get(f"{self.url}/health", timeout=5.0)
+            
+            if response.status_code == 200:
+                self.is_healthy = True
+                self.consecutive_failures = 0
+                backend_health.labels(backend=self.name).set(1)
+                return True
+            else:
+                raise Exception(f"Health check returned {response.status_code}")
                 
-                if response.status_code == 200:
-                    self.is_healthy = True
-                    self.consecutive_failures = 0
-                    backend_health.labels(backend=self.name).set(1)
-                    return True
-                else:
-                    raise Exception(f"Health check returned {response.status_code}")
-                    
         except Exception as e:
             self.consecutive_failures += 1
             logger.warning(
@@ -201,6 +384,908 @@ class BackendHealthMonitor:
             await self.check_health()
             await asyncio.sleep(self.check_interval)
 
+# =====================================================
+# Backend Pools
+# =====================================================
+
+class Replica:
+    """One backend pod: its own circuit breaker, health monitor and outstanding count"""
+    
+    def __init__(self, tier: str, name: str, url: str, client: httpx.AsyncClient):
+        self.tier = tier
+        self.name = name
+        self.url = url
+        self.client = client
+        self.outstanding = 0
+        self.breaker = CircuitBreaker(name, CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_TIMEOUT)
+        self.monitor = BackendHealthMonitor(name, url, HEALTH_CHECK_INTERVAL, client)
+        self.task: Optional[asyncio.Task] = None
+    
+    @property
+    def available(self) -> bool:
+        return self.monitor.is_healthy and self.breaker.can_attempt()
+    
+    def begin(self):
+        self.outstanding += 1
+        replica_outstanding.labels(backend=self.name).set(self.outstanding)
+    
+    def end(self):
+        self.outstanding -= 1
+        replica_outstanding.labels(backend=self.name).set(self.outstanding)
+    
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "healthy": self.monitor.is_healthy,
+            "circuit_breaker": self.breaker.state.name,
+            "outstanding": self.outstanding,
+        }
+
+def stable_hash(value: str) -> int:
+    """Stable across processes (unlike hash()), so every router replica agrees"""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+def rendezvous_score(key: str, node: str) -> int:
+    return stable_hash(f"{key}|{node}")
+
+def session_key(request: Request, payload: dict) -> Optional[str]:
+    """Conversation id from the body (session_id) or the X-Session-ID header"""
+    value = payload.get("session_id") or request.headers.get("x-session-id")
+    return str(value) if value else None
+
+def prompt_key(payload: dict) -> Optional[str]:
+    """Normalized prompt (case and whitespace folded), so near-identical prompts share a replica"""
+    messages = payload.get("messages")
+    if isinstance(messages, list) and messages:
+        text = "\n".join(str(m.get("content", "")) for m in messages if isinstance(m, dict))
+    else:
+        text = payload.get("prompt")
+    if not isinstance(text, str) or not text.strip():
+        return None
+    return " ".join(text.lower().split())
+
+class BackendPool:
+    """
+    Replicas of one tier (gpu/cpu), from a static URL list or DNS discovery
+    of a headless service, with least-outstanding or power-of-two-choices
+    selection among healthy replicas.
+    
+    chash routes keyed requests (session id, else normalized prompt) on a
+    consistent-hash ring with bounded loads: a replica already above
+    CHASH_LOAD_FACTOR x the average outstanding requests, or unavailable,
+    spills the request to the next replica on the ring.
+    """
+    
+    def __init__(self, tier: str, urls: List[str], discovery_dns: str = "", policy: str = "p2c"):
+        if policy not in ("p2c", "least_outstanding", "chash"):
+            logger.warning(f"Unknown LB_POLICY '{policy}', using p2c")
+            policy = "p2c"
+        self.tier = tier
+        self.static_urls = urls
+        self.discovery_dns = discovery_dns
+        self.policy = policy
+        self.replicas: Dict[str, Replica] = {}
+        # Consistent-hash ring: sorted virtual-node hashes and the replica URL of each
+        self._ring_hashes: List[int] = []
+        self._ring_urls: List[str] = []
+        self.client: Optional[httpx.AsyncClient] = None
+        self._discovery_task: Optional[asyncio.Task] = None
+    
+    def _replica_name(self, url: str) -> str:
+        # Keep the plain tier name for the classic single-URL setup (dashboards key on it)
+        if not self.discovery_dns and len(self.static_urls) == 1:
+            return self.tier
+        return f"{self.tier}@{urlsplit(url).netloc}"
+    
+    async def _discover(self) -> List[str]:
+        if not self.discovery_dns:
+            return self.static_urls
+        host, _, port = self.discovery_dns.partition(":")
+        port = int(port or 8000)
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        urls = set()
+        for family, _, _, _, sockaddr in infos:
+            ip = sockaddr[0]
+            urls.add(f"http://[{ip}]:{port}" if family == socket.AF_INET6 else f"http://{ip}:{port}")
+        return sorted(urls)
+    
+    async def refresh(self):
+        """Reconcile replicas with discovery (keeps the current set if DNS fails or is empty)"""
+        try:
+            urls = await self._discover()
+        except Exception as e:
+            logger.warning(f"{self.tier} discovery failed: {e}")
+            return
+        if not urls:
+            return
+        
+        for url in urls:
+            if url not in self.replicas:
+                replica = Replica(self.tier, self._replica_name(url), url, self.client)
+                self.replicas[url] = replica
+                await replica.monitor.check_health()
+                replica.task = asyncio.create_task(replica.monitor.start_monitoring())
+                logger.info(f"➕ {self.tier} replica added: {url}")
+        for url in list(self.replicas):
+            if url not in urls:
+                replica = self.replicas.pop(url)
+                if replica.task:
+                    replica.task.cancel()
+                logger.info(f"➖ {self.tier} replica removed: {url}")
+        self._rebuild_ring()
+    
+    def _rebuild_ring(self):
+        points = sorted(
+            (stable_hash(f"{url}#{i}"), url) for url in self.replicas for i in range(CHASH_VNODES)
+        )
+        self._ring_hashes = [h for h, _ in points]
+        self._ring_urls = [url for _, url in points]
+    
+    async def _discovery_loop(self):
+        while True:
+            await asyncio.sleep(DISCOVERY_INTERVAL)
+            await self.refresh()
+    
+    async def start(self):
+        self.client = create_backend_client()
+        backend_clients[self.tier] = self.client
+        await self.refresh()
+        if self.discovery_dns:
+            self._discovery_task = asyncio.create_task(self._discovery_loop())
+    
+    async def stop(self):
+        if self._discovery_task:
+            self._discovery_task.cancel()
+        for replica in self.replicas.values():
+            if replica.task:
+                replica.task.cancel()
+        if self.client:
+            await self.client.aclose()
+    
+    @property
+    def is_healthy(self) -> bool:
+        return any(r.monitor.is_healthy for r in self.replicas.values())
+    
+    def has_available(self) -> bool:
+        return any(r.available for r in self.replicas.values())
+    
+    def unavailable_reason(self) -> str:
+        return "unhealthy" if not self.is_healthy else "circuit_open"
+    
+    def pick(
+        self,
+        healthy_only: bool = True,
+        affinity_key: Optional[str] = None,
+        exclude: Optional[Replica] = None,
+    ) -> Optional[Replica]:
+        """
+        Choose a replica by policy; with healthy_only=False fall back to any replica.
+        ``exclude`` skips a replica already tried (hedging).
+        An affinity key (conversation session) pins the choice by rendezvous
+        hashing, so it only moves when its replica leaves or becomes unavailable.
+        """
+        candidates = [r for r in self.replicas.values() if r.available and r is not exclude]
+        if not candidates and not healthy_only:
+            candidates = [r for r in self.replicas.values() if r is not exclude]
+        if not candidates:
+            return None
+        if affinity_key and self.policy == "chash":
+            return self._ring_pick(affinity_key, candidates)
+        if affinity_key:
+            return max(candidates, key=lambda r: rendezvous_score(affinity_key, r.url))
+        if self.policy == "p2c" and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        lowest = min(r.outstanding for r in candidates)
+        return random.choice([r for r in candidates if r.outstanding == lowest])
+    
+    def _ring_pick(self, key: str, candidates: List[Replica]) -> Replica:
+        """First replica clockwise from the key's hash that is a candidate and under the load bound"""
+        eligible = {r.url: r for r in candidates}
+        # +1 counts the request being placed, so some replica is always under the bound
+        bound = math.ceil(CHASH_LOAD_FACTOR * (sum(r.outstanding for r in candidates) + 1) / len(candidates))
+        start = bisect.bisect(self._ring_hashes, stable_hash(key))
+        seen = set()
+        reason = None
+        for i in range(len(self._ring_urls)):
+            url = self._ring_urls[(start + i) % len(self._ring_urls)]
+            if url in seen:
+                continue
+            seen.add(url)
+            replica = eligible.get(url)
+            if replica is None:
+                reason = reason or "unavailable"
+            elif replica.outstanding + 1 > bound:
+                reason = reason or "overloaded"
+            else:
+                if reason:
+                    affinity_spills.labels(backend=self.tier, reason=reason).inc()
+                return replica
+            if len(seen) == len(self.replicas):
+                break
+        return min(candidates, key=lambda r: r.outstanding)
+    
+    def status(self) -> dict:
+        return {
+            "healthy": self.is_healthy,
+            "policy": self.policy,
+            "discovery": self.discovery_dns or "static",
+            "replicas": [r.status() for r in self.replicas.values()],
+        }
+
+# =====================================================
+# Admission Control
+# =====================================================
+
+class ServiceTimeEstimator:
+    """Exponentially weighted moving average of observed service times"""
+    
+    def __init__(self, name: str, initial: float, alpha: float = 0.2):
+        self.name = name
+        self.alpha = alpha
+        self.value = initial
+        service_time_estimate.labels(backend=name).set(initial)
+    
+    def observe(self, seconds: float):
+        self.value = self.alpha * seconds + (1 - self.alpha) * self.value
+        service_time_estimate.labels(backend=self.name).set(self.value)
+
+class AdaptiveConcurrencyLimit:
+    """
+    In-flight limit adjusted from measured latency.
+    
+    Latency samples are normalized by the requested max_tokens so a mix of
+    short and long generations does not look like congestion.
+    
+    gradient: Netflix gradient-style. Compares the windowed minimum latency
+        with the recent (EWMA) latency; the limit shrinks as latency inflates
+        and grows by sqrt(limit) headroom while latency stays flat.
+    aimd: +1 per successful sample while the limit is in use, x0.9 on errors
+        or requests slower than GPU_LIMIT_AIMD_TIMEOUT.
+    static: fixed at max_limit.
+    """
+    
+    def __init__(
+        self,
+        algorithm: str,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        aimd_timeout: float = 30.0,
+        smoothing: float = 0.2,
+        probe_interval: int = 200,
+    ):
+        if algorithm not in ("gradient", "aimd", "static"):
+            logger.warning(f"Unknown GPU_LIMIT_ALGORITHM '{algorithm}', using gradient")
+            algorithm = "gradient"
+        self.algorithm = algorithm
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.aimd_timeout = aimd_timeout
+        self.smoothing = smoothing
+        initial = max_limit if algorithm == "static" else initial
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self.probe_interval = probe_interval
+        self.short_rtt: Optional[float] = None
+        self.min_rtt: Optional[float] = None
+        self._samples = 0
+    
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+    
+    def on_sample(self, latency: float, inflight: int, cost: float = 1.0, dropped: bool = False):
+        """Record one completed request (``cost`` ~ requested tokens)"""
+        if self.algorithm == "static":
+            return
+        if self.algorithm == "aimd":
+            self._aimd(latency, inflight, dropped)
+        else:
+            self._gradient(latency / max(cost, 1.0), inflight, dropped)
+        self._limit = min(max(self._limit, self.min_limit), self.max_limit)
+    
+    def _aimd(self, latency: float, inflight: int, dropped: bool):
+        if dropped or latency > self.aimd_timeout:
+            self._limit *= 0.9
+        elif inflight * 2 >= self._limit:
+            self._limit += 1.0
+    
+    def _gradient(self, rtt: float, inflight: int, dropped: bool):
+        self.short_rtt = rtt if self.short_rtt is None else 0.5 * rtt + 0.5 * self.short_rtt
+        
+        # Periodically halve the limit and re-learn the no-load latency, so the
+        # baseline can follow model/hardware changes without ratcheting upwards
+        self._samples += 1
+        if self._samples >= self.probe_interval:
+            self._samples = 0
+            self.min_rtt = None
+            self._limit = max(self.min_limit, self._limit / 2)
+            return
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        
+        # Application-limited: no evidence the limit is too low
+        if not dropped and inflight < self._limit / 2:
+            return
+        
+        gradient = 0.5 if dropped else max(0.5, min(1.0, self.min_rtt / self.short_rtt))
+        new_limit = self._limit * gradient + math.sqrt(self._limit)
+        self._limit = (1 - self.smoothing) * self._limit + self.smoothing * new_limit
+
+class PriorityClass:
+    def __init__(self, name: str, weight: float, shed_after: float):
+        self.name = name
+        self.weight = weight
+        self.shed_after = shed_after  # 0 = never shed
+    
+    @property
+    def sheddable(self) -> bool:
+        return self.shed_after > 0
+
+def parse_priority_classes(spec: str) -> Dict[str, PriorityClass]:
+    classes = {}
+    for item in spec.split(","):
+        parts = item.strip().split(":")
+        if not parts[0]:
+            continue
+        try:
+            weight = float(parts[1]) if len(parts) > 1 else 1.0
+            shed_after = float(parts[2]) if len(parts) > 2 else 0.0
+        except ValueError:
+            logger.warning(f"Ignoring malformed PRIORITY_CLASSES entry '{item}'")
+            continue
+        classes[parts[0].lower()] = PriorityClass(parts[0].lower(), max(weight, 0.01), shed_after)
+    if not classes:
+        classes["interactive"] = PriorityClass("interactive", 1.0, 0.0)
+    return classes
+
+class GpuAdmissionQueue:
+    """
+    Bounded queue of requests waiting for a GPU slot, weighted-fair across
+    priority classes.
+    
+    Requests either get a slot immediately, wait up to a deadline, or are
+    refused when the queue is full. Each waiter gets a virtual finish tag
+    (start-time fair queuing): classes receive freed slots in proportion to
+    their weight, and a busy low-weight class can't starve the others. The
+    expected wait counts the waiters that would be served ahead of a new
+    request of the given class.
+    """
+    
+    def __init__(
+        self,
+        limiter: AdaptiveConcurrencyLimit,
+        max_queue: int,
+        service_time: ServiceTimeEstimator,
+        classes: Dict[str, PriorityClass],
+    ):
+        self.limiter = limiter
+        self.max_queue = max_queue
+        self.service_time = service_time
+        self.classes = classes
+        self.inflight = 0
+        self._waiters: Dict[str, Deque[Tuple[float, asyncio.Future]]] = {name: deque() for name in classes}
+        self._last_tag: Dict[str, float] = {name: 0.0 for name in classes}
+        # Finish tag of the last admitted waiter per class (tags of refused waiters are rolled back to it)
+        self._served_tag: Dict[str, float] = {name: 0.0 for name in classes}
+        self._virtual_time = 0.0
+        self._total_weight = sum(c.weight for c in classes.values())
+    
+    @property
+    def limit(self) -> int:
+        return self.limiter.limit
+    
+    @property
+    def available(self) -> int:
+        return max(0, self.limit - self.inflight)
+    
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self._waiters.values())
+    
+    def depth_by_priority(self) -> Dict[str, int]:
+        return {name: len(q) for name, q in self._waiters.items()}
+    
+    def _next_tag(self, priority: PriorityClass) -> float:
+        return max(self._virtual_time, self._last_tag[priority.name]) + 1.0 / priority.weight
+    
+    def predicted_wait(self, priority: Optional[PriorityClass] = None) -> float:
+        """Expected time until a new request (of ``priority``) would get a slot"""
+        depth = self.depth
+        if self.available > 0 and not depth:
+            return 0.0
+        if priority is None:
+            ahead = depth
+        else:
+            tag = self._next_tag(priority)
+            ahead = sum(1 for q in self._waiters.values() for t, _ in q if t <= tag)
+        # Slots free up at roughly limit / service_time per second
+        return (ahead + 1) * self.service_time.value / max(self.limit, 1)
+    
+    def class_full(self, priority: PriorityClass) -> bool:
+        """Sheddable classes may hold at most their weight share of the queue"""
+        if not priority.sheddable:
+            return self.depth >= self.max_queue
+        share = max(1, int(self.max_queue * priority.weight / self._total_weight))
+        return len(self._waiters[priority.name]) >= share or self.depth >= self.max_queue
+    
+    def _update_gauges(self):
+        gpu_capacity.set(self.limit)
+        gpu_available_slots.set(self.available)
+        gpu_queue_size.set(self.inflight)
+        gpu_wait_queue_depth.set(self.depth)
+        for name, queue in self._waiters.items():
+            priority_queue_depth.labels(priority=name).set(len(queue))
+    
+    def try_acquire(self) -> bool:
+        if self.inflight < self.limit and not self.depth:
+            self.inflight += 1
+            self._update_gauges()
+            return True
+        return False
+    
+    async def acquire(self, timeout: float, priority: PriorityClass) -> bool:
+        """Wait up to ``timeout`` seconds for a slot (weighted fair). Returns False if refused or timed out"""
+        if self.try_acquire():
+            gpu_wait_seconds.labels(outcome="immediate").observe(0)
+            priority_wait_seconds.labels(priority=priority.name).observe(0)
+            return True
+        if timeout <= 0 or self.class_full(priority):
+            return False
+        
+        waiter = asyncio.get_running_loop().create_future()
+        tag = self._next_tag(priority)
+        self._last_tag[priority.name] = tag
+        entry = (tag, waiter)
+        self._waiters[priority.name].append(entry)
+        self._update_gauges()
+        start = time.time()
+        admitted = False
+        try:
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                # The slot may have been granted as the timeout fired: it is ours, keep it
+                if not waiter.done() or waiter.cancelled():
+                    gpu_wait_seconds.labels(outcome="timeout").observe(time.time() - start)
+                    return False
+            admitted = True
+            gpu_wait_seconds.labels(outcome="admitted").observe(time.time() - start)
+            priority_wait_seconds.labels(priority=priority.name).observe(time.time() - start)
+            return True
+        except asyncio.CancelledError:
+            # Slot may have been handed over just before the caller went away
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            queue = self._waiters[priority.name]
+            if entry in queue:
+                queue.remove(entry)
+            if not admitted:
+                # A refused waiter consumed no service: don't push back later requests of its class
+                self._last_tag[priority.name] = max([t for t, _ in queue] + [self._served_tag[priority.name]])
+            self._update_gauges()
+    
+    def release(self, latency: Optional[float] = None, cost: float = 1.0, dropped: bool = False):
+        """Free a slot; a latency sample (or drop) also adjusts the concurrency limit"""
+        if latency is not None or dropped:
+            self.limiter.on_sample(latency or 0.0, self.inflight, cost, dropped)
+        self.inflight -= 1
+        self._dispatch()
+        self._update_gauges()
+    
+    def _dispatch(self):
+        """Hand free slots to the waiter with the smallest finish tag across classes"""
+        while self.inflight < self.limit:
+            heads = [name for name, q in self._waiters.items() if q]
+            if not heads:
+                return
+            name = min(heads, key=lambda n: self._waiters[n][0][0])
+            tag, waiter = self._waiters[name].popleft()
+            if waiter.done():
+                continue
+            self._virtual_time = tag
+            self._served_tag[name] = tag
+            self.inflight += 1
+            waiter.set_result(True)
+
+def request_priority(request: Request, payload: dict) -> PriorityClass:
+    """Priority class from the X-Priority header or the priority field (unknown -> DEFAULT_PRIORITY)"""
+    name = str(request.headers.get("x-priority") or payload.get("priority") or DEFAULT_PRIORITY).lower()
+    return priority_classes.get(name) or priority_classes.get(DEFAULT_PRIORITY) or next(iter(priority_classes.values()))
+
+def gpu_retry_after() -> float:
+    """When a shed request could next find the GPU tier usable"""
+    if not gpu_pool.is_healthy:
+        return HEALTH_CHECK_INTERVAL
+    return CIRCUIT_BREAKER_TIMEOUT if not gpu_pool.has_available() else gpu_service_time.value
+
+def shed(priority: PriorityClass, reason: str, status_code: int, retry_after: float) -> HTTPException:
+    shed_total.labels(priority=priority.name, reason=reason).inc()
+    logger.info(f"🚫 Shedding {priority.name} request (reason: {reason}, retry after {retry_after:.0f}s)")
+    return HTTPException(
+        status_code=status_code,
+        detail=f"Overloaded: {priority.name} request shed ({reason}), retry later",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+# =====================================================
+# Request Hedging
+# =====================================================
+
+class LatencyWindow:
+    """Recent response-header latencies of one tier; its percentile is the hedge delay"""
+    
+    def __init__(self, name: str, size: int, min_samples: int):
+        self.name = name
+        self.min_samples = min_samples
+        self.samples: Deque[float] = deque(maxlen=size)
+    
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+    
+    def hedge_delay(self) -> Optional[float]:
+        """None until enough samples have been seen"""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        value = ordered[min(len(ordered) - 1, int(HEDGE_PERCENTILE * len(ordered)))]
+        delay = max(HEDGE_MIN_DELAY, value)
+        hedge_delay_seconds.labels(backend=self.name).set(delay)
+        return delay
+
+class HedgeBudget:
+    """Token bucket: every request earns ``ratio`` of a hedge, every hedge spends one"""
+    
+    def __init__(self, ratio: float, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+    
+    def earn(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+    
+    def try_spend(self) -> bool:
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+# =====================================================
+# Response Cache
+# =====================================================
+
+# Must match ResponseCache._generate_key in backend/api/cache.py
+CACHE_KEY_PREFIX = "llama:cache:"
+CACHE_MODELS = ("qwen", "llama")
+# Written next to "response" by ResponseCache.set (usage of the model that answered)
+CACHE_USAGE_FIELDS = ("model", "estimated_tokens", "context_window", "messages_in_context", "messages_truncated")
+
+def cache_prompt(payload: dict) -> Optional[str]:
+    """
+    The prompt the API caches this request under (app.infer builds it the
+    same way), or None if the API wouldn't serve it from cache unchanged.
+    """
+    if not isinstance(payload, dict) or payload.get("use_cache", True) is not True:
+        return None
+    if str(payload.get("model_name", "qwen")).lower() not in CACHE_MODELS:
+        return None
+    messages = payload.get("messages")
+    if messages:
+        lines = []
+        for msg in messages:
+            if not isinstance(msg, dict) or not isinstance(msg.get("content"), str) or not msg["content"]:
+                return None
+            role_label = "User" if msg.get("role") == "user" else "Assistant"
+            lines.append(f"{role_label}: {msg['content']}\n\n")
+        return "".join(lines) + "Assistant:"
+    prompt = payload.get("prompt")
+    if isinstance(prompt, str) and 0 < len(prompt) <= 4096:
+        return prompt
+    return None
+
+def cache_max_tokens(payload: dict) -> Optional[int]:
+    max_tokens = payload.get("max_tokens", 400)
+    if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or not 1 <= max_tokens <= 2048:
+        return None
+    return max_tokens
+
+class RouterCache:
+    """
+    Exact-match reads from the shared Redis response cache, so repeated
+    prompts are answered before admission and never reach a model pod.
+    Semantic matches still need the API's vector index.
+    Lookups are bounded by a short timeout; after an error the cache is
+    skipped for ROUTER_CACHE_RETRY seconds instead of slowing every request.
+    """
+    
+    def __init__(self, url: str, timeout: float, retry_after: float):
+        self.url = url
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.client: Optional[aioredis.Redis] = None
+        self.skip_until = 0.0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.client is not None
+    
+    async def start(self):
+        if self.url:
+            self.client = aioredis.from_url(
+                self.url, socket_timeout=self.timeout, socket_connect_timeout=self.timeout
+            )
+    
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    @staticmethod
+    def key(prompt: str, max_tokens: int) -> str:
+        content = f"{prompt}:{max_tokens}"
+        return f"{CACHE_KEY_PREFIX}{hashlib.sha256(content.encode()).hexdigest()}"
+    
+    async def _read(self, key: str) -> Optional[Dict[str, str]]:
+        """The cached response plus any usage fields stored with it (v2 entries)"""
+        try:
+            values = await self.client.hmget(key, "response", *CACHE_USAGE_FIELDS)
+        except redis.ResponseError:
+            # v1 entry stored as a plain string (JSON or text)
+            cached = await self.client.get(key)
+            if not cached:
+                return None
+            try:
+                data = json.loads(cached)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                data = None
+            if isinstance(data, dict):
+                return {"response": data["response"]} if data.get("response") else None
+            return {"response": cached.decode() if isinstance(cached, bytes) else cached}
+        if not values[0]:
+            return None
+        return {
+            name: value.decode() if isinstance(value, bytes) else value
+            for name, value in zip(("response",) + CACHE_USAGE_FIELDS, values)
+            if value is not None
+        }
+    
+    async def get(self, prompt: str, max_tokens: int) -> Optional[Dict[str, str]]:
+        if not self.enabled or time.time() < self.skip_until:
+            return None
+        try:
+            cached = await asyncio.wait_for(self._read(self.key(prompt, max_tokens)), self.timeout)
+        except Exception as e:
+            logger.warning(f"⚠️  Router cache lookup failed ({e!r}), skipping cache for {self.retry_after}s")
+            self.skip_until = time.time() + self.retry_after
+            cache_lookups.labels(result="error").inc()
+            return None
+        cache_lookups.labels(result="hit" if cached else "miss").inc()
+        return cached or None
+
+def cached_usage(payload: dict, entry: Dict[str, str]) -> Dict[str, int]:
+    """
+    Usage fields stored with the entry by the API, if the same model wrote it
+    (the router has no tokenizer; without them the fields are left out)
+    """
+    if entry.get("model") != str(payload.get("model_name", "qwen")).lower():
+        return {}
+    try:
+        return {name: int(entry[name]) for name in CACHE_USAGE_FIELDS[1:] if name in entry}
+    except ValueError:
+        return {}
+
+def cached_response(payload: dict, prompt: str, entry: Dict[str, str]) -> Response:
+    """A cache hit in the API's own response format (JSON, or SSE when streaming)"""
+    model_name = payload.get("model_name", "qwen")
+    text = entry["response"]
+    if payload.get("stream"):
+        events = [
+            {"token": text},
+            {"done": True, "cached": True, "model_used": model_name, "response_length": len(text)},
+        ]
+        return Response(
+            content="".join(f"data: {json.dumps(event)}\n\n" for event in events),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    body = {
+        "response": text,
+        "prompt_length": len(prompt),
+        "response_length": len(text),
+        "cached": True,
+        "model_used": model_name,
+        **cached_usage(payload, entry),
+        "coalesced": False,
+        "session_id": payload.get("session_id"),
+    }
+    return Response(content=json.dumps(body), media_type="application/json")
+
+# =====================================================
+# Rate Limiting
+# =====================================================
+
+RATE_LIMIT_KEY_PREFIX = "router:ratelimit:"
+
+# Atomic refill-and-take on the shared bucket. Uses the Redis clock so every
+# replica refills the same way; returns {allowed, tokens left}.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst / rate + 1) * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+def key_id(api_key: str) -> str:
+    return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:32]
+
+def client_id(request: Request) -> str:
+    """
+    Who to charge: the API key (X-API-Key or Authorization bearer, hashed)
+    if one is sent, else the client IP. With RATE_LIMIT_PROXY_HOPS trusted
+    proxies in front, the IP is the entry that many hops from the right of
+    X-Forwarded-For (earlier entries are client-supplied and spoofable).
+    """
+    api_key = request.headers.get("x-api-key")
+    auth = request.headers.get("authorization", "")
+    if not api_key and auth.lower().startswith("bearer "):
+        api_key = auth[7:].strip()
+    if api_key:
+        return key_id(api_key)
+    if RATE_LIMIT_PROXY_HOPS > 0:
+        hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(hops) >= RATE_LIMIT_PROXY_HOPS:
+            return "ip:" + hops[-RATE_LIMIT_PROXY_HOPS]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+class TokenBucket:
+    """Local view of one client's bucket (refilled lazily on access)"""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+    
+    def sync(self, tokens: float):
+        """Adopt the shared bucket's level after a Redis update"""
+        self.tokens = min(self.burst, tokens)
+        self.updated = time.monotonic()
+    
+    def wait_for(self, cost: float) -> float:
+        """Seconds until ``cost`` tokens are available"""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+class RateLimiter:
+    """
+    Per-client token buckets weighted by requested max_tokens.
+    
+    Each replica keeps in-memory buckets as a fast path: a client whose
+    local bucket is already empty is refused without a Redis round trip.
+    Otherwise the charge is applied atomically to the shared bucket in
+    Redis (TOKEN_BUCKET_LUA), which is authoritative across replicas, and
+    the local bucket adopts its level. If Redis is unset or failing, the
+    local buckets enforce the limit per replica and Redis is retried after
+    RATE_LIMIT_RETRY seconds.
+    """
+    
+    def __init__(self, enabled: bool, rate: float, burst: float, max_clients: int,
+                 url: str, timeout: float, retry_after: float, exempt_keys: List[str] = ()):
+        self.enabled = enabled and rate > 0 and burst > 0
+        self.exempt = {key_id(key) for key in exempt_keys}
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.url = url
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.client: Optional[aioredis.Redis] = None
+        self.script = None
+        self.skip_until = 0.0
+        # client id -> bucket, least recently seen first
+        self.buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+    
+    @property
+    def shared(self) -> bool:
+        return self.client is not None
+    
+    async def start(self):
+        if self.enabled and self.url:
+            self.client = aioredis.from_url(
+                self.url, socket_timeout=self.timeout, socket_connect_timeout=self.timeout
+            )
+            self.script = self.client.register_script(TOKEN_BUCKET_LUA)
+    
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    def _bucket(self, client: str) -> TokenBucket:
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        return bucket
+    
+    async def _take_shared(self, client: str, cost: float) -> Optional[Tuple[bool, float]]:
+        if time.time() < self.skip_until:
+            return None
+        try:
+            allowed, tokens = await asyncio.wait_for(
+                self.script(keys=[RATE_LIMIT_KEY_PREFIX + client], args=[self.rate, self.burst, cost]),
+                self.timeout,
+            )
+        except Exception as e:
+            logger.warning(f"⚠️  Shared rate limit failed ({e!r}), using local buckets for {self.retry_after}s")
+            self.skip_until = time.time() + self.retry_after
+            rate_limit_errors.inc()
+            return None
+        return bool(int(allowed)), float(tokens)
+    
+    async def check(self, client: str, max_tokens: int) -> Optional[float]:
+        """Charge ``max_tokens`` to ``client``; returns None if allowed, else seconds to wait"""
+        if not self.enabled or client in self.exempt:
+            return None
+        # A request larger than the burst could never pass; it just needs a full bucket
+        cost = min(float(max_tokens), self.burst)
+        bucket = self._bucket(client)
+        if bucket.refill() < cost:
+            rate_limited_total.labels(source="local").inc()
+            return bucket.wait_for(cost)
+        
+        shared = await self._take_shared(client, cost) if self.shared else None
+        if shared is None:
+            bucket.tokens -= cost
+            return None
+        allowed, tokens = shared
+        bucket.sync(tokens)
+        if not allowed:
+            rate_limited_total.labels(source="redis").inc()
+            return bucket.wait_for(cost)
+        return None
+    
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "shared": self.shared and time.time() >= self.skip_until,
+            "tokens_per_sec": self.rate,
+            "burst": self.burst,
+            "tracked_clients": len(self.buckets),
+            "exempt_keys": len(self.exempt),
+        }
+
+def latency_budget(request: Request, payload: dict) -> float:
+    """Per-request latency budget (X-Latency-Budget header or latency_budget field, seconds)"""
+    raw = request.headers.get("x-latency-budget", payload.get("latency_budget"))
+    try:
+        return float(raw) if raw is not None else DEFAULT_LATENCY_BUDGET
+    except (TypeError, ValueError):
+        return DEFAULT_LATENCY_BUDGET
+
 # =====================================================
 # FastAPI App
 # =====================================================
@@ -224,16 +1309,71 @@ app.add_middleware(
 # Global State
 # =====================================================
 
-# Semaphore to limit GPU concurrency
-gpu_semaphore = asyncio.Semaphore(GPU_MAX_INFLIGHT)
+# Service-time estimates feed the admission decision
+gpu_service_time = ServiceTimeEstimator("gpu", GPU_SERVICE_TIME_INITIAL, SERVICE_TIME_EWMA_ALPHA)
+cpu_service_time = ServiceTimeEstimator("cpu", CPU_SERVICE_TIME_INITIAL, SERVICE_TIME_EWMA_ALPHA)
 
-# Circuit breakers
-gpu_circuit_breaker = CircuitBreaker("gpu", CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_TIMEOUT)
-cpu_circuit_breaker = CircuitBreaker("cpu", CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_TIMEOUT)
+# Bounded wait queue limiting GPU concurrency (limit adapts to observed latency)
+gpu_limiter = AdaptiveConcurrencyLimit(
+    GPU_LIMIT_ALGORITHM,
+    initial=GPU_INITIAL_INFLIGHT,
+    min_limit=GPU_MIN_INFLIGHT,
+    max_limit=GPU_MAX_INFLIGHT,
+    aimd_timeout=GPU_LIMIT_AIMD_TIMEOUT,
+)
+priority_classes = parse_priority_classes(PRIORITY_CLASSES)
+gpu_admission = GpuAdmissionQueue(gpu_limiter, GPU_MAX_QUEUE, gpu_service_time, priority_classes)
+
+# Replica pools (each replica has its own circuit breaker and health monitor)
+gpu_pool = BackendPool("gpu", GPU_URLS, GPU_DISCOVERY_DNS, LB_POLICY)
+cpu_pool = BackendPool("cpu", CPU_URLS, CPU_DISCOVERY_DNS, LB_POLICY)
+
+# Hedge delays (per tier) and the share of traffic allowed to hedge
+header_latency: Dict[str, LatencyWindow] = {
+    tier: LatencyWindow(tier, HEDGE_WINDOW, HEDGE_MIN_SAMPLES) for tier in ("gpu", "cpu")
+}
+hedge_budget = HedgeBudget(HEDGE_BUDGET)
 
-# Health monitors
-gpu_health_monitor = BackendHealthMonitor("gpu", GPU_URL, HEALTH_CHECK_INTERVAL)
-cpu_health_monitor = BackendHealthMonitor("cpu", CPU_URL, HEALTH_CHECK_INTERVAL)
+# Shared response cache, read before admission
+response_cache = RouterCache(REDIS_URL if ROUTER_CACHE else "", ROUTER_CACHE_TIMEOUT, ROUTER_CACHE_RETRY)
+
+# Per-client token buckets, checked after the cache and before admission
+rate_limiter = RateLimiter(
+    RATE_LIMIT_ENABLED, RATE_LIMIT_TOKENS_PER_SEC, RATE_LIMIT_BURST, RATE_LIMIT_MAX_CLIENTS,
+    REDIS_URL, RATE_LIMIT_TIMEOUT, RATE_LIMIT_RETRY, RATE_LIMIT_EXEMPT_KEYS,
+)
+
+# =====================================================
+# Connection Pools
+# =====================================================
+
+# tier -> long-lived pooled client (created at startup, shared by the tier's replicas)
+backend_clients: Dict[str, httpx.AsyncClient] = {}
+
+def create_backend_client() -> httpx.AsyncClient:
+    """Pooled keep-alive client shared by forwarding and health checks."""
+    return httpx.AsyncClient(
+        timeout=BACKEND_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=ROUTER_MAX_CONNECTIONS,
+            max_keepalive_connections=ROUTER_MAX_KEEPALIVE,
+            keepalive_expiry=ROUTER_KEEPALIVE_EXPIRY,
+        ),
+        http2=ROUTER_HTTP2,
+    )
+
+def update_pool_metrics():
+    """Export connection-pool occupancy (reads httpcore pool internals, best effort)."""
+    for name, client in backend_clients.items():
+        try:
+            pool = client._transport._pool
+            connections = list(pool.connections)
+            idle = sum(1 for conn in connections if conn.is_idle())
+            connection_pool_connections.labels(backend=name, state="idle").set(idle)
+            connection_pool_connections.labels(backend=name, state="active").set(len(connections) - idle)
+            connection_pool_pending.labels(backend=name).set(len(getattr(pool, "_requests", [])))
+        except Exception as e:
+            logger.debug(f"Pool stats unavailable for {name}: {e}")
 
 # =====================================================
 # Startup/Shutdown
@@ -243,18 +1383,34 @@ cpu_health_monitor = BackendHealthMonitor("cpu", CPU_URL, HEALTH_CHECK_INTERVAL)
 async def startup_event():
     """Start background tasks"""
     logger.info("🚀 Router starting up...")
-    logger.info(f"   GPU URL: {GPU_URL}")
-    logger.info(f"   CPU URL: {CPU_URL}")
-    logger.info(f"   GPU max inflight: {GPU_MAX_INFLIGHT}")
+    logger.info(f"   GPU replicas: {GPU_DISCOVERY_DNS or ', '.join(GPU_URLS)}")
+    logger.info(f"   CPU replicas: {CPU_DISCOVERY_DNS or ', '.join(CPU_URLS)}")
+    logger.info(f"   Load balancing: {LB_POLICY}")
+    logger.info(f"   GPU max inflight: {GPU_MAX_INFLIGHT} (queue: {GPU_MAX_QUEUE})")
+    logger.info(
+        f"   GPU concurrency limit: {GPU_LIMIT_ALGORITHM} "
+        f"(initial={gpu_limiter.limit}, min={GPU_MIN_INFLIGHT}, max={GPU_MAX_INFLIGHT})"
+    )
+    logger.info(f"   Default latency budget: {DEFAULT_LATENCY_BUDGET}s")
     logger.info(f"   Backend timeout: {BACKEND_TIMEOUT}s")
+    logger.info(
+        f"   Connection pool: max={ROUTER_MAX_CONNECTIONS}, keepalive={ROUTER_MAX_KEEPALIVE}, "
+        f"expiry={ROUTER_KEEPALIVE_EXPIRY}s, http2={ROUTER_HTTP2}"
+    )
     
-    # Start health monitoring
-    asyncio.create_task(gpu_health_monitor.start_monitoring())
-    asyncio.create_task(cpu_health_monitor.start_monitoring())
-    
-    # Initial health checks
-    await gpu_health_monitor.check_health()
-    await cpu_health_monitor.check_health()
+    # Discover replicas, run initial health checks and start monitoring
+    await gpu_pool.start()
+    await cpu_pool.start()
+    await response_cache.start()
+    logger.info(f"   Router cache: {'on' if response_cache.enabled else 'off'}")
+    await rate_limiter.start()
+    if rate_limiter.enabled:
+        logger.info(
+            f"   Rate limit: {RATE_LIMIT_TOKENS_PER_SEC} tokens/s, burst {RATE_LIMIT_BURST} per client "
+            f"({'shared via Redis' if rate_limiter.shared else 'local only'})"
+        )
+    else:
+        logger.info("   Rate limit: off")
     
     logger.info("✅ Router ready")
 
@@ -262,232 +1418,516 @@ async def startup_event():
 async def shutdown_event():
     """Graceful shutdown"""
     logger.info("🛑 Router shutting down...")
+    await gpu_pool.stop()
+    await cpu_pool.stop()
+    await response_cache.stop()
+    await rate_limiter.stop()
+    backend_clients.clear()
 
 # =====================================================
 # Request Forwarding
 # =====================================================
 
+# Headers that describe a single connection and must not be relayed
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "content-length",
+}
+
 async def forward_request(
-    backend_name: str,
-    backend_url: str,
+    replica: Replica,
     request: Request,
     path: str = "/infer",
-) -> JSONResponse:
+) -> Response:
     """
     Forward HTTP request to backend service
     
+    Successful responses are relayed as a byte stream (no JSON re-parsing),
+    so SSE backends are flushed to the client incrementally. Error responses
+    (status >= 400) are small and buffered, so callers can inspect them and
+    fall back without leaking an open upstream stream.
+    
+    The replica's outstanding count covers the whole exchange, including
+    the streamed body.
+    
     Args:
-        backend_name: Name for logging/metrics (gpu/cpu)
-        backend_url: Base URL of backend service
+        replica: Target backend replica (tier is used for metrics)
         request: Incoming FastAPI request
         path: API path to call
         
     Returns:
-        JSONResponse with backend response
+        StreamingResponse (or buffered Response for errors) with backend status and headers
         
     Raises:
         HTTPException on backend errors
     """
+    upstream, start_time = await open_upstream(replica, request, path)
+    return await relay_upstream(replica, upstream, start_time)
+
+async def open_upstream(replica: Replica, request: Request, path: str = "/infer"):
+    """
+    Send the request and wait for the response headers. Returns
+    (upstream, start_time); the replica stays counted as outstanding until
+    the upstream is closed (see relay_upstream / discard_upstream).
+    """
     start_time = time.time()
+    client = replica.client
+    backend_name = replica.tier
+    replica.begin()
     
     try:
-        async with httpx.AsyncClient(timeout=BACKEND_TIMEOUT) as client:
-            # Get request body
-            body = await request.body()
-            
-            # Prepare headers (remove hop-by-hop headers)
-            headers = dict(request.headers)
-            headers.pop("host", None)
-            headers.pop("connection", None)
-            headers.pop("transfer-encoding", None)
-            
-            # Make backend request
-            backend_full_url = f"{backend_url}{path}"
-            
-            logger.info(f"→ Forwarding to {backend_name}: {request.method} {path}")
-            
-            response = await client.request(
-                method=request.method,
-                url=backend_full_url,
-                content=body,
-                headers=headers,
-                params=request.query_params,
-            )
-            
-            # Record metrics
-            duration = time.time() - start_time
-            requests_duration.labels(backend=backend_name).observe(duration)
-            requests_total.labels(backend=backend_name, status=response.status_code).inc()
-            
-            logger.info(
-                f"✓ {backend_name} response: {response.status_code} "
-                f"({duration:.2f}s)"
-            )
-            
-            # Parse response
-            if "application/json" in response.headers.get("content-type", ""):
-                content = response.json()
-            else:
-                content = response.text
-            
-            return JSONResponse(
-                status_code=response.status_code,
-                content=content,
-            )
-            
+        # Get request body
+        body = await request.body()
+        
+        # Prepare headers (remove hop-by-hop headers)
+        headers = dict(request.headers)
+        headers.pop("host", None)
+        headers.pop("connection", None)
+        headers.pop("transfer-encoding", None)
+        
+        # Make backend request
+        backend_full_url = f"{replica.url}{path}"
+        
+        logger.info(f"→ Forwarding to {replica.name}: {request.method} {path}")
+        
+        backend_request = client.build_request(
+            method=request.method,
+            url=backend_full_url,
+            content=body,
+            headers=headers,
+            params=request.query_params,
+        )
+        upstream = await client.send(backend_request, stream=True)
+        
+    except asyncio.CancelledError:
+        # Lost a hedge race (or the client went away) before the headers arrived
+        replica.end()
+        raise
+        
     except httpx.TimeoutException as e:
+        replica.end()
         duration = time.time() - start_time
         requests_duration.labels(backend=backend_name).observe(duration)
         requests_total.labels(backend=backend_name, status=504).inc()
-        logger.error(f"✗ {backend_name} timeout after {duration:.2f}s: {e}")
+        logger.error(f"✗ {replica.name} timeout after {duration:.2f}s: {e}")
         raise HTTPException(status_code=504, detail=f"{backend_name} timeout")
         
     except httpx.RequestError as e:
+        replica.end()
         duration = time.time() - start_time
         requests_duration.labels(backend=backend_name).observe(duration)
         requests_total.labels(backend=backend_name, status=502).inc()
-        logger.error(f"✗ {backend_name} connection error: {e}")
+        logger.error(f"✗ {replica.name} connection error: {e}")
         raise HTTPException(status_code=502, detail=f"{backend_name} unavailable")
         
     except Exception as e:
+        replica.end()
         duration = time.time() - start_time
         requests_duration.labels(backend=backend_name).observe(duration)
         requests_total.labels(backend=backend_name, status=500).inc()
-        logger.error(f"✗ {backend_name} error: {e}")
+        logger.error(f"✗ {replica.name} error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    
+    if path == "/infer" and upstream.status_code < 500:
+        header_latency[backend_name].observe(time.time() - start_time)
+    return upstream, start_time
+
+async def discard_upstream(replica: Replica, upstream: httpx.Response):
+    """Close a response that won't be relayed (hedge loser)"""
+    replica.end()
+    await upstream.aclose()
+
+async def relay_upstream(replica: Replica, upstream: httpx.Response, start_time: float) -> Response:
+    """Relay an open upstream response (see forward_request)"""
+    backend_name = replica.tier
+    requests_total.labels(backend=backend_name, status=upstream.status_code).inc()
+    response_headers = {
+        k: v for k, v in upstream.headers.items()
+        if k.lower() not in HOP_BY_HOP_HEADERS
+    }
+    
+    closed = False
+    
+    async def close_upstream():
+        # Returns the connection to the pool (idempotent: called from relay and background)
+        nonlocal closed
+        if not closed:
+            closed = True
+            replica.end()
+        await upstream.aclose()
+    
+    if upstream.status_code >= 400:
+        try:
+            content = await upstream.aread()
+        except httpx.HTTPError as e:
+            logger.warning(f"✗ {replica.name} error body unreadable: {e}")
+            content = b""
+        finally:
+            await close_upstream()
+        duration = time.time() - start_time
+        requests_duration.labels(backend=backend_name).observe(duration)
+        logger.info(
+            f"✓ {replica.name} response: {upstream.status_code} "
+            f"({duration:.2f}s)"
+        )
+        return Response(content=content, status_code=upstream.status_code, headers=response_headers)
+    
+    async def relay():
+        first_byte = True
+        try:
+            async for chunk in upstream.aiter_raw():
+                if first_byte:
+                    time_to_first_byte.labels(backend=backend_name).observe(time.time() - start_time)
+                    first_byte = False
+                yield chunk
+        except httpx.HTTPError as e:
+            # Headers are already sent; all we can do is end the stream and record it
+            logger.error(f"✗ {replica.name} stream aborted: {e}")
+        finally:
+            await close_upstream()
+            duration = time.time() - start_time
+            requests_duration.labels(backend=backend_name).observe(duration)
+            logger.info(
+                f"✓ {replica.name} response: {upstream.status_code} "
+                f"({duration:.2f}s)"
+            )
+    
+    return StreamingResponse(
+        relay(),
+        status_code=upstream.status_code,
+        headers=response_headers,
+        background=BackgroundTask(close_upstream),
+    )
+
+
+async def hedged_forward(
+    replica: Replica,
+    request: Request,
+    hedge_to: Callable[[Replica], Optional[Replica]],
+) -> Tuple[Response, Replica]:
+    """
+    forward_request to ``replica``, hedged when HEDGE_ENABLED: if no response
+    headers arrive within the tier's hedge delay, a second attempt goes to
+    ``hedge_to(replica)`` (budget permitting). The first answer without a
+    5xx or transport error is relayed and the other attempt is cancelled.
+    Returns (response, replica that served it); if both fail, the first
+    replica's outcome is returned or raised.
+    
+    Streams commit once their headers arrive, so a streamed request can only
+    be hedged while the backend has not yet accepted it. ``hedge_to`` is
+    responsible for any admission slot the hedge needs (the GPU path takes
+    one while the race lasts).
+    """
+    hedge_budget.earn()
+    delay = header_latency[replica.tier].hedge_delay() if HEDGE_ENABLED else None
+    if delay is None:
+        return await forward_request(replica, request), replica
+    
+    primary = asyncio.create_task(open_upstream(replica, request))
+    attempts = {primary: replica}
+    outcomes: Dict[asyncio.Task, Any] = {}
+    chosen: Optional[asyncio.Task] = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if not done:
+            backup = hedge_to(replica)
+            if backup is None:
+                hedges_skipped.labels(reason="no_replica").inc()
+            elif not hedge_budget.try_spend():
+                hedges_skipped.labels(reason="budget").inc()
+            else:
+                logger.info(f"⏱  {replica.name} slower than {delay:.1f}s, hedging to {backup.name}")
+                hedges_fired.labels(backend=replica.tier).inc()
+                attempts[asyncio.create_task(open_upstream(backup, request))] = backup
+        
+        winner: Optional[asyncio.Task] = None
+        pending = set(attempts)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                outcome = outcomes[task] = task.exception() or task.result()
+                if winner is None and not isinstance(outcome, BaseException) and outcome[0].status_code < 500:
+                    winner = task
+        chosen = winner or primary
+    finally:
+        # Also runs when we are cancelled: no attempt may outlive this call
+        # holding an open response (and the replica's outstanding count)
+        unfinished = [task for task in attempts if task not in outcomes]
+        for task in unfinished:
+            task.cancel()
+        for task, outcome in zip(unfinished, await asyncio.gather(*unfinished, return_exceptions=True)):
+            outcomes[task] = outcome
+        for task, outcome in outcomes.items():
+            if task is chosen:
+                continue
+            if isinstance(outcome, HTTPException):
+                attempts[task].breaker.record_failure()
+            elif not isinstance(outcome, BaseException):
+                await discard_upstream(attempts[task], outcome[0])
+    
+    served = attempts[chosen]
+    if chosen is not primary:
+        hedges_won.labels(backend=served.tier).inc()
+    outcome = outcomes[chosen]
+    if isinstance(outcome, BaseException):
+        raise outcome
+    return await relay_upstream(served, *outcome), served
+
+def defer_until_sent(response: Response, callback) -> bool:
+    """
+    Run ``callback`` after a streamed response body has been fully sent
+    (or the client disconnected) instead of when the handler returns.
+    Returns False for buffered responses, which the caller handles itself.
+    """
+    if not isinstance(response, StreamingResponse):
+        return False
+    tasks = BackgroundTasks()
+    if response.background is not None:
+        tasks.add_task(response.background)
+    tasks.add_task(callback)
+    response.background = tasks
+    return True
 
 # =====================================================
 # Routing Logic
 # =====================================================
 
+async def route_to_cpu(request: Request, affinity_key: Optional[str] = None) -> Response:
+    """Forward to a CPU replica, recording circuit-breaker results and observed service time"""
+    # Last resort: try any CPU replica rather than refusing outright
+    replica = cpu_pool.pick(healthy_only=False, affinity_key=affinity_key)
+    if replica is None:
+        raise HTTPException(status_code=503, detail="No CPU backends available")
+    
+    started = time.time()
+    try:
+        response, replica = await hedged_forward(
+            replica, request, lambda tried: cpu_pool.pick(affinity_key=affinity_key, exclude=tried)
+        )
+    except HTTPException:
+        replica.breaker.record_failure()
+        raise
+    
+    if response.status_code >= 500:
+        replica.breaker.record_failure()
+    else:
+        replica.breaker.record_success()
+    
+    def observe():
+        if response.status_code < 400:
+            cpu_service_time.observe(time.time() - started)
+    
+    if not defer_until_sent(response, observe):
+        observe()
+    return response
+
+async def fallback_to_cpu(
+    request: Request, affinity_key: Optional[str], priority: PriorityClass, reason: str
+) -> Response:
+    """GPU tier can't take the request: CPU for interactive traffic, 503 for sheddable classes"""
+    if priority.sheddable:
+        raise shed(priority, reason, 503, gpu_retry_after())
+    fallback_count.labels(reason=reason).inc()
+    return await route_to_cpu(request, affinity_key)
+
 @app.api_route("/infer", methods=["POST"])
 async def infer(request: Request):
     """
     Route inference request with adaptive logic:
     
     Priority 1: Respect user's use_gpu preference
-    Priority 2: GPU (if available and healthy)
+    Priority 2: GPU (if available and healthy, possibly after a bounded wait)
     Priority 3: CPU (fallback)
     
     Routing decision based on:
     - User's use_gpu flag in request body
-    - GPU queue capacity
-    - Circuit breaker state
-    - Backend health
+    - Priority class (X-Priority / priority): weighted fair GPU queuing,
+      low-priority work shed with 429/503 + Retry-After under load
+    - Predicted GPU wait (queue depth x service time) vs predicted CPU latency
+    - Request latency budget (X-Latency-Budget / latency_budget)
+    - Circuit breaker state and health of each replica
+    
+    Within a tier the replica is chosen by LB_POLICY (power of two choices,
+    least outstanding requests, or chash: consistent hashing of the session
+    or prompt with bounded loads). Sessions always stick to one replica.
     """
     
     # Parse request body to check use_gpu preference
     try:
         body_bytes = await request.body()
         body = body_bytes.decode('utf-8')
-        import json
         payload = json.loads(body) if body else {}
         use_gpu_requested = payload.get("use_gpu", True)  # Default to True for backward compatibility
     except Exception as e:
         logger.warning(f"Failed to parse request body: {e}, defaulting to GPU priority")
+        payload = {}
         use_gpu_requested = True
     
+    # Keep a conversation on one replica so its cached KV state is reused; with
+    # the chash policy, also send the same prompt to the same replica (pod caches)
+    affinity = session_key(request, payload)
+    if affinity is None and LB_POLICY == "chash":
+        affinity = prompt_key(payload)
+    
+    # Exact cache hits are answered here, before taking any backend capacity
+    prompt = cache_prompt(payload)
+    max_tokens = cache_max_tokens(payload)
+    if prompt is not None and max_tokens is not None:
+        cached = await response_cache.get(prompt, max_tokens)
+        if cached is not None:
+            logger.info(f"✓ Router cache hit (length={len(prompt)})")
+            requests_total.labels(backend="cache", status=200).inc()
+            return cached_response(payload, prompt, cached)
+    
+    # Per-client limit, weighted by the generation length the client asked for
+    wait = await rate_limiter.check(client_id(request), max_tokens or 400)
+    if wait is not None:
+        logger.info(f"🚫 Rate limited client (retry after {wait:.1f}s)")
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded, retry later",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+    
+    # Sheddable classes (batch/eval) never fall back (or hedge) to CPU: they are
+    # refused instead, keeping both tiers free for interactive traffic
+    priority = request_priority(request, payload)
+    
     # If user explicitly requests CPU, route to CPU directly
     if not use_gpu_requested:
         logger.info("User requested CPU inference, routing to CPU")
         fallback_count.labels(reason="user_preference").inc()
-        try:
-            return await forward_request("cpu", CPU_URL, request)
-        except HTTPException as e:
-            cpu_circuit_breaker.record_failure()
-            raise
-    
-    # User wants GPU - continue with existing GPU-priority logic
-    # Update capacity gauge
-    gpu_capacity.set(gpu_semaphore._value)
-    gpu_queue_size.set(GPU_MAX_INFLIGHT - gpu_semaphore._value)
+        return await route_to_cpu(request, affinity)
     
     # Check if we should try GPU
-    should_try_gpu = (
-        gpu_circuit_breaker.can_attempt() and
-        gpu_health_monitor.is_healthy and
-        gpu_semaphore._value > 0
-    )
+    should_try_gpu = gpu_pool.has_available()
     
     if not should_try_gpu:
-        # GPU not available - go straight to CPU
-        reason = "circuit_open" if not gpu_circuit_breaker.can_attempt() else \
-                 "unhealthy" if not gpu_health_monitor.is_healthy else \
-                 "queue_full"
+        # No GPU replica available - go straight to CPU
+        reason = gpu_pool.unavailable_reason()
         
-        logger.info(f"⚠️  Skipping GPU (reason: {reason}), routing to CPU")
-        fallback_count.labels(reason=reason).inc()
+        logger.info(f"⚠️  Skipping GPU (reason: {reason})")
+        return await fallback_to_cpu(request, affinity, priority, reason)
+    
+    # Wait for a GPU slot only while that is predicted to beat CPU and fits the budget.
+    # Sheddable classes wait up to their shed_after instead.
+    acquired = gpu_admission.try_acquire()
+    if not acquired and priority.sheddable:
+        predicted_wait = gpu_admission.predicted_wait(priority)
+        max_wait = min(latency_budget(request, payload), priority.shed_after)
+        if gpu_admission.class_full(priority):
+            raise shed(priority, "queue_full", 429, predicted_wait)
+        if predicted_wait > max_wait:
+            raise shed(priority, "predicted_wait", 503, predicted_wait)
+        if not await gpu_admission.acquire(timeout=max_wait, priority=priority):
+            raise shed(priority, "queue_timeout", 503, gpu_admission.predicted_wait(priority))
+        acquired = True
+    if not acquired:
+        budget = latency_budget(request, payload)
+        predicted_wait = gpu_admission.predicted_wait(priority)
+        gpu_total = predicted_wait + gpu_service_time.value
+        cpu_total = cpu_service_time.value if cpu_pool.is_healthy else float("inf")
+        max_wait = min(budget, cpu_total - gpu_service_time.value)
         
-        try:
-            return await forward_request("cpu", CPU_URL, request)
-        except HTTPException as e:
-            cpu_circuit_breaker.record_failure()
-            raise
+        if gpu_total < cpu_total and predicted_wait <= max_wait:
+            acquired = await gpu_admission.acquire(timeout=max_wait, priority=priority)
+            reason = "queue_timeout"
+        else:
+            reason = "queue_full"
+        
+        if not acquired:
+            logger.info(
+                f"⚠️  GPU queue (reason: {reason}, depth={gpu_admission.depth}, "
+                f"predicted_wait={predicted_wait:.1f}s, cpu={cpu_total:.1f}s), routing to CPU"
+            )
+            fallback_count.labels(reason=reason).inc()
+            return await route_to_cpu(request, affinity)
     
-    # Try to acquire GPU slot
-    acquired = False
+    started = time.time()
     try:
-        # Non-blocking acquire with immediate timeout
-        acquired = await asyncio.wait_for(
-            gpu_semaphore.acquire(),
-            timeout=0.001
-        )
-    except asyncio.TimeoutError:
-        # GPU queue full - fallback to CPU
-        logger.info("⚠️  GPU queue full, routing to CPU")
-        fallback_count.labels(reason="queue_full").inc()
-        
-        try:
-            return await forward_request("cpu", CPU_URL, request)
-        except HTTPException as e:
-            cpu_circuit_breaker.record_failure()
-            raise
+        cost = float(payload.get("max_tokens", 400))
+    except (TypeError, ValueError):
+        cost = 400.0
+    
+    def release_gpu_slot():
+        latency = time.time() - started
+        if replica.tier != "gpu":
+            # A CPU hedge won the race: its latency says nothing about GPU service time
+            cpu_service_time.observe(latency)
+            gpu_admission.release()
+            return
+        gpu_service_time.observe(latency)
+        gpu_admission.release(latency=latency, cost=cost)
+    
+    # GPU slot acquired - pick the replica now, so the choice reflects current load
+    replica = gpu_pool.pick(affinity_key=affinity)
+    if replica is None:
+        acquired = False
+        gpu_admission.release(dropped=True)
+        reason = gpu_pool.unavailable_reason()
+        logger.info(f"⚠️  No GPU replica after admission (reason: {reason})")
+        return await fallback_to_cpu(request, affinity, priority, reason)
+    
+    # A hedge goes to another GPU replica if a GPU slot is free, else to CPU (interactive only)
+    hedge_slots = 0
+    
+    def hedge_target(tried: Replica) -> Optional[Replica]:
+        nonlocal hedge_slots
+        backup = gpu_pool.pick(affinity_key=affinity, exclude=tried)
+        if backup is not None and gpu_admission.try_acquire():
+            hedge_slots += 1
+            return backup
+        return None if priority.sheddable else cpu_pool.pick(affinity_key=affinity)
     
-    # GPU slot acquired - try GPU
     try:
         try:
-            response = await forward_request("gpu", GPU_URL, request)
+            try:
+                response, replica = await hedged_forward(replica, request, hedge_target)
+            finally:
+                # The race is decided: one attempt survives under this request's own slot
+                for _ in range(hedge_slots):
+                    gpu_admission.release()
+        except HTTPException as e:
+            # GPU failed - try CPU fallback
+            logger.warning(f"⚠️  {replica.name} failed: {e.detail}, attempting CPU fallback")
+            replica.breaker.record_failure()
             
-            # Check for backend errors that should trigger fallback
-            if response.status_code >= 500:
-                logger.warning(
-                    f"⚠️  GPU returned {response.status_code}, "
-                    f"attempting CPU fallback"
-                )
-                gpu_circuit_breaker.record_failure()
-                fallback_count.labels(reason="gpu_error").inc()
-                
-                # Try CPU
-                try:
-                    return await forward_request("cpu", CPU_URL, request)
-                except HTTPException:
-                    cpu_circuit_breaker.record_failure()
-                    # Return original GPU error
-                    return response
+            acquired = False
+            gpu_admission.release(dropped=True)
             
-            # Success!
-            gpu_circuit_breaker.record_success()
-            return response
+            return await fallback_to_cpu(request, affinity, priority, "gpu_failed")
+        
+        # Check for backend errors that should trigger fallback
+        if response.status_code >= 500:
+            logger.warning(
+                f"⚠️  {replica.name} returned {response.status_code}, "
+                f"attempting CPU fallback"
+            )
+            replica.breaker.record_failure()
             
-        except HTTPException as e:
-            # GPU failed - try CPU fallback
-            logger.warning(f"⚠️  GPU failed: {e.detail}, attempting CPU fallback")
-            gpu_circuit_breaker.record_failure()
-            fallback_count.labels(reason="gpu_failed").inc()
+            # Free the slot before the (slow) CPU attempt
+            acquired = False
+            gpu_admission.release(dropped=True)
+            if priority.sheddable:
+                raise shed(priority, "gpu_error", 503, gpu_retry_after())
+            fallback_count.labels(reason="gpu_error").inc()
             
+            # Try CPU
             try:
-                response = await forward_request("cpu", CPU_URL, request)
-                cpu_circuit_breaker.record_success()
-                return response
+                return await route_to_cpu(request, affinity)
             except HTTPException:
-                cpu_circuit_breaker.record_failure()
-                raise
-                
+                # Return original GPU error
+                return response
+        
+        # Success! Hold the GPU slot until the body has been streamed
+        replica.breaker.record_success()
+        if defer_until_sent(response, release_gpu_slot):
+            acquired = False
+        return response
+    
     finally:
         if acquired:
-            gpu_semaphore.release()
-            gpu_capacity.set(gpu_semaphore._value)
-            gpu_queue_size.set(GPU_MAX_INFLIGHT - gpu_semaphore._value)
+            release_gpu_slot()
 
 # =====================================================
 # Health & Status Endpoints
@@ -500,23 +1940,32 @@ async def health():
         "status": "healthy",
         "backends": {
             "gpu": {
-                "url": GPU_URL,
-                "healthy": gpu_health_monitor.is_healthy,
-                "circuit_breaker": gpu_circuit_breaker.state.name,
-                "available_slots": gpu_semaphore._value,
-                "max_slots": GPU_MAX_INFLIGHT,
+                **gpu_pool.status(),
+                "available_slots": gpu_admission.available,
+                "max_slots": gpu_admission.limit,
+                "concurrency_limit": {
+                    "algorithm": gpu_limiter.algorithm,
+                    "current": gpu_limiter.limit,
+                    "min": gpu_limiter.min_limit,
+                    "max": gpu_limiter.max_limit,
+                },
+                "queue_depth": gpu_admission.depth,
+                "queue_depth_by_priority": gpu_admission.depth_by_priority(),
+                "predicted_wait_seconds": round(gpu_admission.predicted_wait(), 2),
+                "service_time_seconds": round(gpu_service_time.value, 2),
             },
             "cpu": {
-                "url": CPU_URL,
-                "healthy": cpu_health_monitor.is_healthy,
-                "circuit_breaker": cpu_circuit_breaker.state.name,
+                **cpu_pool.status(),
+                "service_time_seconds": round(cpu_service_time.value, 2),
             }
-        }
+        },
+        "rate_limit": rate_limiter.stats(),
     }
 
 @app.get("/metrics")
 async def metrics():
     """Prometheus metrics"""
+    update_pool_metrics()
     return Response(
         content=generate_latest(),
         media_type=CONTENT_TYPE_LATEST
@@ -540,10 +1989,20 @@ async def root():
             "/metrics": "GET - Prometheus metrics",
         },
         "config": {
-            "gpu_url": GPU_URL,
-            "cpu_url": CPU_URL,
+            "gpu_urls": GPU_URLS,
+            "cpu_urls": CPU_URLS,
+            "gpu_discovery_dns": GPU_DISCOVERY_DNS,
+            "cpu_discovery_dns": CPU_DISCOVERY_DNS,
+            "lb_policy": LB_POLICY,
             "gpu_max_inflight": GPU_MAX_INFLIGHT,
+            "gpu_max_queue": GPU_MAX_QUEUE,
+            "priority_classes": {
+                c.name: {"weight": c.weight, "shed_after": c.shed_after} for c in priority_classes.values()
+            },
+            "default_latency_budget": DEFAULT_LATENCY_BUDGET,
             "backend_timeout": BACKEND_TIMEOUT,
+            "router_cache": response_cache.enabled,
+            "hedging": {"enabled": HEDGE_ENABLED, "percentile": HEDGE_PERCENTILE, "budget": HEDGE_BUDGET},
         }
     }
 
@@ -551,13 +2010,20 @@ async def root():
 # Cache endpoints (proxy to backends)
 # =====================================================
 
+def cache_replica() -> Replica:
+    """Any reachable replica (the cache lives in shared Redis), preferring GPU"""
+    replica = gpu_pool.pick() or cpu_pool.pick() or gpu_pool.pick(healthy_only=False)
+    if replica is None:
+        raise HTTPException(status_code=503, detail="No backends available")
+    return replica
+
 @app.post("/cache/clear")
 async def clear_cache(request: Request):
-    """Clear cache (forwards to GPU backend)"""
-    return await forward_request("gpu", GPU_URL, request, "/cache/clear")
+    """Clear cache (forwards to a backend replica)"""
+    return await forward_request(cache_replica(), request, "/cache/clear")
 
 @app.get("/cache/stats")
 async def cache_stats(request: Request):
-    """Get cache stats (forwards to GPU backend)"""
-    return await forward_request("gpu", GPU_URL, request, "/cache/stats")
+    """Get cache stats (forwards to a backend replica)"""
+    return await forward_request(cache_replica(), request, "/cache/stats")
 
@@ -25,12 +25,18 @@ export function runTest() {
     max_tokens: config.max_tokens,
     model_name: config.model,
     use_gpu: config.use_gpu,
-    use_cache: config.use_cache
+    use_cache: config.use_cache,
+    // Router priority class (interactive | batch | eval); omitted when unset
+    priority: __ENV.PRIORITY || config.priority
   });
 
-  http.post(API_URL, payload, {
-    headers: { "Content-Type": "application/json" }
-  });
+  // API key for the router's per-client rate limit (exempt keys are never limited)
+  const headers = { "Content-Type": "application/json" };
+  if (__ENV.API_KEY) {
+    headers["X-API-Key"] = __ENV.API_KEY;
+  }
+
+  http.post(API_URL, payload, { headers: headers });
 
   sleep(0.2);
 }